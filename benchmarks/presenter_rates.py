@@ -0,0 +1,76 @@
+"""
+Measures the frame rates that the Presenter can sustain using the emulated ALP device.
+
+For each picture time, a run of SparseNoise patterns is presented and saved, and the emulator reports how often the
+device queue ran empty (underruns) and for how long. With --no_monitor, the presenter polls the projection progress
+at a fixed interval instead of using the ProjectionMonitor thread; short sequences show the difference:
+
+    python benchmarks/presenter_rates.py --pic_times 10000 1000 100 50
+    python benchmarks/presenter_rates.py --pic_times 1000 --pix_per_seq 20 --nseqs 3 [--no_monitor]
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from dmdlib.core.ALP import AlpDmd
+from dmdlib.core.emulator import AlpEmulator
+from dmdlib.randpatterns.presenter import Presenter, PipelinedPresenter
+from dmdlib.randpatterns.saving import HfiveSaver
+from dmdlib.randpatterns.sparsenoise_obj import SparseNoise
+
+
+def run(picture_time, nframes, pix_per_seq, nseqs, scale, fraction_on, usb_bandwidth, packed, read_ahead, workdir,
+        monitor=True):
+    emulator = AlpEmulator(usb_bandwidth=usb_bandwidth)
+    mask = np.ones((emulator.height, emulator.width), dtype=bool)
+    generator = SparseNoise(fraction_on, mask, scale)
+    path = os.path.join(workdir, 'bench_{}.h5'.format(picture_time))
+    with HfiveSaver(path, overwrite=True) as saver, AlpDmd(backend=emulator) as dmd:
+        kwargs = dict(nseqs=nseqs, pix_per_seq=pix_per_seq, picture_time=picture_time, image_scale=scale,
+                      packed=packed, monitor=monitor)
+        if read_ahead:
+            presenter = PipelinedPresenter(dmd, generator, saver, nframes, read_ahead=read_ahead, **kwargs)
+        else:
+            presenter = Presenter(dmd, generator, saver, nframes, **kwargs)
+        t = time.perf_counter()
+        presenter.run()
+        elapsed = time.perf_counter() - t
+        presenter.shutdown()
+    result = emulator.summary()
+    result['wall_time_s'] = elapsed
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pic_times', type=int, nargs='+', default=[10000, 1000, 200, 50],
+                        help='picture times to test in us')
+    parser.add_argument('--nframes', type=int, default=5000, help='frames to present per picture time')
+    parser.add_argument('--pix_per_seq', type=int, default=250)
+    parser.add_argument('--nseqs', type=int, default=3)
+    parser.add_argument('--scale', type=int, default=4)
+    parser.add_argument('--fraction_on', type=float, default=.005)
+    parser.add_argument('--usb_mbps', type=float, default=40., help='emulated USB bandwidth in MB/s')
+    parser.add_argument('--packed', action='store_true', help='upload packed binary frames')
+    parser.add_argument('--read_ahead', type=int, default=0, help='use the PipelinedPresenter with this read ahead')
+    parser.add_argument('--no_monitor', action='store_true', help='poll the progress every 100 ms instead')
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for pt in args.pic_times:
+            r = run(pt, args.nframes, args.pix_per_seq, args.nseqs, args.scale, args.fraction_on,
+                    args.usb_mbps * 1e6, args.packed, args.read_ahead, workdir, not args.no_monitor)
+            rows.append((pt, r))
+
+    print('{:>10} {:>10} {:>12} {:>10} {:>10} {:>12} {:>12}'.format(
+        'pic_us', 'target_hz', 'achieved_hz', 'shown', 'underruns', 'underrun_s', 'upload_s'))
+    for pt, r in rows:
+        print('{:>10} {:>10.0f} {:>12.1f} {:>10} {:>10} {:>12.3f} {:>12.3f}'.format(
+            pt, 1e6 / pt, r['frames_displayed'] / r['wall_time_s'], r['frames_displayed'], r['underruns'],
+            r['underrun_time_s'], r['upload_time_s']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Compares the write throughput of the h5 savers for sparse noise sequences.
+
+Sequences are submitted at the rate they would be presented at the given picture time (250 frames per sequence at
+1000 us is one sequence every 250 ms). The time each store_sequence_array call blocks the presentation loop, the time
+to drain the writer on close, the write latency and stalls of the save queue, and the resulting file size are
+reported. With --queue_mb, the save queue is limited to that many MB and submissions wait when it is full.
+
+    python benchmarks/saver_throughput.py --pic_time 1000 --nseqs 200
+    python benchmarks/saver_throughput.py --unpaced --queue_mb 50
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from dmdlib.randpatterns.saving import HfiveSaver, HfiveStreamSaver, MAX_QUEUE_BYTES
+from dmdlib.randpatterns.sparsenoise_obj import SparseNoise
+
+SAVERS = {
+    'HfiveSaver': HfiveSaver,
+    'HfiveStreamSaver': HfiveStreamSaver,
+}
+
+
+def run(saver_class, sequences, picture_time, path, paced, packing=None, logical_mask=None,
+        max_queue_bytes=MAX_QUEUE_BYTES):
+    n_frames = len(sequences[0])
+    interval = n_frames * picture_time / 1e6
+    store_times = []
+    t_start = time.perf_counter()
+    with saver_class(path, overwrite=True, packing=packing, logical_mask=logical_mask,
+                     max_queue_bytes=max_queue_bytes) as saver:
+        t_next = time.perf_counter()
+        for i, seq in enumerate(sequences):
+            if paced:
+                t_next += interval
+            t = time.perf_counter()
+            saver.store_sequence_array(seq, {'seq_id': i % 3, 'picture_time_us': picture_time})
+            store_times.append(time.perf_counter() - t)
+            if paced:
+                time.sleep(max(0., t_next - time.perf_counter()))
+        t_close = time.perf_counter()
+    t_end = time.perf_counter()
+    queue = saver.queue_stats.summary()
+    return {
+        'total_s': t_end - t_start,
+        'close_s': t_end - t_close,
+        'store_max_ms': max(store_times) * 1e3,
+        'store_mean_ms': np.mean(store_times) * 1e3,
+        'frames_per_s': n_frames * len(sequences) / (t_end - t_start),
+        'size_mb': os.path.getsize(path) / 1e6,
+        'write_p95_ms': queue['write_p95_ms'],
+        'peak_queue_mb': queue['peak_mb'],
+        'stalls': queue['stalls'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pic_time', type=int, default=1000, help='picture time in us used to pace the sequences')
+    parser.add_argument('--nseqs', type=int, default=100, help='number of sequences to save')
+    parser.add_argument('--pix_per_seq', type=int, default=250)
+    parser.add_argument('--scale', type=int, default=4)
+    parser.add_argument('--fraction_on', type=float, default=.005)
+    parser.add_argument('--unpaced', action='store_true', help='submit sequences as fast as possible')
+    parser.add_argument('--packing', choices=['bits', 'unmasked'], default=None, help='bit-packed storage')
+    parser.add_argument('--queue_mb', type=int, default=MAX_QUEUE_BYTES // 2 ** 20, help='save queue budget in MB')
+    args = parser.parse_args()
+
+    mask = np.ones((768, 1024), dtype=bool)
+    generator = SparseNoise(args.fraction_on, mask, args.scale, seed=0)
+    h, w = 768 // args.scale, 1024 // args.scale
+    sequences = []
+    for i in range(args.nseqs):
+        seq = np.zeros((args.pix_per_seq, h, w), dtype=bool)
+        generator.frames(i * args.pix_per_seq, seq)
+        sequences.append(seq)
+
+    rows = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, saver_class in SAVERS.items():
+            path = os.path.join(workdir, name + '.h5')
+            rows.append((name, run(saver_class, sequences, args.pic_time, path, not args.unpaced, args.packing,
+                                   generator.unmasked, args.queue_mb * 2 ** 20)))
+
+    print('{:>18} {:>10} {:>10} {:>14} {:>15} {:>12} {:>10} {:>14} {:>14} {:>8}'.format(
+        'saver', 'total_s', 'close_s', 'store_max_ms', 'store_mean_ms', 'frames/s', 'size_mb', 'write_p95_ms',
+        'peak_queue_mb', 'stalls'))
+    for name, r in rows:
+        print('{:>18} {:>10.2f} {:>10.2f} {:>14.2f} {:>15.3f} {:>12.0f} {:>10.1f} {:>14.1f} {:>14.1f} {:>8}'.format(
+            name, r['total_s'], r['close_s'], r['store_max_ms'], r['store_mean_ms'], r['frames_per_s'],
+            r['size_mb'], r['write_p95_ms'], r['peak_queue_mb'], r['stalls']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Measures the time SparseNoise takes to generate one sequence for upload, against the previous multi-pass
+implementation (per frame numpy Philox draws, threshold, boolean scatter, zoomer and mask multiplication). Both the
+dense (fused kernel) and the sparse (coordinate list) generation methods are timed.
+
+    python benchmarks/sparsenoise_generation.py --pix_per_seq 250 --scale 4
+"""
+import argparse
+import time
+import numpy as np
+from dmdlib.randpatterns import utils
+from dmdlib.randpatterns.sparsenoise_obj import SparseNoise
+
+
+def reference_make_patterns(generator: SparseNoise, boolean_array, whole_seq_array):
+    """ the implementation that SparseNoise.make_patterns replaced. """
+    n_frames = boolean_array.shape[0]
+    randbool = np.empty((n_frames, generator.n_unmasked_pix), dtype=bool)
+    randnums = np.empty(generator.n_unmasked_pix)
+    for i in range(n_frames):
+        generator.streams.frame(generator.frame_index + i).random(out=randnums)
+        np.less_equal(randnums, generator.threshold, out=randbool[i])
+    utils.reshape(randbool, generator.unmasked, boolean_array)
+    generator.frame_index += n_frames
+    utils.render_sequence(boolean_array, generator.scale, whole_seq_array, generator.mask)
+
+
+def time_sequences(make_patterns, n_seqs, boolean_array, seq_array):
+    make_patterns(boolean_array, seq_array)  # compiles numba functions.
+    times = []
+    for _ in range(n_seqs):
+        t = time.perf_counter()
+        make_patterns(boolean_array, seq_array)
+        times.append(time.perf_counter() - t)
+    return np.median(times) * 1e3, np.min(times) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pix_per_seq', type=int, default=250)
+    parser.add_argument('--scale', type=int, default=4)
+    parser.add_argument('--fraction_on', type=float, default=.005)
+    parser.add_argument('--nseqs', type=int, default=10, help='number of sequences to time')
+    args = parser.parse_args()
+
+    h, w = 768, 1024
+    mask = np.zeros((h, w), dtype=bool)
+    mask[100:700, 150:900] = True
+    generator = SparseNoise(args.fraction_on, mask, args.scale, seed=0, method='dense')
+    sparse_generator = SparseNoise(args.fraction_on, mask, args.scale, seed=0, method='sparse')
+    boolean_array = np.zeros((args.pix_per_seq, h // args.scale, w // args.scale), dtype=bool)
+
+    print('{:>10} {:>10} {:>14} {:>12}'.format('impl', 'format', 'median_ms', 'min_ms'))
+    for fmt, row_bytes in (('uint8', w), ('packed', w // 8)):
+        seq_array = np.zeros((args.pix_per_seq, h, row_bytes), dtype=np.uint8)
+        impls = (
+            ('previous', lambda b, a: reference_make_patterns(generator, b, a)),
+            ('dense', lambda b, a: generator.make_patterns(b, a, False)),
+            ('sparse', lambda b, a: sparse_generator.make_patterns(b, a, False)),
+        )
+        for name, make_patterns in impls:
+            med, mn = time_sequences(make_patterns, args.nseqs, boolean_array, seq_array)
+            print('{:>10} {:>10} {:>14.1f} {:>12.1f}'.format(name, fmt, med, mn))
+
+
+if __name__ == '__main__':
+    main()
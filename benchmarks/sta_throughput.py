@@ -0,0 +1,61 @@
+"""
+Measures how much faster than real time StreamingSTA averages sparse noise for many units.
+
+One second of frames at the given picture time is generated with SparseNoise, and each unit fires at the given
+rate (Poisson). Frames and spikes are added in sequences of pix_per_seq frames, as they would be during a
+presentation, and the time per second of presentation is reported.
+
+    python benchmarks/sta_throughput.py --pic_time 1000 --units 300 --rate 20
+"""
+import argparse
+import time
+import numpy as np
+from dmdlib.randpatterns.sparsenoise_obj import SparseNoise
+from staonline.sta import StreamingSTA
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pic_time', type=int, default=1000, help='picture time in microseconds')
+    parser.add_argument('--units', type=int, default=300)
+    parser.add_argument('--rate', type=float, default=20., help='spike rate of each unit (Hz)')
+    parser.add_argument('--lags', type=int, default=20)
+    parser.add_argument('--scale', type=int, default=4)
+    parser.add_argument('--fraction_on', type=float, default=.05)
+    parser.add_argument('--pix_per_seq', type=int, default=250)
+    parser.add_argument('--seconds', type=int, default=3, help='seconds of presentation to average')
+    args = parser.parse_args()
+
+    h, w = 768, 1024
+    mask = np.zeros((h, w), dtype=bool)
+    mask[100:700, 150:900] = True
+    generator = SparseNoise(args.fraction_on, mask, args.scale, seed=0)
+    frames_per_s = int(1e6 / args.pic_time)
+    n_frames = frames_per_s * args.seconds
+    frames = np.zeros((n_frames, h // args.scale, w // args.scale), dtype=bool)
+    generator.frames(0, frames)
+    rng = np.random.default_rng(0)
+    n_spikes = rng.poisson(args.rate * args.seconds * args.units)
+    spike_frames = np.sort(rng.integers(0, n_frames, n_spikes))
+    units = rng.integers(0, args.units, n_spikes)
+
+    sta = StreamingSTA(frames.shape[1:], args.units, args.lags, generator.unmasked,
+                       capacity=2 * args.pix_per_seq + args.lags)
+    sta.add_frames(frames[:args.pix_per_seq])  # compiles numba functions.
+    sta.add_spikes(units[:10], np.full(10, args.pix_per_seq - 1))
+    sta.reset()
+    t = time.perf_counter()
+    for start in range(0, n_frames, args.pix_per_seq):
+        stop = start + args.pix_per_seq
+        sta.add_frames(frames[start:stop])
+        in_seq = (spike_frames >= start) & (spike_frames < stop)
+        sta.add_spikes(units[in_seq], spike_frames[in_seq])
+    elapsed = time.perf_counter() - t
+    print('{} units, {} spikes/s, {} frames/s, {} lags, {} unmasked logical pixels'.format(
+        args.units, int(n_spikes / args.seconds), frames_per_s, args.lags, sta.n_pix))
+    print('{:.1f} ms per second of presentation ({:.1f}x real time), {} spikes dropped'.format(
+        elapsed / args.seconds * 1e3, args.seconds / elapsed, sta.dropped))
+
+
+if __name__ == '__main__':
+    main()
@@ -30,10 +30,21 @@ class AlpDmd:
     returnpointer = c_long()  # throwaway C pointer that is passed into functions and stores the return message
     alp_id = c_ulong()  # handle
 
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, backend=None):
+        """
+        :param verbose: print device information on connection.
+        :param backend: object implementing the ALP C API functions (AlpDevAlloc, AlpSeqPut, ...). By default, this is
+        the alpV42.dll library. Use dmdlib.core.emulator.AlpEmulator to run without a device.
+        """
         self.connected = False  # is the device connected?
         self.temps = {'DDC': 0, 'APPS': 0, 'PCB': 0}  # temperatures in deg C
         self.seq_handles = []
+        if backend is None:
+            backend = alp_cdll
+        if backend is None:
+            raise AlpError("The directory containing 'alpV42.dll' is not found in the system (Windows) path. "
+                           "Please add it to use this package.")
+        self._alp = backend
         self._AlpDevAlloc()
 
         self.connected = True
@@ -50,10 +61,11 @@ class AlpDmd:
 
         self._projecting = c_long()
         self._proj_progress = AlpProjProgress()
+        self._flut_write = AlpFlutWrite()
 
     def _try_reconnect(self):
         print('trying reconnect...')
-        val = alp_cdll.AlpDevControl(self.alp_id, ALP_USB_CONNECTION, ALP_DEFAULT)
+        val = self._alp.AlpDevControl(self.alp_id, ALP_USB_CONNECTION, ALP_DEFAULT)
         if val == ALP_OK:
             self.connected = True
         return val
@@ -88,29 +100,31 @@ class AlpDmd:
         elif returnval == ALP_NOT_READY:
             self.connected = False
             raise AlpError("ALP_NOT_READY")
+        elif returnval == ALP_MEMORY_FULL:
+            raise AlpOutOfMemoryError("ALP_MEMORY_FULL")
         else:
             raise AlpError('unknown error.')
 
     @_api_call
     def _AlpDevAlloc(self):
-        return alp_cdll.AlpDevAlloc(ALP_DEFAULT, ALP_DEFAULT, byref(self.alp_id))
+        return self._alp.AlpDevAlloc(ALP_DEFAULT, ALP_DEFAULT, byref(self.alp_id))
 
     @_api_call
     def _AlpDevInquire(self, inquire_type, uservarptr):
         # todo: check if uservarptr is a CArgObject.
-        return alp_cdll.AlpDevInquire(self.alp_id, inquire_type, uservarptr)
+        return self._alp.AlpDevInquire(self.alp_id, inquire_type, uservarptr)
 
     @_api_call
     def _AlpDevControl(self, control_type, control_value):
-        return alp_cdll.AlpDevControl(self.alp_id, control_type, control_value)
+        return self._alp.AlpDevControl(self.alp_id, control_type, control_value)
 
     @_api_call
     def _AlpDevHalt(self):
-        return alp_cdll.AlpDevHalt(self.alp_id)
+        return self._alp.AlpDevHalt(self.alp_id)
 
     @_api_call
     def _AlpDevFree(self):
-        return alp_cdll.AlpDevFree(self.alp_id)
+        return self._alp.AlpDevFree(self.alp_id)
 
     @_api_call
     def _AlpSeqAlloc(self, bitplanes, picnum, sequence_id_ptr):
@@ -123,11 +137,11 @@ class AlpDmd:
         :param sequence_id_ptr:
         :return:
         """
-        return alp_cdll.AlpSeqAlloc(self.alp_id, bitplanes, picnum, sequence_id_ptr)
+        return self._alp.AlpSeqAlloc(self.alp_id, bitplanes, picnum, sequence_id_ptr)
 
     @_api_call
     def _AlpSeqControl(self, sequence_id, controltype, controlvalue):
-        return alp_cdll.AlpSeqControl(self.alp_id, sequence_id, controltype, controlvalue)
+        return self._alp.AlpSeqControl(self.alp_id, sequence_id, controltype, controlvalue)
 
     @_api_call
     def _AlpSeqTiming(self,
@@ -148,12 +162,12 @@ class AlpDmd:
         """
 
         # todo: verify ctype in the low level API!
-        return alp_cdll.AlpSeqTiming(self.alp_id, sequenceid, illuminatetime, picturetime,
+        return self._alp.AlpSeqTiming(self.alp_id, sequenceid, illuminatetime, picturetime,
                                      syncdelay, syncpulsewidth, triggerindelay)
 
     @_api_call
     def _AlpSeqInquire(self, sequenceid, inquiretype, uservarptr):
-        return alp_cdll.AlpSeqInquire(self.alp_id, sequenceid, inquiretype, uservarptr)
+        return self._alp.AlpSeqInquire(self.alp_id, sequenceid, inquiretype, uservarptr)
 
     @_api_call
     def _AlpSeqPut(self, sequenceid, picoffset, n_pix, userarrayptr):
@@ -168,14 +182,14 @@ class AlpDmd:
         :param userarrayptr: C-order c_char array.
         :return:
         """
-        return alp_cdll.AlpSeqPut(self.alp_id, sequenceid, picoffset, n_pix, userarrayptr)
+        return self._alp.AlpSeqPut(self.alp_id, sequenceid, picoffset, n_pix, userarrayptr)
 
     @_api_call
     def _AlpSeqFree(self, sequenceid):
         """
         :type sequenceid: c_long
         """
-        return alp_cdll.AlpSeqFree(self.alp_id, sequenceid)
+        return self._alp.AlpSeqFree(self.alp_id, sequenceid)
 
     @_api_call
     def _AlpProjControl(self, controltype, controlvalue):
@@ -183,11 +197,11 @@ class AlpDmd:
         :type controltype: c_long
         :type controlvalue: c_long
         """
-        return alp_cdll.AlpProjControl(self.alp_id, controltype, controlvalue)
+        return self._alp.AlpProjControl(self.alp_id, controltype, controlvalue)
 
     @_api_call
     def _AlpProjInquire(self, inquire_type, uservarptr):
-        return alp_cdll.AlpProjInquire(self.alp_id, inquire_type, uservarptr)
+        return self._alp.AlpProjInquire(self.alp_id, inquire_type, uservarptr)
 
     @_api_call
     def _AlpProjInquireEx(self, inquire_type, userstructptr):
@@ -198,7 +212,17 @@ class AlpDmd:
         :param inquire_type: ALP_PROJ_PROGRESS
         :param userstructptr: pointer to AlpProjProgress structure.
         """
-        return alp_cdll.AlpProjInquireEx(self.alp_id, inquire_type, userstructptr)
+        return self._alp.AlpProjInquireEx(self.alp_id, inquire_type, userstructptr)
+
+    @_api_call
+    def _AlpProjControlEx(self, controltype, userstructptr):
+        """
+        Data transfer to the projection, ie the frame look-up table (FLUT).
+
+        :param controltype: ALP_FLUT_WRITE_9BIT or ALP_FLUT_WRITE_18BIT
+        :param userstructptr: pointer to AlpFlutWrite structure.
+        """
+        return self._alp.AlpProjControlEx(self.alp_id, controltype, userstructptr)
 
     @_api_call
     def AlpProjStart(self, sequenceid):
@@ -215,7 +239,7 @@ class AlpDmd:
 
         :type sequenceid: c_long
         """
-        return alp_cdll.AlpProjStart(self.alp_id, sequenceid)
+        return self._alp.AlpProjStart(self.alp_id, sequenceid)
 
     @_api_call
     def _AlpProjStartCont(self, sequenceid):
@@ -224,14 +248,14 @@ class AlpDmd:
         :type sequenceid: c_long
         :return:
         """
-        return alp_cdll.AlpProjStartCont(self.alp_id, sequenceid)
+        return self._alp.AlpProjStartCont(self.alp_id, sequenceid)
 
     @_api_call
     def _AlpProjHalt(self):
         """
         halts projection of current sequence.
         """
-        return alp_cdll.AlpProjHalt(self.alp_id)
+        return self._alp.AlpProjHalt(self.alp_id)
 
     @_api_call
     def _AlpProjWait(self):
@@ -239,7 +263,7 @@ class AlpDmd:
         blocking call that returns only when projection is complete.
         """
         print ('Waiting for projection to complete...')
-        return alp_cdll.AlpProjWait(self.alp_id)
+        return self._alp.AlpProjWait(self.alp_id)
 
 
     def _get_device_size(self):
@@ -292,10 +316,13 @@ class AlpDmd:
         else:
             return 0
 
-    def get_projecting_progress(self) -> AlpProjProgress:
+    def get_projecting_progress(self, progress: AlpProjProgress = None) -> AlpProjProgress:
         """
         Returns AlpProjProgress structure. See ALP API.
 
+        :param progress: structure to write the progress to. By default, a structure owned by this object is reused,
+        so threads polling the progress concurrently must pass their own.
+
         AlpProjProgress(Structure):
 	     _fields_ = [
             ("CurrentQueueId", c_ulong),
@@ -311,8 +338,10 @@ class AlpDmd:
         :return: AlpProjProgress
         """
         # warning: not thread-safe, if we're reading values in one thread and reading in another!
-        self._AlpProjInquireEx(ALP_PROJ_PROGRESS, byref(self._proj_progress))
-        return self._proj_progress
+        if progress is None:
+            progress = self._proj_progress
+        self._AlpProjInquireEx(ALP_PROJ_PROGRESS, byref(progress))
+        return progress
 
     def update_temperature(self):
         """
@@ -372,18 +401,21 @@ class AlpDmd:
             print(alpmode.keys())
             raise ValueError('Cannot set projector mode, shutting down...')
 
-    def seq_alloc(self, bitnum:int, picnum:int) -> "AlpFrameSequence":
+    def seq_alloc(self, bitnum:int, picnum:int, packed=False) -> "AlpFrameSequence":
         """pre-allocate memory for sequence
         bitnum: bit-depth of sequence, e.g. '1L'
         picnum: # frames in sequence, e.g. '2L'
+        packed: use packed binary data (8 pixels per byte, ALP_DATA_BINARY_TOPDOWN) for upload. Only for bitnum 1.
         
         returns AlpFrameSequence pointing to the allocated position.
         """
+        if packed and bitnum != 1:
+            raise ValueError('Packed binary sequences must have a bit depth of 1.')
         seq_id = c_long()  # pointer to seq id
 
         returnvalue = self._AlpSeqAlloc(bitnum, picnum, byref(seq_id))
         if returnvalue == ALP_OK:
-            seq = AlpFrameSequence(seq_id, bitnum, picnum, self)
+            seq = AlpFrameSequence(seq_id, bitnum, picnum, self, packed)
             self.seq_handles.append(seq)
         return seq
 
@@ -393,6 +425,7 @@ class AlpDmd:
         returnvalue = self._AlpSeqFree(sequence.seq_id)
         if returnvalue == ALP_OK:
             self.seq_handles.remove(sequence)
+            sequence.freed = True
         if returnvalue == 1003:
             raise ValueError('Try DMD.stop() before attempting to release sequence')
 
@@ -443,13 +476,75 @@ class AlpDmd:
             print(alp_edge_type.keys())
             raise ValueError('Cannot set trigger edge , shutting down...')
 
-    def make_sequence_array(self, n_pix=1):
+    @property
+    def avail_memory(self):
+        """ sequence memory available for further allocations, in binary frames. """
+        self._AlpDevInquire(ALP_AVAIL_MEMORY, byref(self.returnpointer))
+        return self.returnpointer.value
+
+    @property
+    def queue_max_avail(self):
+        """ total number of waiting positions in the sequence queue (1 in the legacy queue mode). """
+        self._AlpProjInquire(ALP_PROJ_QUEUE_MAX_AVAIL, byref(self.returnpointer))
+        return self.returnpointer.value
+
+    @property
+    def queue_id(self):
+        """ queue id of the most recently enqueued sequence, as reported in AlpProjProgress.CurrentQueueId. """
+        self._AlpProjInquire(ALP_PROJ_QUEUE_ID, byref(self.returnpointer))
+        return self.returnpointer.value
+
+    @property
+    def flut_max_entries(self):
+        """ size of the frame look-up table (FLUT) in 9-bit entries. It holds half as many 18-bit entries. """
+        self._AlpDevInquire(ALP_FLUT_MAX_ENTRIES9, byref(self.returnpointer))
+        return self.returnpointer.value
+
+    def flut_write(self, frame_numbers, offset=0, bits=9):
+        """
+        Writes frame numbers into the frame look-up table (FLUT), which is shared by all sequences. Sequences that use
+        the FLUT (see AlpFrameSequence.set_flut) display their pictures in the order of its entries.
+
+        :param frame_numbers: sequence of picture indices. 9-bit entries address up to 512 pictures, 18-bit entries
+        up to 262144.
+        :param offset: index of the first entry to write, in entries of the given width.
+        :param bits: entry width, 9 or 18.
+        """
+        if bits not in (9, 18):
+            raise ValueError('FLUT entries are 9 or 18 bits wide.')
+        frame_numbers = np.asarray(frame_numbers)
+        if len(frame_numbers) and (frame_numbers.min() < 0 or frame_numbers.max() >= 2 ** bits):
+            raise ValueError('Frame numbers do not fit into {}-bit FLUT entries.'.format(bits))
+        control = ALP_FLUT_WRITE_9BIT if bits == 9 else ALP_FLUT_WRITE_18BIT
+        buffer = np.ctypeslib.as_array(self._flut_write.FrameNumbers)
+        for start in range(0, len(frame_numbers), FLUT_WRITE_MAX):
+            chunk = frame_numbers[start:start + FLUT_WRITE_MAX]
+            self._flut_write.nOffset = offset + start
+            self._flut_write.nSize = len(chunk)
+            buffer[:len(chunk)] = chunk
+            self._AlpProjControlEx(control, byref(self._flut_write))
+
+    def make_sequence_array(self, n_pix=1, packed=False):
         """ make an array to hold n_pix number of frames.
         :param n_pix: number of images (frames) in the sequence.
-        :return: numpy uint8 array (n, h, w)
+        :param packed: make an array for packed binary data (see packed_row_bytes).
+        :return: numpy uint8 array (n, h, w) or (n, h, packed_row_bytes)
         """
+        if packed:
+            return np.zeros((n_pix, self.h, self.packed_row_bytes), dtype='uint8')
         return np.zeros((n_pix, self.h, self.w), dtype='uint8')
 
+    @property
+    def packed_row_bytes(self):
+        """
+        Number of bytes per row in the packed binary data format (ALP_DATA_BINARY_TOPDOWN). Bit 7 of the first byte
+        is the leftmost mirror. SXGA+ rows have an extra first byte that is ignored by the device.
+        """
+        n = (self.w + 7) // 8
+        if self.w == 1400:
+            n += 1
+        return n
+
     def stop(self):
         if self.connected:
             returnvalue = self._AlpDevHalt()
@@ -470,8 +565,9 @@ class AlpDmd:
         print('complete.')
 
     def __del__(self):
-        self.stop()
-        self.shutdown()
+        if hasattr(self, '_alp'):
+            self.stop()
+            self.shutdown()
 
 
 class AlpFrameSequence:
@@ -479,12 +575,13 @@ class AlpFrameSequence:
     Interface with allocated ALP frame sequence buffer. Allows for upload to the memory slot, destruction of the
     allocation, and projection start of an uploaded frame sequence.
     """
-    def __init__(self, seq_id: c_long, bitnum, picnum, parent: AlpDmd):
+    def __init__(self, seq_id: c_long, bitnum, picnum, parent: AlpDmd, packed=False):
         """
 
         :param seq_id:
         :param bitnum: bit depth of the allocated sequence
         :param picnum:
+        :param packed: if True, the array is in the packed binary format (n, h, parent.packed_row_bytes).
         """
 
         self.seq_id = seq_id
@@ -498,7 +595,18 @@ class AlpFrameSequence:
         self.syncdelay = -1
         self.syncpulsewidth = -1
         self.triggerindelay = -1
-        self.array = self.gen_array()
+        self.packed = packed
+        if packed:
+            parent._AlpSeqControl(seq_id, ALP_DATA_FORMAT, ALP_DATA_BINARY_TOPDOWN)
+        self._array = None
+        self.freed = False  # set by AlpDmd.seq_free.
+
+    @property
+    def array(self):
+        """ host buffer for this sequence, allocated on first use. """
+        if self._array is None:
+            self._array = self.gen_array()
+        return self._array
 
 
     def set_timing(self, illuminatetime=c_long(ALP_DEFAULT),
@@ -517,25 +625,64 @@ class AlpFrameSequence:
         self.triggerindelay = triggerindelay
 
     def gen_array(self):
-        return np.zeros((self.picnum, self._parent.h, self._parent.w), dtype='uint8')
+        return self._parent.make_sequence_array(self.picnum, self.packed)
 
-    def upload_array(self, pattern=None):
+    def upload_array(self, pattern=None, copy=True):
         """
         Uploads a numpy uint8 array pattern to parent DMD into this sequence space. This handles the sequence
         shape definition based on what was allocated, and it handles conversion from numpy array to a C
         pointer of chars.
 
-        :param pattern: numpy array of uint8 values to be uploaded.
-        """
+        For packed sequences, the pattern can be either packed or one byte per pixel (it is packed before upload).
 
+        :param pattern: numpy array of uint8 values to be uploaded.
+        :param copy: if False, the pattern is uploaded directly instead of being copied to the sequence's array. It
+        must then be a C-contiguous uint8 array with the shape of the sequence's array (see make_sequence_array),
+        otherwise a ValueError is raised.
+        """
+
+        if pattern is not None and not copy:
+            shape = (self.picnum, self.h, self._parent.packed_row_bytes if self.packed else self.w)
+            if not pattern.flags.c_contiguous or pattern.dtype != np.uint8 or pattern.shape != shape:
+                raise ValueError('Patterns uploaded without copy must be C-contiguous uint8 arrays of shape {}, '
+                                 'got {} {}.'.format(shape, pattern.dtype, pattern.shape))
+            patternptr = pattern.ctypes.data_as(POINTER(c_char))
+            self._parent._AlpSeqPut(self.seq_id, c_long(0), c_long(self.picnum), patternptr)
+            return
         if pattern is not None:
             # assert pattern.dtype == np.uint8
-            # assert pattern.shape == self.array.shape
-            self.array[:, :, :] = pattern[:, :, :]
+            if self.packed and pattern.shape[2] == self.w:
+                row_bytes = self.w // 8
+                self.array[:, :, -row_bytes:] = np.packbits(pattern, axis=-1)
+            else:
+                self.array[:, :, :] = pattern[:, :, :]
 
         patternptr = self.array.ctypes.data_as(POINTER(c_char))
         self._parent._AlpSeqPut(self.seq_id,  c_long(0), c_long(self.picnum), patternptr)
 
+    def set_flut(self, n_entries, offset=0, bits=9):
+        """
+        Makes this sequence display n_entries frames, whose picture indices are read from the frame look-up table
+        (FLUT) starting at entry offset (see AlpDmd.flut_write).
+
+        :param n_entries: number of frames to display per iteration.
+        :param offset: first FLUT entry, in entries of the given width. The offset must be a multiple of 256 9-bit
+        entries (128 18-bit entries).
+        :param bits: entry width, 9 or 18. Use None to stop using the FLUT.
+        """
+        if bits is None:
+            self._parent._AlpSeqControl(self.seq_id, ALP_FLUT_MODE, ALP_FLUT_NONE)
+            return
+        if bits not in (9, 18):
+            raise ValueError('FLUT entries are 9 or 18 bits wide.')
+        units = 1 if bits == 9 else 2  # the settings are in 9-bit entries.
+        if (offset * units) % 256:
+            raise ValueError('FLUT offset must be a multiple of 256 9-bit entries.')
+        mode = ALP_FLUT_9BIT if bits == 9 else ALP_FLUT_18BIT
+        self._parent._AlpSeqControl(self.seq_id, ALP_FLUT_MODE, mode)
+        self._parent._AlpSeqControl(self.seq_id, ALP_FLUT_ENTRIES9, n_entries * units)
+        self._parent._AlpSeqControl(self.seq_id, ALP_FLUT_OFFSET9, offset * units)
+
     def start_projection(self):
         self._parent.AlpProjStart(self.seq_id)
 
@@ -548,7 +695,7 @@ class AlpFrameSequence:
         return self.seq_id.value
 
     def __del__(self):
-        if self._parent.connected:
+        if self._parent.connected and not self.freed:
             self._parent.seq_free(self)
 
     def __str__(self):
@@ -571,9 +718,8 @@ class AlpOutOfMemoryError(AlpError):
 
 try:
     alp_cdll = CDLL('alpV42.dll')
-except WindowsError as e:
-    raise AlpError("The directory containing 'alpV42.dll' is not found in the system (Windows) path. "
-                   "Please add it to use this package.")
+except OSError:
+    alp_cdll = None  # no driver installed. AlpDmd must be given a backend (ie the emulator) to be used.
 
 
 def powertest(edge_sz_px=160):
@@ -131,7 +131,7 @@ ALP_SCROLL_TO_ROW = 2124  # combined value from ALP_LASTFRAME and ALP_LASTLINE
 
 #    Frame Look Up Table (FLUT): sequence settings select how to use the FLUT.
 #    The look-up table itself is shared across all sequences.
-#    (use ALP_FLUT_SET_MEMORY controls for accessing it) 
+#    (use AlpProjControlEx with ALP_FLUT_WRITE_9BIT/18BIT for accessing it)
 
 ALP_FLUT_MODE = 2118  # Select Frame LookUp Table usage mode:
 ALP_FLUT_NONE = 0  # linear addressing, do not use FLUT (default)
@@ -232,6 +232,26 @@ ALP_PROJ_WAIT_UNTIL = 2323  # When does _AlpProjWait complete regarding the last
 ALP_PROJ_WAIT_PIC_TIME = 0  # ALP_DEFAULT: _AlpProjWait returns after picture time
 ALP_PROJ_WAIT_ILLU_TIME = 1  # _AlpProjWait returns after illuminate time (except binary uninterrupted sequences, because an "illuminate time" is not applicable there)
 
+FLUT_WRITE_MAX = 4096  # entries that can be transferred with one tFlutWrite structure.
+
+
+class AlpFlutWrite(Structure):
+	_fields_ = [
+		("nOffset", c_long),
+		("nSize", c_long),
+		("FrameNumbers", c_ulong * FLUT_WRITE_MAX)
+	]
+
+
+"""
+struct tFlutWrite {
+	long nOffset;	/* first FLUT entry to write, in entries of the written width (9 or 18 bit) */
+	long nSize;	/* number of entries to write; -1: up to the end of the table */
+	unsigned long FrameNumbers[4096];	/* frame numbers (picture index within the sequence) */
+};
+"""
+
+
 class AlpProjProgress(Structure):
 	_fields_ = [
 		("CurrentQueueId", c_ulong),
@@ -273,9 +293,8 @@ struct tAlpProjProgress {
 
 
 
-''' #== TODO : HOW TO MAKE UNSIGNED LONG IN PYTHON?
-define ALP_FLAG_QUEUE_IDLE                1UL
-define ALP_FLAG_SEQUENCE_ABORTING        2UL
-define ALP_FLAG_SEQUENCE_INDEFINITE    4UL    /* _AlpProjStartCont: this loop runs indefinitely long, until aborted */
-define ALP_FLAG_FRAME_FINISHED            8UL    /* illumination of last frame finished, picture time still progressing */
-'''
+# ===== AlpProjProgress.nFlags =====
+ALP_FLAG_QUEUE_IDLE = 1
+ALP_FLAG_SEQUENCE_ABORTING = 2
+ALP_FLAG_SEQUENCE_INDEFINITE = 4  # _AlpProjStartCont: this loop runs indefinitely long, until aborted
+ALP_FLAG_FRAME_FINISHED = 8  # illumination of last frame finished, picture time still progressing
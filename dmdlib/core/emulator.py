@@ -0,0 +1,697 @@
+"""
+Software emulation of the Vialux ALP v4.2 API, for running and benchmarking the stimulus pipeline without a device.
+
+AlpEmulator implements the alpV42.dll functions that are used by AlpDmd, so it can be used in place of the library:
+
+    dmd = AlpDmd(backend=AlpEmulator())
+
+Projection is modeled from the picture time of the sequences and the host clock: the progress reported by
+AlpProjInquireEx(ALP_PROJ_PROGRESS) and the state of the sequence queue are consistent with the time that has passed
+since each sequence was started. Uploads (AlpSeqPut) block for the time that the host-side data conversion and the
+transfer of the sequence bitplanes would take with the configured bandwidths, and sequence allocation is limited by the
+device memory. Only master mode timing is modeled (triggers are not emulated).
+"""
+from ctypes import addressof, cast, c_void_p, c_ubyte
+from collections import deque
+import threading
+import time
+import numpy as np
+from ._alp_defns import *
+
+DEFAULT_PICTURE_TIME = 33334  # us, ALP default.
+XGA_MEMORY = 43690  # binary frames available on the device.
+
+
+def _value(arg):
+    """ returns the python value of a ctypes number or python number. """
+    return getattr(arg, 'value', arg)
+
+
+def _target(ptr):
+    """ returns the ctypes object referenced by a pointer made by byref() or pointer(). """
+    try:
+        return ptr._obj
+    except AttributeError:
+        return ptr.contents
+
+
+def _address(ptr):
+    """ returns the memory address referenced by a pointer made by byref() or ndarray.ctypes.data_as(). """
+    try:
+        return addressof(ptr._obj)
+    except AttributeError:
+        return cast(ptr, c_void_p).value
+
+
+class _EmulatedSequence:
+    """
+    Sequence memory allocated on the emulated device.
+    """
+    def __init__(self, seq_id, bitplanes, picnum):
+        self.seq_id = seq_id
+        self.bitplanes = bitplanes
+        self.picnum = picnum
+        self.controls = {
+            ALP_SEQ_REPEAT: 1,
+            ALP_FIRSTFRAME: 0,
+            ALP_LASTFRAME: picnum - 1,
+            ALP_BITNUM: bitplanes,
+            ALP_BIN_MODE: ALP_BIN_NORMAL,
+            ALP_PWM_MODE: ALP_DEFAULT,
+            ALP_DATA_FORMAT: ALP_DATA_MSB_ALIGN,
+            ALP_SEQ_PUT_LOCK: ALP_DEFAULT,
+            ALP_FLUT_MODE: ALP_FLUT_NONE,
+            ALP_FLUT_ENTRIES9: 1,
+            ALP_FLUT_OFFSET9: 0,
+            ALP_FIRSTLINE: ALP_DEFAULT,
+            ALP_LASTLINE: ALP_DEFAULT,
+            ALP_LINE_INC: ALP_DEFAULT,
+            ALP_SCROLL_FROM_ROW: ALP_DEFAULT,
+            ALP_SCROLL_TO_ROW: ALP_DEFAULT,
+            ALP_SEQ_DMD_LINES: ALP_DEFAULT,
+        }
+        self.timing = {
+            ALP_ILLUMINATE_TIME: DEFAULT_PICTURE_TIME,
+            ALP_PICTURE_TIME: DEFAULT_PICTURE_TIME,
+            ALP_SYNCH_DELAY: 0,
+            ALP_SYNCH_PULSEWIDTH: DEFAULT_PICTURE_TIME,
+            ALP_TRIGGER_IN_DELAY: 0,
+        }
+        self.data = None  # only filled if the emulator keeps uploaded data.
+        self.n_uploads = 0
+
+    @property
+    def frames_per_iteration(self):
+        flut_mode = self.controls[ALP_FLUT_MODE]
+        if flut_mode == ALP_FLUT_9BIT:
+            return self.controls[ALP_FLUT_ENTRIES9]
+        elif flut_mode == ALP_FLUT_18BIT:
+            return self.controls[ALP_FLUT_ENTRIES9] // 2
+        return self.controls[ALP_LASTFRAME] - self.controls[ALP_FIRSTFRAME] + 1
+
+
+class _QueueEntry:
+    """
+    A started sequence, either waiting in the queue or running.
+    """
+    def __init__(self, queue_id, sequence: _EmulatedSequence, indefinite=False):
+        self.queue_id = queue_id
+        self.sequence = sequence
+        self.indefinite = indefinite
+        self.repeats = sequence.controls[ALP_SEQ_REPEAT]
+        self.n_frames = sequence.frames_per_iteration
+        self.picture_time = sequence.timing[ALP_PICTURE_TIME]  # us
+        self.illuminate_time = sequence.timing[ALP_ILLUMINATE_TIME]
+        self.t_start = None
+        self.t_end = None  # None while running indefinitely.
+        self.aborting = False
+        self.flut_frames = None  # frame numbers read from the FLUT when the sequence begins.
+
+    def begin(self, t):
+        self.t_start = t
+        if not self.indefinite:
+            self.t_end = t + self.repeats * self.n_frames * self.picture_time * 1e-6
+
+    def frames_shown(self, t):
+        """ number of frames that have started display by time t. """
+        if self.t_start is None or t < self.t_start:
+            return 0
+        if self.t_end is not None:
+            t = min(t, self.t_end)
+        return int(np.ceil((t - self.t_start) / (self.picture_time * 1e-6) - 1e-6))  # tolerates rounding errors.
+
+    def end_of_iteration(self, t):
+        """ time at which the iteration running at time t ends. """
+        iteration_len = self.n_frames * self.picture_time * 1e-6
+        iterations = np.floor((t - self.t_start) / iteration_len) + 1
+        return self.t_start + iterations * iteration_len
+
+
+class AlpEmulator:
+    """
+    Emulated ALP device. Pass this as the backend of an AlpDmd object.
+
+    Statistics about the emulated projection are available as attributes:
+        display_log: list of (queue id, sequence id, start time, end time, frames displayed) for finished sequences.
+        flut_log: list of (queue id, sequence id, array of the displayed frame numbers) for finished sequences that
+        use the frame look-up table.
+        idle_gaps: list of (start time, end time) of periods in which the queue ran empty between two sequences.
+        bytes_uploaded, upload_time_s: totals for AlpSeqPut.
+    """
+
+    def __init__(self, width=1024, height=768, memory=XGA_MEMORY, usb_bandwidth=40e6, conversion_bandwidth=1e9,
+                 min_picture_time=44, queue_size=32, keep_data=False, clock=time.perf_counter, sleep=time.sleep):
+        """
+        :param width: number of mirror columns.
+        :param height: number of mirror rows.
+        :param memory: device sequence memory in binary frames.
+        :param usb_bandwidth: transfer bandwidth of bitplane data to the device in bytes per second. If None,
+        transfers are instantaneous.
+        :param conversion_bandwidth: rate in bytes per second at which the driver converts user data (one byte per
+        pixel) into bitplanes before the transfer. Packed binary data is not converted. If None, conversion is
+        instantaneous.
+        :param min_picture_time: minimum picture time in microseconds.
+        :param queue_size: number of waiting positions in the sequence queue (ALP_PROJ_SEQUENCE_QUEUE mode).
+        :param keep_data: keep a copy of uploaded data in each sequence (for testing).
+        :param clock: function returning the time in seconds.
+        :param sleep: function blocking for a time in seconds.
+        """
+        self.width = width
+        self.height = height
+        self.memory = memory
+        self.usb_bandwidth = usb_bandwidth
+        self.conversion_bandwidth = conversion_bandwidth
+        self.min_picture_time = min_picture_time
+        self.queue_size = queue_size
+        self.keep_data = keep_data
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.RLock()
+
+        self._alp_id = None
+        self._next_alp_id = 1
+        self._next_seq_id = 1
+        self._next_queue_id = 1
+        self._sequences = {}
+        self._avail_memory = memory
+        self._dev_controls = {
+            ALP_SYNCH_POLARITY: ALP_LEVEL_HIGH,
+            ALP_TRIGGER_EDGE: ALP_EDGE_RISING,
+            ALP_TRIGGER_TIME_OUT: ALP_TIME_OUT_ENABLE,
+            ALP_DEV_DMD_MODE: ALP_DEFAULT,
+            ALP_PWM_LEVEL: 0,
+        }
+        self._proj_controls = {
+            ALP_PROJ_MODE: ALP_MASTER,
+            ALP_PROJ_STEP: ALP_DEFAULT,
+            ALP_PROJ_SYNC: ALP_ASYNCHRONOUS,
+            ALP_PROJ_INVERSION: ALP_DEFAULT,
+            ALP_PROJ_UPSIDE_DOWN: ALP_DEFAULT,
+            ALP_PROJ_QUEUE_MODE: ALP_PROJ_LEGACY,
+            ALP_PROJ_WAIT_UNTIL: ALP_PROJ_WAIT_PIC_TIME,
+        }
+
+        self._queue = deque()
+        self._running = None  # type: _QueueEntry
+        self._last_entry = None  # type: _QueueEntry
+        self._idle_since = None
+
+        self.flut_max_entries = 4096  # 9-bit entries.
+        # the 9- and 18-bit views of the FLUT memory are kept as separate tables.
+        self._flut9 = np.zeros(self.flut_max_entries, dtype=np.uint32)
+        self._flut18 = np.zeros(self.flut_max_entries // 2, dtype=np.uint32)
+
+        self.display_log = []
+        self.flut_log = []
+        self.idle_gaps = []
+        self.frames_completed = 0
+        self.bytes_uploaded = 0
+        self.upload_time_s = 0.
+
+    # ----- emulation helpers -----
+
+    def _advance(self, now):
+        """ advances the projection state to time 'now'. """
+        while self._running is not None:
+            entry = self._running
+            if entry.t_end is None or now < entry.t_end:
+                break
+            self._finish(entry)
+            if self._queue:
+                self._begin(self._queue.popleft(), entry.t_end)
+            else:
+                self._running = None
+                self._idle_since = entry.t_end
+
+    def _begin(self, entry: _QueueEntry, t):
+        if self._idle_since is not None and self._last_entry is not None:
+            self.idle_gaps.append((self._idle_since, t))
+        self._idle_since = None
+        entry.begin(t)
+        seq = entry.sequence
+        flut_mode = seq.controls[ALP_FLUT_MODE]
+        if flut_mode != ALP_FLUT_NONE:
+            offset, n = seq.controls[ALP_FLUT_OFFSET9], seq.controls[ALP_FLUT_ENTRIES9]
+            if flut_mode == ALP_FLUT_9BIT:
+                entry.flut_frames = self._flut9[offset:offset + n].copy()
+            else:
+                entry.flut_frames = self._flut18[offset // 2:(offset + n) // 2].copy()
+        self._running = entry
+
+    def _finish(self, entry: _QueueEntry):
+        n = entry.frames_shown(entry.t_end)
+        self.frames_completed += n
+        self.display_log.append((entry.queue_id, entry.sequence.seq_id, entry.t_start, entry.t_end, n))
+        if entry.flut_frames is not None:
+            self.flut_log.append((entry.queue_id, entry.sequence.seq_id, np.resize(entry.flut_frames, n)))
+        self._last_entry = entry
+
+    def _stop(self):
+        now = self._clock()
+        self._advance(now)
+        if self._running is not None:
+            self._running.t_end = now
+            self._finish(self._running)
+            self._idle_since = None
+        self._running = None
+        self._queue.clear()
+
+    def _in_use(self, seq: _EmulatedSequence):
+        if self._running is not None and self._running.sequence is seq:
+            return True
+        return any(e.sequence is seq for e in self._queue)
+
+    def _bytes_per_picture(self, seq: _EmulatedSequence):
+        if self._is_packed(seq):
+            row_bytes = (self.width + 7) // 8
+            if self.width == 1400:  # SXGA+ rows have an extra first byte.
+                row_bytes += 1
+            return self.height * row_bytes
+        return self.height * self.width
+
+    @staticmethod
+    def _is_packed(seq: _EmulatedSequence):
+        return seq.controls[ALP_DATA_FORMAT] in (ALP_DATA_BINARY_TOPDOWN, ALP_DATA_BINARY_BOTTOMUP)
+
+    def _check_alp_id(self, alp_id):
+        return self._alp_id is not None and _value(alp_id) == self._alp_id
+
+    def frames_displayed(self):
+        """ total number of frames that have started display. """
+        with self._lock:
+            now = self._clock()
+            self._advance(now)
+            n = self.frames_completed
+            if self._running is not None:
+                n += self._running.frames_shown(now)
+            return n
+
+    def summary(self) -> dict:
+        """ returns a dictionary of projection statistics. """
+        with self._lock:
+            n = self.frames_displayed()
+            gaps = [e - s for s, e in self.idle_gaps]
+            return {
+                'frames_displayed': n,
+                'sequences_displayed': len(self.display_log),
+                'underruns': len(gaps),
+                'underrun_time_s': float(sum(gaps)),
+                'bytes_uploaded': self.bytes_uploaded,
+                'upload_time_s': self.upload_time_s,
+            }
+
+    # ----- device API -----
+
+    def AlpDevAlloc(self, devicenum, initflag, alp_id_ptr):
+        with self._lock:
+            if self._alp_id is not None:
+                return ALP_NOT_READY
+            self._alp_id = self._next_alp_id
+            self._next_alp_id += 1
+            _target(alp_id_ptr).value = self._alp_id
+            return ALP_OK
+
+    def AlpDevInquire(self, alp_id, inquire_type, uservarptr):
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            self._advance(self._clock())
+            inquire_type = _value(inquire_type)
+            if inquire_type in self._dev_controls:
+                val = self._dev_controls[inquire_type]
+            elif inquire_type == ALP_DEVICE_NUMBER:
+                val = 0
+            elif inquire_type == ALP_VERSION:
+                val = 0
+            elif inquire_type == ALP_DEV_STATE:
+                val = ALP_DEV_BUSY if self._running is not None else ALP_DEV_READY
+            elif inquire_type == ALP_AVAIL_MEMORY:
+                val = self._avail_memory
+            elif inquire_type == ALP_FLUT_MAX_ENTRIES9:
+                val = self.flut_max_entries
+            elif inquire_type in (ALP_DDC_FPGA_TEMPERATURE, ALP_APPS_FPGA_TEMPERATURE, ALP_PCB_TEMPERATURE):
+                val = 30 * 256
+            elif inquire_type == ALP_DEV_DISPLAY_WIDTH:
+                val = self.width
+            elif inquire_type == ALP_DEV_DISPLAY_HEIGHT:
+                val = self.height
+            elif inquire_type == ALP_DEV_DMDTYPE:
+                val = ALP_DMDTYPE_XGA_07A if (self.width, self.height) == (1024, 768) else ALP_DMDTYPE_DISCONNECT
+            else:
+                return ALP_PARM_INVALID
+            _target(uservarptr).value = val
+            return ALP_OK
+
+    def AlpDevControl(self, alp_id, control_type, control_value):
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            control_type = _value(control_type)
+            if control_type == ALP_USB_CONNECTION:
+                return ALP_OK
+            if control_type not in self._dev_controls:
+                return ALP_PARM_INVALID
+            self._dev_controls[control_type] = _value(control_value)
+            return ALP_OK
+
+    def AlpDevHalt(self, alp_id):
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            self._stop()
+            return ALP_OK
+
+    def AlpDevFree(self, alp_id):
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            self._stop()
+            self._sequences.clear()
+            self._avail_memory = self.memory
+            self._alp_id = None
+            return ALP_OK
+
+    # ----- sequence API -----
+
+    def AlpSeqAlloc(self, alp_id, bitplanes, picnum, sequence_id_ptr):
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            bitplanes, picnum = _value(bitplanes), _value(picnum)
+            if not 1 <= bitplanes <= 8 or picnum < 1:
+                return ALP_PARM_INVALID
+            if bitplanes * picnum > self._avail_memory:
+                return ALP_MEMORY_FULL
+            seq = _EmulatedSequence(self._next_seq_id, bitplanes, picnum)
+            self._next_seq_id += 1
+            self._sequences[seq.seq_id] = seq
+            self._avail_memory -= bitplanes * picnum
+            _target(sequence_id_ptr).value = seq.seq_id
+            return ALP_OK
+
+    def AlpSeqControl(self, alp_id, sequence_id, control_type, control_value):
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            seq = self._sequences.get(_value(sequence_id))
+            control_type, control_value = _value(control_type), _value(control_value)
+            if seq is None or control_type not in seq.controls:
+                return ALP_PARM_INVALID
+            if control_type in (ALP_FIRSTFRAME, ALP_LASTFRAME) and not 0 <= control_value < seq.picnum:
+                return ALP_PARM_INVALID
+            if control_type == ALP_BITNUM and not 1 <= control_value <= seq.bitplanes:
+                return ALP_PARM_INVALID
+            if control_type == ALP_FLUT_ENTRIES9 and not 1 <= control_value <= self.flut_max_entries:
+                return ALP_PARM_INVALID
+            if control_type == ALP_FLUT_OFFSET9 and (control_value % 256 or
+                                                     not 0 <= control_value < self.flut_max_entries):
+                return ALP_PARM_INVALID
+            if control_type == ALP_DATA_FORMAT and seq.bitplanes != 1 and \
+                    control_value in (ALP_DATA_BINARY_TOPDOWN, ALP_DATA_BINARY_BOTTOMUP):
+                return ALP_PARM_INVALID
+            seq.controls[control_type] = control_value
+            return ALP_OK
+
+    def AlpSeqTiming(self, alp_id, sequence_id, illuminatetime, picturetime, syncdelay, syncpulsewidth,
+                     triggerindelay):
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            seq = self._sequences.get(_value(sequence_id))
+            if seq is None:
+                return ALP_PARM_INVALID
+            illuminate, picture = _value(illuminatetime), _value(picturetime)
+            delay, pulse, trigger_delay = _value(syncdelay), _value(syncpulsewidth), _value(triggerindelay)
+            if picture == ALP_DEFAULT:
+                picture = illuminate if illuminate != ALP_DEFAULT else DEFAULT_PICTURE_TIME
+            if illuminate == ALP_DEFAULT:
+                illuminate = picture  # highest possible contrast.
+            if pulse == ALP_DEFAULT:
+                pulse = illuminate
+            if picture < self.min_picture_time or illuminate > picture or pulse > picture:
+                return ALP_PARM_INVALID
+            seq.timing[ALP_ILLUMINATE_TIME] = illuminate
+            seq.timing[ALP_PICTURE_TIME] = picture
+            seq.timing[ALP_SYNCH_DELAY] = delay
+            seq.timing[ALP_SYNCH_PULSEWIDTH] = pulse
+            seq.timing[ALP_TRIGGER_IN_DELAY] = trigger_delay
+            return ALP_OK
+
+    def AlpSeqInquire(self, alp_id, sequence_id, inquire_type, uservarptr):
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            seq = self._sequences.get(_value(sequence_id))
+            inquire_type = _value(inquire_type)
+            if seq is None:
+                return ALP_PARM_INVALID
+            if inquire_type == ALP_BITPLANES:
+                val = seq.bitplanes
+            elif inquire_type == ALP_PICNUM:
+                val = seq.picnum
+            elif inquire_type in seq.timing:
+                val = seq.timing[inquire_type]
+            elif inquire_type in seq.controls:
+                val = seq.controls[inquire_type]
+            elif inquire_type in (ALP_MIN_PICTURE_TIME, ALP_MIN_ILLUMINATE_TIME):
+                val = self.min_picture_time
+            elif inquire_type == ALP_MAX_PICTURE_TIME:
+                val = 2 ** 31 - 1
+            elif inquire_type == ALP_ON_TIME:
+                val = seq.timing[ALP_ILLUMINATE_TIME]
+            elif inquire_type == ALP_OFF_TIME:
+                val = seq.timing[ALP_PICTURE_TIME] - seq.timing[ALP_ILLUMINATE_TIME]
+            else:
+                return ALP_PARM_INVALID
+            _target(uservarptr).value = val
+            return ALP_OK
+
+    def AlpSeqPut(self, alp_id, sequence_id, picoffset, n_pix, userarrayptr):
+        """
+        Copies data from the user array (if keep_data is set) and blocks for the emulated transfer time.
+        """
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            self._advance(self._clock())
+            seq = self._sequences.get(_value(sequence_id))
+            picoffset, n_pix = _value(picoffset), _value(n_pix)
+            if seq is None or picoffset < 0 or n_pix < 1 or picoffset + n_pix > seq.picnum:
+                return ALP_PARM_INVALID
+            if seq.controls[ALP_SEQ_PUT_LOCK] == ALP_DEFAULT and self._in_use(seq):
+                return ALP_SEQ_IN_USE
+            bytes_per_pic = self._bytes_per_picture(seq)
+            nbytes = n_pix * bytes_per_pic
+            if self.keep_data:
+                if seq.data is None:
+                    seq.data = np.zeros((seq.picnum, bytes_per_pic), dtype=np.uint8)
+                buffer = (c_ubyte * nbytes).from_address(_address(userarrayptr))
+                seq.data[picoffset:picoffset + n_pix] = np.ctypeslib.as_array(buffer).reshape(n_pix, bytes_per_pic)
+            seq.n_uploads += 1
+        # block outside of the lock, so that other threads can inquire progress during the upload.
+        transfer_time = 0.
+        if self.usb_bandwidth:
+            transfer_time += n_pix * seq.bitplanes * self.height * self.width / 8 / self.usb_bandwidth
+        if self.conversion_bandwidth and not self._is_packed(seq):
+            transfer_time += nbytes / self.conversion_bandwidth
+        t = self._clock()
+        self._sleep(transfer_time)
+        with self._lock:
+            self.bytes_uploaded += nbytes
+            self.upload_time_s += self._clock() - t
+        return ALP_OK
+
+    def AlpSeqFree(self, alp_id, sequence_id):
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            self._advance(self._clock())
+            seq = self._sequences.get(_value(sequence_id))
+            if seq is None:
+                return ALP_PARM_INVALID
+            if self._in_use(seq):
+                return ALP_SEQ_IN_USE
+            del self._sequences[seq.seq_id]
+            self._avail_memory += seq.bitplanes * seq.picnum
+            return ALP_OK
+
+    # ----- projection API -----
+
+    def AlpProjControl(self, alp_id, control_type, control_value):
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            now = self._clock()
+            self._advance(now)
+            control_type, control_value = _value(control_type), _value(control_value)
+            if control_type == ALP_PROJ_RESET_QUEUE:
+                self._queue.clear()
+            elif control_type in (ALP_PROJ_ABORT_SEQUENCE, ALP_PROJ_ABORT_FRAME):
+                entry = self._running
+                if entry is None or (control_value != ALP_DEFAULT and control_value != entry.queue_id):
+                    return ALP_PARM_INVALID
+                entry.aborting = True
+                if control_type == ALP_PROJ_ABORT_SEQUENCE:
+                    entry.t_end = entry.end_of_iteration(now)
+                else:
+                    frame_len = entry.picture_time * 1e-6
+                    entry.t_end = entry.t_start + (np.floor((now - entry.t_start) / frame_len) + 1) * frame_len
+            elif control_type in self._proj_controls:
+                if control_type == ALP_PROJ_QUEUE_MODE and self._running is not None:
+                    return ALP_NOT_IDLE
+                self._proj_controls[control_type] = control_value
+            else:
+                return ALP_PARM_INVALID
+            return ALP_OK
+
+    def AlpProjControlEx(self, alp_id, control_type, userstructptr):
+        """ writes the frame look-up table, the transfer time is not emulated. """
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            control_type = _value(control_type)
+            if control_type == ALP_FLUT_WRITE_9BIT:
+                table, bits = self._flut9, 9
+            elif control_type == ALP_FLUT_WRITE_18BIT:
+                table, bits = self._flut18, 18
+            else:
+                return ALP_PARM_INVALID
+            flut_write = _target(userstructptr)  # type: AlpFlutWrite
+            offset, size = flut_write.nOffset, flut_write.nSize
+            if size == -1:
+                size = min(len(table) - offset, FLUT_WRITE_MAX)
+            if offset < 0 or size < 1 or size > FLUT_WRITE_MAX or offset + size > len(table):
+                return ALP_PARM_INVALID
+            frames = np.ctypeslib.as_array(flut_write.FrameNumbers)[:size]
+            if frames.max() >= 2 ** bits:
+                return ALP_PARM_INVALID
+            table[offset:offset + size] = frames
+            self.bytes_uploaded += size * (2 if bits == 9 else 4)
+            return ALP_OK
+
+    def AlpProjInquire(self, alp_id, inquire_type, uservarptr):
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            self._advance(self._clock())
+            inquire_type = _value(inquire_type)
+            if inquire_type in self._proj_controls:
+                val = self._proj_controls[inquire_type]
+            elif inquire_type == ALP_PROJ_STATE:
+                val = ALP_PROJ_ACTIVE if self._running is not None else ALP_PROJ_IDLE
+            elif inquire_type == ALP_PROJ_QUEUE_ID:
+                val = self._next_queue_id - 1
+            elif inquire_type == ALP_PROJ_QUEUE_MAX_AVAIL:
+                val = self._max_waiting()
+            elif inquire_type == ALP_PROJ_QUEUE_AVAIL:
+                val = self._max_waiting() - len(self._queue)
+            else:
+                return ALP_PARM_INVALID
+            _target(uservarptr).value = val
+            return ALP_OK
+
+    def AlpProjInquireEx(self, alp_id, inquire_type, userstructptr):
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            if _value(inquire_type) != ALP_PROJ_PROGRESS:
+                return ALP_PARM_INVALID
+            now = self._clock()
+            self._advance(now)
+            progress = _target(userstructptr)  # type: AlpProjProgress
+            entry = self._running
+            progress.nWaitingSequences = len(self._queue)
+            progress.nSequenceCounterUnderflow = 0
+            if entry is None:
+                last = self._last_entry
+                progress.CurrentQueueId = last.queue_id if last else 0
+                progress.SequenceId = last.sequence.seq_id if last else 0
+                progress.nSequenceCounter = 0
+                progress.nFrameCounter = 0
+                progress.nPictureTime = last.picture_time if last else 0
+                progress.nFramesPerSubSequence = last.n_frames if last else 0
+                progress.nFlags = ALP_FLAG_QUEUE_IDLE
+                return ALP_OK
+            frame_len = entry.picture_time * 1e-6
+            frames_done = int((now - entry.t_start) // frame_len)  # frames finished in this sequence.
+            iteration, frame = divmod(frames_done, entry.n_frames)
+            flags = 0
+            if entry.indefinite:
+                flags |= ALP_FLAG_SEQUENCE_INDEFINITE
+                progress.nSequenceCounter = 0
+                progress.nSequenceCounterUnderflow = iteration
+            else:
+                progress.nSequenceCounter = entry.repeats - iteration
+            if entry.t_end is not None and entry.t_end - now < frame_len:
+                if now - (entry.t_end - frame_len) >= entry.illuminate_time * 1e-6:
+                    flags |= ALP_FLAG_FRAME_FINISHED
+            if entry.aborting:
+                flags |= ALP_FLAG_SEQUENCE_ABORTING
+            progress.CurrentQueueId = entry.queue_id
+            progress.SequenceId = entry.sequence.seq_id
+            progress.nFrameCounter = entry.n_frames - frame
+            progress.nPictureTime = entry.picture_time
+            progress.nFramesPerSubSequence = entry.n_frames
+            progress.nFlags = flags
+            return ALP_OK
+
+    def _max_waiting(self):
+        if self._proj_controls[ALP_PROJ_QUEUE_MODE] == ALP_PROJ_SEQUENCE_QUEUE:
+            return self.queue_size
+        return 1
+
+    def _start(self, alp_id, sequence_id, indefinite):
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            now = self._clock()
+            self._advance(now)
+            seq = self._sequences.get(_value(sequence_id))
+            if seq is None:
+                return ALP_PARM_INVALID
+            entry = _QueueEntry(self._next_queue_id, seq, indefinite)
+            legacy = self._proj_controls[ALP_PROJ_QUEUE_MODE] == ALP_PROJ_LEGACY
+            if self._running is None:
+                self._begin(entry, now)
+            elif legacy:
+                # only one waiting position, further requests replace the waiting request.
+                self._queue.clear()
+                self._queue.append(entry)
+                if self._running.indefinite:  # switch after the current repetition.
+                    self._running.aborting = True
+                    self._running.t_end = self._running.end_of_iteration(now)
+            elif len(self._queue) >= self.queue_size:
+                return ALP_NOT_IDLE
+            else:
+                self._queue.append(entry)
+            self._next_queue_id += 1
+            return ALP_OK
+
+    def AlpProjStart(self, alp_id, sequence_id):
+        return self._start(alp_id, sequence_id, False)
+
+    def AlpProjStartCont(self, alp_id, sequence_id):
+        return self._start(alp_id, sequence_id, True)
+
+    def AlpProjHalt(self, alp_id):
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            self._stop()
+            return ALP_OK
+
+    def AlpProjWait(self, alp_id):
+        """ blocks until the queue is empty and the running sequence is finished. """
+        with self._lock:
+            if not self._check_alp_id(alp_id):
+                return ALP_NOT_AVAILABLE
+            now = self._clock()
+            self._advance(now)
+            if self._running is None:
+                return ALP_OK
+            entries = [self._running] + list(self._queue)
+            if any(e.indefinite for e in entries):
+                return ALP_NOT_IDLE  # would never return.
+            t_end = self._running.t_end + sum(e.repeats * e.n_frames * e.picture_time * 1e-6 for e in entries[1:])
+        self._sleep(max(t_end - self._clock(), 0.))
+        return ALP_OK
@@ -0,0 +1,141 @@
+"""
+Tests for the emulated ALP device.
+"""
+
+import unittest
+import numpy as np
+from dmdlib.core.ALP import AlpDmd, AlpError, AlpOutOfMemoryError
+from dmdlib.core.emulator import AlpEmulator
+from dmdlib.core._alp_defns import *
+
+
+class FakeClock:
+    """ clock that only moves when told to. """
+    def __init__(self):
+        self.t = 0.
+
+    def __call__(self):
+        return self.t
+
+    def sleep(self, dt):
+        self.t += dt
+
+
+class TestEmulatedProjection(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.emulator = AlpEmulator(usb_bandwidth=None, conversion_bandwidth=None, keep_data=True,
+                                    clock=self.clock, sleep=self.clock.sleep)
+        self.dmd = AlpDmd(backend=self.emulator)
+        self.dmd.proj_mode('master')
+        self.dmd.seq_queue_mode()
+        self.seqs = [self.dmd.seq_alloc(1, 10) for _ in range(2)]
+        for s in self.seqs:
+            s.set_timing(picturetime=1000)
+
+    def tearDown(self):
+        self.dmd.stop()
+        self.seqs = []
+        self.dmd.shutdown()
+
+    def test_size(self):
+        self.assertEqual((self.dmd.w, self.dmd.h), (1024, 768))
+
+    def test_queue_progress(self):
+        for s in self.seqs:
+            s.upload_array()
+            s.start_projection()
+        self.clock.t = .0055
+        p = self.dmd.get_projecting_progress()
+        self.assertEqual(p.SequenceId, int(self.seqs[0]))
+        self.assertEqual(p.nWaitingSequences, 1)
+        self.assertEqual(p.nFrameCounter, 5)
+        self.assertEqual(p.nPictureTime, 1000)
+        self.clock.t = .0125
+        p = self.dmd.get_projecting_progress()
+        self.assertEqual(p.SequenceId, int(self.seqs[1]))
+        self.assertEqual(p.nWaitingSequences, 0)
+        self.assertEqual(p.nFrameCounter, 8)
+        self.assertEqual(self.dmd.projecting, ALP_PROJ_ACTIVE)
+        self.clock.t = .021
+        p = self.dmd.get_projecting_progress()
+        self.assertTrue(p.nFlags & ALP_FLAG_QUEUE_IDLE)
+        self.assertEqual(self.dmd.projecting, ALP_PROJ_IDLE)
+        self.assertEqual(self.emulator.frames_displayed(), 20)
+        self.assertEqual(self.emulator.idle_gaps, [])
+
+    def test_underrun(self):
+        self.seqs[0].start_projection()
+        self.clock.t = .015
+        self.seqs[1].start_projection()
+        self.assertEqual(len(self.emulator.idle_gaps), 1)
+        start, end = self.emulator.idle_gaps[0]
+        self.assertAlmostEqual(start, .01)
+        self.assertAlmostEqual(end, .015)
+
+    def test_legacy_replaces_waiting(self):
+        self.dmd._AlpProjControl(ALP_PROJ_QUEUE_MODE, ALP_PROJ_LEGACY)
+        third = self.dmd.seq_alloc(1, 10)
+        third.set_timing(picturetime=1000)
+        for s in self.seqs + [third]:
+            s.start_projection()
+        self.clock.t = .1
+        self.dmd.get_projecting_progress()
+        shown = [log[1] for log in self.emulator.display_log]
+        self.assertEqual(shown, [int(self.seqs[0]), int(third)])
+
+    def test_upload_in_use(self):
+        self.seqs[0].start_projection()
+        with self.assertRaises(AlpError):
+            self.seqs[0].upload_array()
+        self.clock.t = .011
+        self.seqs[0].upload_array()
+
+    def test_upload_data(self):
+        pattern = np.random.randint(0, 2, (10, 768, 1024), dtype=np.uint8) * 255
+        self.seqs[0].upload_array(pattern)
+        stored = self.emulator._sequences[int(self.seqs[0])].data
+        self.assertTrue(np.all(stored.reshape(pattern.shape) == pattern))
+
+    def test_upload_packed(self):
+        seq = self.dmd.seq_alloc(1, 10, packed=True)
+        self.assertEqual(seq.array.shape, (10, 768, 128))
+        pattern = np.random.randint(0, 2, (10, 768, 1024), dtype=np.uint8) * 255
+        seq.upload_array(pattern)
+        stored = self.emulator._sequences[int(seq)].data
+        self.assertEqual(stored.shape, (10, 768 * 128))
+        self.assertTrue(np.all(np.unpackbits(stored, axis=-1).reshape(pattern.shape) == pattern.astype(bool)))
+        # without copy, the array must have the shape of the sequence's own array.
+        seq.upload_array(seq.gen_array(), copy=False)
+        with self.assertRaises(ValueError):
+            seq.upload_array(pattern, copy=False)
+        with self.assertRaises(ValueError):
+            self.seqs[0].upload_array(seq.gen_array(), copy=False)
+        with self.assertRaises(ValueError):
+            seq.upload_array(seq.gen_array()[:5], copy=False)
+
+    def test_memory(self):
+        with self.assertRaises(AlpOutOfMemoryError):
+            self.dmd.seq_alloc(1, self.emulator.memory)
+
+    def test_flut(self):
+        self.assertEqual(self.dmd.flut_max_entries, 4096)
+        a, b = self.seqs
+        a.set_flut(4, 256)
+        b.set_flut(3, 128, bits=18)
+        self.dmd.flut_write([9, 0, 0, 2], 256)
+        self.dmd.flut_write([5, 7, 1], 128, bits=18)
+        for s in self.seqs:
+            s.upload_array()
+            s.start_projection()
+        self.clock.t = .01
+        self.assertEqual(self.dmd.projecting, ALP_PROJ_IDLE)
+        self.assertEqual([log[4] for log in self.emulator.display_log], [4, 3])
+        self.assertEqual([list(log[2]) for log in self.emulator.flut_log], [[9, 0, 0, 2], [5, 7, 1]])
+        with self.assertRaises(ValueError):
+            b.set_flut(3, 100)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4)
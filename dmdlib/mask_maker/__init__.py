@@ -0,0 +1 @@
+from .polygon import polygon_mask, transform_vertices, dmd_mask
@@ -3,7 +3,7 @@ from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 import numpy as np
 import os
-from PIL import Image
+from dmdlib.mask_maker import stacks
 
 """
 It is possible to add image loaders that return a bitmap images. Add the functions to the image_loaders
@@ -11,68 +11,44 @@ dictionary with their extension as a key.
 """
 
 
-def load_tsm(path, startframe=0, endframe=0):
+def load_tsm(path, startframe=0, endframe=0, projection='mean'):
     """
     Loads tsm images from RedShirt Imaging and returns the composite mean image within the file.
 
     You can also specify start and end frames to use to build the composite (eg you have a recording
     in which there are pre and post stimulus onset conditions.
 
+    The file is memory-mapped and the composite is accumulated over chunks of frames (see stacks.tsm_projections), so
+    recordings larger than the memory can be loaded.
+
     Adapted from JK.
 
     :param path: filepath
     :param startframe: first frame to include in the average
     :param endframe: last frame to include in output.
-    :return:
+    :param projection: composite of the frames: 'mean', 'max' or 'std'.
+    :return: QImage
     """
+    return array_to_qimage(stacks.tsm_projections(path, startframe, endframe, (projection,))[projection])
 
-    HOFFSET = 2880  # this is hardcoded
-
-    with open(path, 'rb') as f:
-        header = f.read(HOFFSET)
-        pixels = np.frombuffer(f.read(), 'uint16')
-        header = [header[i:i + 80] for i in range(0, len(header), 80)]
-        # remove all whitespaces
-    for i, h in enumerate(header):
-        header[i] = h.replace(b' ', b'')
-    for h in header:
-        if h == b'END':
-            break
-        else:
-            param, value = h.split(b'=')
-        if param == b'NAXIS1':
-            width = int(value)
-        elif param == b'NAXIS2':
-            height = int(value)
-        elif param == b'NAXIS3':
-            n_frames = int(value)
-        else:
-            pass
-
-    n_pixels = width * height
-    trialframes = []
 
-    if not endframe:
-        endframe = n_frames
+def load_tiff(path, startframe=0, endframe=0, projection='mean'):
+    """
+    Loads a TIFF image, or the composite of the pages of a TIFF stack, which are read one at a time.
 
-    for i_frame in range(startframe, endframe):
-        st = i_frame * n_pixels
-        nd = st + n_pixels
-        frame = pixels[st:nd]
-        frame.shape = width, height
-        trialframes.append(frame)
-    m = np.mean(trialframes, axis=0)
-    scale = 255. / m.max()
-    m_8 = m * scale
-    img = QImage(m_8.astype('uint8').data, width, height, QImage.Format_Grayscale8)
-    return img
+    Takes the same parameters as load_tsm.
+    """
+    return array_to_qimage(stacks.tiff_projections(path, startframe, endframe, (projection,))[projection])
 
 
-def load_tiff(path):
-    im = Image.open(path)  # type: Image.Image
-    im_L = im.convert('L')
-    arr = np.array(im_L)
-    return QImage(arr.astype('uint8').data, im.width, im.height, QImage.Format_Grayscale8)
+def array_to_qimage(image) -> QImage:
+    """ scales an image to the 8-bit range and returns it as a grayscale QImage. """
+    m = np.asarray(image, dtype=np.float64)
+    peak = m.max()
+    scale = 255. / peak if peak > 0 else 0.
+    m_8 = np.ascontiguousarray(m * scale, dtype='uint8')
+    height, width = m_8.shape
+    return QImage(m_8.data, width, height, width, QImage.Format_Grayscale8).copy()  # the copy owns its data.
 
 
 image_loaders = {
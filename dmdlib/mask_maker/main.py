@@ -3,8 +3,8 @@ from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 import sys
 from dmdlib.mask_maker.image_load import *
+from dmdlib.mask_maker.polygon import dmd_mask
 import pickle
-import cv2
 import json
 try:
     from dmdlib import ALP
@@ -15,6 +15,8 @@ from ctypes import c_long, byref, POINTER, c_char
 
 TRANSFORM_CONFIG_PATH_KEY = 'cam_to_dmd'
 IMAGE_CONFIG_PATH_KEY = 'img_path'
+DMD_SHAPE = (768, 1024)  # (height, width) of the mask when no DMD is connected.
+PREVIEW_WIDTH = 256
 
 
 class MyMainWindow(QMainWindow):
@@ -68,6 +70,7 @@ class MainWidget(QWidget):
             err = QErrorMessage(self)
             err.showMessage("DMD not connected. {}".format(e))
         self.dmd_mask = None
+        self._mask_window = None
         # update the displayed image when we successfully load an image.
         self.imageLoaded.connect(self.imwidget.set_image)
         self.cam_to_dmd_transform = None
@@ -81,6 +84,7 @@ class MainWidget(QWidget):
         self.controlwidget.mask_disp_stop_button.clicked.connect(self.disp_stop)
         self.controlwidget.mask_clear_button.clicked.connect(self.imwidget.clear_mask_poly)
         self.imwidget.mask_generated.connect(self.register_mask)
+        self.imwidget.polygon_changed.connect(self.preview_mask)
         self.transformLoaded.connect(self.controlwidget.mask_calc_button.setEnabled)
         self.maskRegistered.connect(self.controlwidget.mask_disp_button.setEnabled)  # enable when mask is actually available for display.
         self.maskRegistered.connect(self.controlwidget.mask_disp_stop_button.setEnabled)
@@ -114,17 +118,31 @@ class MainWidget(QWidget):
                     print("transform loaded at {}".format(filepath))
                     self.cam_to_dmd_transform = transform_dict['cam_to_dmd']
                     self.transformLoaded.emit(True)
+                    self.preview_mask(self.imwidget.vertices())
                     self.config[TRANSFORM_CONFIG_PATH_KEY] = filepath
                     save_config(self.config)
             except:
                 #todo: error msg.
                 pass
 
+    def dmd_shape(self):
+        """ (height, width) of the DMD masks. """
+        if self.dmd is None:
+            return DMD_SHAPE
+        return self.dmd.h, self.dmd.w
+
     @pyqtSlot(np.ndarray)
-    def register_mask(self, cam_array, ):
+    def preview_mask(self, vertices):
+        """ redraws the DMD preview of the polygon while it is drawn. """
+        if self.cam_to_dmd_transform is None:
+            return
+        self.controlwidget.set_preview(dmd_mask(vertices, self.cam_to_dmd_transform, self.dmd_shape()))
+
+    @pyqtSlot(np.ndarray)
+    def register_mask(self, vertices):
         try:
-            dmd_shape = self.dmd.w, self.dmd.h  # this is opposite of what you would expect because cv2 returns transposed matrix.
-            self.dmd_mask = cv2.warpAffine(cam_array.astype('uint8'), self.cam_to_dmd_transform, dmd_shape) # return shape (h, w)
+            # the vertices are mapped to the DMD and the polygon is rasterized once, at the DMD resolution.
+            self.dmd_mask = dmd_mask(vertices, self.cam_to_dmd_transform, self.dmd_shape())
             self.maskRegistered.emit(True)
             self._mask_ready = True
         except:
@@ -136,11 +154,10 @@ class MainWidget(QWidget):
     def disp_mask(self):
         if self.dmd is None:
             newwidget = QWidget()
-            h, w = self.dmd_mask.shape
-            img = QImage(self.dmd_mask.data, w, h, QImage.Format_Mono)
             label = QLabel(newwidget)
-            label.setPixmap(QPixmap.fromImage(img))
+            label.setPixmap(mask_pixmap(self.dmd_mask))
             newwidget.show()
+            self._mask_window = newwidget  # keep a reference while it is shown.
         else:
             seq = self.dmd_mask.astype('uint8')
             seq *= 255
@@ -281,9 +298,21 @@ class ControlWidget(QWidget):
         zoom_layout.addWidget(self.zoomoutbutton)
         layout.addWidget(zoom_box)
 
+        preview_box = QGroupBox(self)
+        preview_box.setTitle('DMD preview')
+        self.preview = QLabel(preview_box)
+        self.preview.setFixedSize(PREVIEW_WIDTH, PREVIEW_WIDTH * DMD_SHAPE[0] // DMD_SHAPE[1])
+        preview_layout = QHBoxLayout(preview_box)
+        preview_layout.addWidget(self.preview)
+        layout.addWidget(preview_box)
+
         self.setMinimumSize(layout.sizeHint())
         self.setLayout(layout)
 
+    def set_preview(self, mask):
+        self.preview.setPixmap(mask_pixmap(mask).scaled(self.preview.size(), Qt.KeepAspectRatio,
+                                                        Qt.SmoothTransformation))
+
 
 class ToolSelector(QGroupBox):
     TOOLS = ('Draw &exclusion area polygon', "Draw &points", "Draw poly&gon")
@@ -310,7 +339,8 @@ class ToolSelector(QGroupBox):
 class ImageWidget(QGraphicsView):
 
     # imageLoaded = pyqtSignal(str)
-    mask_generated = pyqtSignal(np.ndarray)
+    mask_generated = pyqtSignal(np.ndarray)  # vertices of the mask polygon.
+    polygon_changed = pyqtSignal(np.ndarray)  # vertices, when a vertex is added or removed.
 
     def __init__(self, parent):
         super(ImageWidget, self).__init__(parent)
@@ -345,40 +375,17 @@ class ImageWidget(QGraphicsView):
         if len(self.polygon.polygon()) < 3:
             print('This polygon has no area!!!')
             return
-        polygon_mask = np.zeros(self.im_shape, dtype=bool)
-        # print(polygon_mask.shape)
-        progress = QProgressDialog()
-        progress.setWindowModality(Qt.WindowModal)
-        progress.setLabelText('Calculating mask...')
-        progress.setMinimum(0)
-        progress.show()
-        i = 0  # counter for progress bar
-        p = QPoint(0, 0)
-
-        br = self.polygon.boundingRect()  # we only need to iterate within the rectangle containing our polygon.
-        st_x = int(br.x())  # floor is good here.
-        st_y = int(br.y())
-        nd_x = st_x + int(np.ceil(br.width()))  # need to ceil so that we get the last fractional pixel.
-        nd_y = st_y + int(np.ceil(br.height()))
-        n_iters = (nd_x - st_x) * (nd_y - st_y)
-        progress.setMaximum(n_iters)
-
-        for x in range(st_x, nd_x):
-            for y in range(st_y, nd_y):
-                p.setX(x)
-                p.setY(y)
-                polygon_mask[y, x] = self.polygon.contains(p)
-                # It isn't completely trivial that this should work, but it does:
-                # The QGraphicsPixMapItem is always painted starting at the scene's (0,0) point, and this
-                # origin doesn't change if, for example, another item is added to a point that is negative to
-                # the origin. Also, since the pixmap is scaled to 1 (even if the sceneview is zoomed
-                # differently 1 px in scene coordinates is 1 px in pixmap coordinates. So using the coordinate
-                # system of our mask bitmap, we're traverse the test point over the entire image pixmap area.
-                # And since the QPolygon is in scene coordinates too, everything works.
-                i += 1
-                if not i % 500:
-                    progress.setValue(i)
-        self.mask_generated.emit(polygon_mask)
+        self.mask_generated.emit(self.vertices())
+
+    def vertices(self) -> np.ndarray:
+        """
+        Returns the (n, 2) image coordinates of the polygon's vertices.
+
+        The QGraphicsPixmapItem is always painted starting at the scene's (0,0) point, and since the pixmap is scaled
+        to 1 (even if the view is zoomed), 1 px in scene coordinates is 1 px in pixmap coordinates. The QPolygon is in
+        scene coordinates too, so its vertices are in the coordinates of the image.
+        """
+        return np.array([(p.x(), p.y()) for p in self.polygon.polygon()], dtype=np.float64).reshape(-1, 2)
 
     @pyqtSlot()
     def zoomin(self):
@@ -393,12 +400,14 @@ class ImageWidget(QGraphicsView):
         # print(self.mapToScene(e.pos()))
         pg.append(self.mapToScene(e.pos()))
         self.polygon.setPolygon(pg)
+        self.polygon_changed.emit(self.vertices())
 
         return
 
     @pyqtSlot()
     def clear_mask_poly(self):
         self.polygon.setPolygon(QPolygonF())
+        self.polygon_changed.emit(self.vertices())
         return
 
     def keyPressEvent(self, e: QKeyEvent):
@@ -412,7 +421,15 @@ class ImageWidget(QGraphicsView):
             i = poly.count() - 1
             poly.remove(i)
         self.polygon.setPolygon(poly)
+        self.polygon_changed.emit(self.vertices())
+
+
 
+def mask_pixmap(mask) -> QPixmap:
+    """ returns a pixmap of a boolean mask, white where it is set. """
+    img = np.ascontiguousarray(mask, dtype=np.uint8) * 255
+    h, w = img.shape
+    return QPixmap.fromImage(QImage(img.data, w, h, w, QImage.Format_Grayscale8))  # copies the data.
 
 
 def main():
@@ -0,0 +1,86 @@
+"""
+Qt-free rasterization of the mask polygons, so that masks can be computed from vertex lists in scripts.
+
+Pixel (row, col) covers [col, col + 1) x [row, row + 1) in image coordinates (the scene coordinates of the mask
+maker), and is in the mask if its center is inside the polygon by the even-odd rule, which is the fill rule of the
+QGraphicsPolygonItem drawn in the mask maker. Self-intersecting polygons therefore have holes where they overlap.
+
+ROIs drawn on a camera image are mapped to the DMD by transforming their vertices (transform_vertices) and
+rasterizing once at the DMD resolution (dmd_mask), instead of warping a camera resolution mask.
+"""
+
+import numpy as np
+
+
+def polygon_mask(vertices, shape) -> np.ndarray:
+    """
+    Rasterizes a polygon with scanlines through the pixel centers.
+
+    Each edge crosses the scanlines of the rows it spans once. Every crossing toggles the pixels to its right, so the
+    parity of the cumulated toggles along a row is the even-odd inside test, computed for all rows at once.
+
+    :param vertices: (n, 2) sequence of the (x, y) image coordinates of the vertices, in order. The polygon is closed
+    from the last vertex to the first.
+    :param shape: (height, width) of the mask.
+    :return: boolean array of the given shape.
+    """
+    h, w = shape
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+    if len(vertices) < 3:
+        return np.zeros((h, w), dtype=bool)
+    x0, y0 = vertices.T
+    x1, y1 = np.roll(vertices, -1, axis=0).T
+    # an edge crosses the centers yc = row + .5 with min(y0, y1) <= yc < max(y0, y1): horizontal edges none.
+    first = np.clip(np.ceil(np.minimum(y0, y1) - .5), 0, h).astype(np.int64)
+    stop = np.clip(np.ceil(np.maximum(y0, y1) - .5), 0, h).astype(np.int64)
+    n_rows = stop - first
+    if not n_rows.sum():
+        return np.zeros((h, w), dtype=bool)
+    edges = np.repeat(np.arange(len(vertices)), n_rows)
+    rows = np.repeat(first, n_rows) + np.arange(n_rows.sum()) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+    yc = rows + .5
+    e_x0, e_y0 = x0[edges], y0[edges]
+    x = e_x0 + (yc - e_y0) * (x1[edges] - e_x0) / (y1[edges] - e_y0)
+    # the pixels whose centers are right of the crossing (xc = col + .5 >= x) are toggled.
+    cols = np.clip(np.ceil(x - .5), 0, w).astype(np.int64)
+    # only the rows and columns from the first crossing on can be inside.
+    r0, c0 = rows.min(), cols.min()
+    toggles = np.zeros((rows.max() + 1 - r0, w + 1 - c0), dtype=bool)
+    np.logical_xor.at(toggles, (rows - r0, cols - c0), True)
+    mask = np.zeros((h, w), dtype=bool)
+    mask[r0:r0 + len(toggles), c0:] = np.logical_xor.accumulate(toggles, axis=1)[:, :w - c0]
+    return mask
+
+
+def transform_vertices(vertices, affine) -> np.ndarray:
+    """
+    Maps vertices through an affine transform, ie the camera to DMD transform of the mask maker.
+
+    The transform is in the convention of cv2 (getAffineTransform, warpAffine), where integer coordinates are pixel
+    centers, so the image coordinates are shifted by half a pixel before and after the transform.
+
+    :param vertices: (n, 2) sequence of (x, y) image coordinates.
+    :param affine: (2, 3) matrix.
+    :return: (n, 2) array of the transformed image coordinates.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2) - .5
+    affine = np.asarray(affine, dtype=np.float64)
+    return vertices @ affine[:, :2].T + affine[:, 2] + .5
+
+
+def dmd_mask(vertices, cam_to_dmd, dmd_shape, scale=1) -> np.ndarray:
+    """
+    Rasterizes a polygon drawn on the camera image at the resolution of the DMD.
+
+    :param vertices: (n, 2) sequence of the (x, y) camera image coordinates of the vertices (see polygon_mask).
+    :param cam_to_dmd: (2, 3) affine transform from camera to DMD pixels.
+    :param dmd_shape: (height, width) of the DMD.
+    :param scale: logical pixel size in mirrors. A logical pixel is in the mask if any of its mirrors is, as in
+    randpatterns.utils.find_unmasked_px.
+    :return: boolean array (height // scale, width // scale).
+    """
+    mask = polygon_mask(transform_vertices(vertices, cam_to_dmd), dmd_shape)
+    if scale == 1:
+        return mask
+    h, w = dmd_shape[0] // scale, dmd_shape[1] // scale
+    return mask[:h * scale, :w * scale].reshape(h, scale, w, scale).any(axis=(1, 3))
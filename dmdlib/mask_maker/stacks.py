@@ -0,0 +1,136 @@
+"""
+Projections (mean, max, std) of image stacks that don't fit in memory, without Qt.
+
+RedShirt .tsm files are memory-mapped and TIFF stacks are read one page at a time, and the projections are accumulated
+over chunks of frames, so the memory used is bounded by chunk_mb, whatever the length of the stack.
+"""
+
+import numpy as np
+from PIL import Image
+
+PROJECTIONS = ('mean', 'max', 'std')
+TSM_HEADER_BYTES = 2880  # this is hardcoded
+TSM_CARD_BYTES = 80
+CHUNK_MB = 64  # memory for the float64 copy of a chunk of frames.
+
+
+def tsm_header(path) -> dict:
+    """
+    :param path: path to a .tsm file.
+    :return: {keyword: value string} of the FITS header cards (ie 'NAXIS1', the frame width).
+    """
+    with open(path, 'rb') as f:
+        header = f.read(TSM_HEADER_BYTES)
+    cards = {}
+    for i in range(0, len(header), TSM_CARD_BYTES):
+        card = header[i:i + TSM_CARD_BYTES].replace(b' ', b'')  # remove all whitespaces
+        if card == b'END':
+            break
+        if b'=' in card:
+            param, value = card.split(b'=', 1)
+            cards[param.decode()] = value.decode()
+    return cards
+
+
+def tsm_frames(path) -> np.memmap:
+    """
+    Memory-maps the frames of a RedShirt Imaging .tsm file (the frames are followed by a dark frame and event data,
+    which are not mapped).
+
+    :param path: path to a .tsm file.
+    :return: uint16 memmap (n_frames, height, width).
+    """
+    cards = tsm_header(path)
+    shape = int(cards['NAXIS3']), int(cards['NAXIS2']), int(cards['NAXIS1'])
+    return np.memmap(path, dtype='uint16', mode='r', offset=TSM_HEADER_BYTES, shape=shape)
+
+
+def tsm_projections(path, startframe=0, endframe=0, projections=('mean',), chunk_mb=CHUNK_MB) -> dict:
+    """
+    :param path: path to a .tsm file.
+    :param startframe: first frame to include.
+    :param endframe: frame after the last one to include (default: the last frame of the file).
+    :param projections: names in PROJECTIONS.
+    :param chunk_mb: memory for the frames accumulated at once (at least one frame).
+    :return: {projection: float64 array (height, width)}
+    """
+    frames = tsm_frames(path)
+    endframe = endframe or len(frames)
+    chunk_frames = _chunk_frames(frames.shape[1:], chunk_mb)
+    chunks = (frames[i:min(i + chunk_frames, endframe)] for i in range(startframe, endframe, chunk_frames))
+    return project(chunks, projections)
+
+
+def _chunk_frames(frame_shape, chunk_mb) -> int:
+    return max(int(chunk_mb * 2 ** 20 // (np.prod(frame_shape) * 8)), 1)
+
+
+def tiff_chunks(path, startframe=0, endframe=0, chunk_mb=CHUNK_MB):
+    """
+    Reads the pages of a TIFF file in chunks, one page at a time.
+
+    :param path: path to a .tif(f) file.
+    :param startframe: first page to include.
+    :param endframe: page after the last one to include (default: the last page of the file).
+    :param chunk_mb: memory for the pages of a chunk (at least one page).
+    :return: generator of arrays (n, height, width). Color pages are converted to grayscale.
+    """
+    with Image.open(path) as im:  # type: Image.Image
+        endframe = endframe or getattr(im, 'n_frames', 1)
+        chunk_frames = _chunk_frames((im.height, im.width), chunk_mb)
+        for start in range(startframe, endframe, chunk_frames):
+            pages = []
+            for i in range(start, min(start + chunk_frames, endframe)):
+                im.seek(i)
+                pages.append(_page_array(im))
+            yield np.stack(pages)
+
+
+def _page_array(page: Image.Image) -> np.ndarray:
+    if len(page.getbands()) > 1 or page.mode in ('P', '1'):
+        page = page.convert('L')
+    return np.asarray(page)
+
+
+def tiff_projections(path, startframe=0, endframe=0, projections=('mean',), chunk_mb=CHUNK_MB) -> dict:
+    """
+    Takes the same parameters as tsm_projections, for the pages of a TIFF file.
+    """
+    return project(tiff_chunks(path, startframe, endframe, chunk_mb), projections)
+
+
+def project(chunks, projections=('mean',)) -> dict:
+    """
+    Accumulates projections over chunks of frames.
+
+    :param chunks: iterable of arrays (n, height, width).
+    :param projections: names in PROJECTIONS.
+    :return: {projection: float64 array (height, width)}
+    """
+    unknown = set(projections) - set(PROJECTIONS)
+    if unknown:
+        raise ValueError('Unknown projections: {}.'.format(', '.join(sorted(unknown))))
+    n = 0
+    mean = m2 = maximum = None
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=np.float64)
+        n_chunk = len(chunk)
+        if not n_chunk:
+            continue
+        chunk_mean = chunk.mean(axis=0)
+        if mean is None:
+            mean = np.zeros(chunk.shape[1:])
+            m2 = np.zeros(chunk.shape[1:])
+            maximum = np.full(chunk.shape[1:], -np.inf)
+        # merges the chunk's mean and sum of squared deviations into the running ones (Chan et al.).
+        delta = chunk_mean - mean
+        if 'std' in projections:
+            m2 += np.square(chunk - chunk_mean).sum(axis=0) + np.square(delta) * n * n_chunk / (n + n_chunk)
+        mean += delta * n_chunk / (n + n_chunk)
+        n += n_chunk
+        if 'max' in projections:
+            np.maximum(maximum, chunk.max(axis=0), out=maximum)
+    if not n:
+        raise ValueError('There are no frames to project.')
+    results = {'mean': mean, 'max': maximum, 'std': np.sqrt(m2 / n)}
+    return {p: results[p] for p in projections}
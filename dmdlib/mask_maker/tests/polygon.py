@@ -0,0 +1,68 @@
+"""
+Tests the polygon rasterization against a pixel by pixel even-odd test.
+"""
+
+import unittest
+import numpy as np
+from dmdlib.mask_maker import polygon_mask, transform_vertices, dmd_mask
+from dmdlib.randpatterns.utils import find_unmasked_px
+
+
+def contains(vertices, shape):
+    """ even-odd test of the pixel centers, one edge at a time. """
+    yy, xx = np.mgrid[:shape[0], :shape[1]] + .5
+    inside = np.zeros(shape, dtype=bool)
+    for (xa, ya), (xb, yb) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        crosses = (ya <= yy) != (yb <= yy)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inside ^= crosses & (xx >= xa + (yy - ya) * (xb - xa) / (yb - ya))
+    return inside
+
+
+class TestPolygonMask(unittest.TestCase):
+
+    def test_rectangle(self):
+        mask = polygon_mask([(2, 1), (6, 1), (6, 4), (2, 4)], (6, 8))
+        expected = np.zeros((6, 8), dtype=bool)
+        expected[1:4, 2:6] = True
+        self.assertTrue(np.all(mask == expected))
+
+    def test_self_intersecting(self):
+        star = [(10 + 9 * np.sin(a), 10 - 9 * np.cos(a)) for a in np.arange(5) * 4 * np.pi / 5]
+        mask = polygon_mask(star, (20, 20))
+        self.assertFalse(mask[10, 10])  # the center of a pentagram is covered twice.
+        self.assertTrue(np.all(mask == contains(np.array(star), (20, 20))))
+
+    def test_random(self):
+        rng = np.random.default_rng(0)
+        for _ in range(100):
+            vertices = rng.uniform(-10, 60, (rng.integers(3, 12), 2))  # also outside of the image.
+            self.assertTrue(np.all(polygon_mask(vertices, (40, 50)) == contains(vertices, (40, 50))))
+
+    def test_empty(self):
+        self.assertFalse(polygon_mask([(1, 1), (5, 5)], (8, 8)).any())
+        self.assertFalse(polygon_mask([(1, 1), (5, 1), (3, 1)], (8, 8)).any())
+        self.assertFalse(polygon_mask([(-5, -5), (-1, -5), (-1, -1)], (8, 8)).any())
+
+
+class TestDmdMask(unittest.TestCase):
+    cam_to_dmd = np.array([[2., 0., 10.], [0., 2., 4.]])  # cv2 convention: pixel centers at integer coordinates.
+
+    def test_transform(self):
+        # the center of camera pixel (3, 1) is the center of DMD pixel (16, 6).
+        self.assertTrue(np.allclose(transform_vertices([(3.5, 1.5)], self.cam_to_dmd), [(16.5, 6.5)]))
+        self.assertTrue(np.allclose(transform_vertices([(0, 0), (1, 1)], self.cam_to_dmd), [(9.5, 3.5), (11.5, 5.5)]))
+
+    def test_dmd_mask(self):
+        square = [(2, 1), (6, 1), (6, 5), (2, 5)]  # camera pixels [2, 6) x [1, 5).
+        mask = dmd_mask(square, self.cam_to_dmd, (30, 40))
+        expected = np.zeros((30, 40), dtype=bool)
+        expected[5:13, 13:21] = True
+        self.assertTrue(np.all(mask == expected))
+        for scale in (3, 4):
+            scaled = dmd_mask(square, self.cam_to_dmd, (30, 40), scale)
+            self.assertTrue(np.all(scaled == find_unmasked_px(mask, scale)))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4)
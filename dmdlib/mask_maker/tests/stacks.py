@@ -0,0 +1,66 @@
+"""
+Tests the chunked projections of .tsm and TIFF stacks against projections of the whole stack in memory.
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from PIL import Image
+from dmdlib.mask_maker import stacks
+
+
+def write_tsm(path, frames):
+    """ writes frames (n, height, width) after a FITS header, followed by a dark frame. """
+    n, h, w = frames.shape
+    cards = ['SIMPLE  = T', 'BITPIX  = 16', 'NAXIS   = 3', 'NAXIS1  = {}'.format(w), 'NAXIS2  = {}'.format(h),
+             'NAXIS3  = {}'.format(n), 'END']
+    header = b''.join(c.ljust(stacks.TSM_CARD_BYTES).encode() for c in cards).ljust(stacks.TSM_HEADER_BYTES)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(frames.astype('uint16').tobytes())
+        f.write(np.full((h, w), 7, dtype='uint16').tobytes())
+
+
+class TestProjections(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.frames = (rng.random((23, 6, 10)) * 60000).astype('uint16')
+        self.frame_mb = self.frames[0].size * 8 / 2 ** 20
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _check(self, result, frames):
+        self.assertTrue(np.allclose(result['mean'], frames.mean(axis=0)))
+        self.assertTrue(np.allclose(result['max'], frames.max(axis=0)))
+        self.assertTrue(np.allclose(result['std'], frames.std(axis=0)))
+
+    def test_tsm(self):
+        path = os.path.join(self.workdir, 'stack.tsm')
+        write_tsm(path, self.frames)
+        self.assertEqual(stacks.tsm_frames(path).shape, self.frames.shape)
+        self._check(stacks.tsm_projections(path, projections=stacks.PROJECTIONS, chunk_mb=4 * self.frame_mb),
+                    self.frames)
+        self._check(stacks.tsm_projections(path, 3, 20, stacks.PROJECTIONS, chunk_mb=0), self.frames[3:20])
+
+    def test_tiff(self):
+        path = os.path.join(self.workdir, 'stack.tif')
+        pages = [Image.fromarray(f) for f in self.frames]
+        pages[0].save(path, save_all=True, append_images=pages[1:])
+        self._check(stacks.tiff_projections(path, projections=stacks.PROJECTIONS, chunk_mb=5 * self.frame_mb),
+                    self.frames)
+        self._check(stacks.tiff_projections(path, 2, 9, stacks.PROJECTIONS), self.frames[2:9])
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            stacks.project([self.frames], ('median',))
+        with self.assertRaises(ValueError):
+            stacks.project([])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4)
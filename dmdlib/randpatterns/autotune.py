@@ -0,0 +1,151 @@
+"""
+Chooses the number and length of the Presenter's sequences for a picture time.
+
+The time to refresh a sequence (pattern generation and _AlpSeqPut) is measured on the device at two sequence lengths
+and modelled as a fixed cost plus a cost per frame. A sequence of n frames then has to:
+    1. be refreshed faster than it is displayed: safety * cost(n) <= n * picture_time, and
+    2. leave enough frames queued while it is refreshed: the other nseqs - 1 sequences are displayed for at least
+       safety * (poll_interval + cost(n)).
+The shortest sequence satisfying (1) is used, and lengthened until the number of sequences required by (2) fits into
+the device memory (ALP_AVAIL_MEMORY) and sequence queue (ALP_PROJ_QUEUE_MAX_AVAIL).
+"""
+
+import time
+import numpy as np
+from dmdlib.core.ALP import AlpDmd
+
+MIN_PIX_PER_SEQ = 10
+
+
+class SequenceCosts:
+    """
+    Linear model of the time to generate and upload a sequence from its length.
+    """
+    def __init__(self, sizes, generate_s, upload_s):
+        """
+        :param sizes: sequence lengths (frames) that were timed.
+        :param generate_s: time in seconds to generate a sequence of each length.
+        :param upload_s: time in seconds to upload a sequence of each length.
+        """
+        self.generate = self._fit(sizes, generate_s)
+        self.upload = self._fit(sizes, upload_s)
+
+    @staticmethod
+    def _fit(sizes, times):
+        """ returns (fixed_s, per_frame_s) of the least squares line. Neither can be negative. """
+        if len(set(sizes)) < 2:
+            return 0., max(float(np.mean(times)) / sizes[0], 0.)
+        per_frame, fixed = np.polyfit(sizes, times, 1)
+        return max(float(fixed), 0.), max(float(per_frame), 0.)
+
+    def sequence_time(self, n, pipelined=False):
+        """
+        Time in seconds to refresh a sequence of n frames. If generation runs in a worker thread
+        (PipelinedPresenter), the slower of the two stages limits the refresh rate.
+        """
+        generate = self.generate[0] + self.generate[1] * n
+        upload = self.upload[0] + self.upload[1] * n
+        if pipelined:
+            return max(generate, upload)
+        return generate + upload
+
+    def __str__(self):
+        return 'generate: {:.2f} ms + {:.3f} ms/frame, upload: {:.2f} ms + {:.3f} ms/frame'.format(
+            self.generate[0] * 1e3, self.generate[1] * 1e3, self.upload[0] * 1e3, self.upload[1] * 1e3)
+
+
+def measure_costs(dmd: AlpDmd, pattern_generator, image_scale=4, packed=False, sizes=(10, 40), repeats=2,
+                  nbits=1) -> SequenceCosts:
+    """
+    Times pattern generation and upload of trial sequences. The generator's frame_index is restored afterwards, so
+    the trial frames are generated again in the run.
+
+    :param dmd: AlpDmd object. The trial sequences are freed after the upload.
+    :param pattern_generator: generator with make_patterns(boolean_array, seq_array, debug).
+    :param image_scale: logical pixel size.
+    :param packed: upload packed binary data.
+    :param sizes: sequence lengths to time.
+    :param repeats: number of times each length is timed, the fastest is used.
+    :param nbits: bit depth of the sequences.
+    :return: SequenceCosts
+    """
+    frame_index = getattr(pattern_generator, 'frame_index', None)
+    generate_s, upload_s = [], []
+    for n in sizes:
+        seq_array_bool = np.zeros((n, dmd.h // image_scale, dmd.w // image_scale), dtype=bool)
+        seq_array = dmd.make_sequence_array(n, packed)
+        seq = dmd.seq_alloc(nbits, n, packed)
+        try:
+            gen, put = [], []
+            for _ in range(repeats):
+                t = time.perf_counter()
+                pattern_generator.make_patterns(seq_array_bool, seq_array, False)
+                gen.append(time.perf_counter() - t)
+                t = time.perf_counter()
+                seq.upload_array(seq_array, copy=False)
+                put.append(time.perf_counter() - t)
+        finally:
+            dmd.seq_free(seq)
+        generate_s.append(min(gen))
+        upload_s.append(min(put))
+    if frame_index is not None:
+        pattern_generator.frame_index = frame_index
+    return SequenceCosts(sizes, generate_s, upload_s)
+
+
+def choose_sequences(costs: SequenceCosts, picture_time, avail_memory, queue_max, poll_interval=.1, safety=2.,
+                     nbits=1, pipelined=False) -> dict:
+    """
+    Picks the sequence length and count (see module docstring).
+
+    :param costs: SequenceCosts measured on the device.
+    :param picture_time: time in microseconds to display each frame.
+    :param avail_memory: device memory available for the sequences, in binary frames.
+    :param queue_max: number of waiting positions in the sequence queue.
+    :param poll_interval: time in seconds between checks of the projection progress.
+    :param safety: factor by which the refresh must be faster than the display.
+    :param nbits: bit depth of the sequences.
+    :param pipelined: generation runs in a worker thread (PipelinedPresenter).
+    :return: dictionary of Presenter keyword arguments: nseqs, pix_per_seq, and max_nseqs, the most sequences that
+    fit in memory and the queue, up to which sequences are added when the queue drains during a run.
+    """
+    if safety < 1:
+        raise ValueError('The safety margin must be at least 1.')
+    frame_s = picture_time * 1e-6
+    fixed = costs.sequence_time(0, pipelined)
+    per_frame = costs.sequence_time(1, pipelined) - fixed
+    if safety * per_frame >= frame_s:
+        raise ValueError('Sequences cannot be refreshed at {} us per frame: generation and upload take {:.0f} us '
+                         'per frame ({}), {:.1f} times the picture time are needed.'.format(
+                            picture_time, per_frame * 1e6, costs, safety))
+    max_seqs = queue_max + 1  # one sequence is displayed while the others wait.
+    n = max(MIN_PIX_PER_SEQ, int(np.ceil(safety * fixed / (frame_s - safety * per_frame))))
+    while True:
+        lead_s = safety * (poll_interval + costs.sequence_time(n, pipelined))
+        nseqs = max(2, int(np.ceil(lead_s / (n * frame_s))) + 1)
+        if nseqs * n * nbits > avail_memory:
+            raise ValueError('{} sequences of {} frames are needed at {} us per frame, but only {} frames of device '
+                             'memory are available.'.format(nseqs, n, picture_time, avail_memory))
+        if nseqs <= max_seqs:
+            break
+        n = int(np.ceil(n * 1.25))
+    # sequences added during a run are limited to twice the planned buffer, the rest of the memory stays free.
+    max_nseqs = min(max_seqs, avail_memory // (n * nbits), 2 * nseqs)
+    return {'nseqs': nseqs, 'pix_per_seq': n, 'max_nseqs': max(max_nseqs, nseqs)}
+
+
+def autotune(dmd: AlpDmd, pattern_generator, picture_time, image_scale=4, packed=False, poll_interval=.1,
+             safety=2., nbits=1, pipelined=False) -> dict:
+    """
+    Measures generation and upload times and queries the device memory and queue size to choose the sequence count
+    and length for a Presenter. The queue size is queried in the sequence queue mode that the Presenter uses.
+
+    :return: dictionary of Presenter keyword arguments (see choose_sequences).
+    """
+    dmd.seq_queue_mode()
+    costs = measure_costs(dmd, pattern_generator, image_scale, packed, nbits=nbits)
+    settings = choose_sequences(costs, picture_time, dmd.avail_memory, dmd.queue_max_avail, poll_interval, safety,
+                                nbits, pipelined)
+    print('Auto-tune ({}): {nseqs} sequences of {pix_per_seq} frames (up to {max_nseqs} sequences), safety margin '
+          '{}x.'.format(costs, safety, **settings))
+    return settings
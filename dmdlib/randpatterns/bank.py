@@ -0,0 +1,110 @@
+import numpy as np
+from dmdlib.randpatterns import utils
+from dmdlib.randpatterns.geometry import MaskGeometry
+from dmdlib.randpatterns import ephys_comms
+from dmdlib.randpatterns.presenter import FlutPresenter
+import os
+
+
+class PatternBank:
+    """
+    Stimulus generator for FlutPresenter: presents a fixed bank of patterns in cycled or random order. The bank is
+    uploaded once, and only the display order is sent to the device for each sequence. Use this for protocols with a
+    small set of patterns, ie single spot scanning, repeated trials, or dictionaries of stimuli.
+    """
+    ORDERS = ('cycle', 'random')
+
+    def __init__(self, patterns: np.ndarray, mask=None, scale=1, order='random', seed=None):
+        """
+        :param patterns: boolean array of logical patterns (n_patterns, h / scale, w / scale).
+        :param mask: boolean mask of the DMD shape.
+        :param scale: logical pixel size in mirrors.
+        :param order: 'cycle' presents the patterns in bank order, 'random' draws each frame uniformly from the bank.
+        :param seed: session seed for the random order.
+        """
+        if order not in self.ORDERS:
+            raise ValueError('order must be one of {}.'.format(self.ORDERS))
+        self.patterns = patterns.astype(bool)
+        self.mask = mask
+        self.geometry = None if mask is None else MaskGeometry.get(mask, scale)
+        self.scale = scale
+        self.order = order
+        self.streams = utils.FrameStreams(seed)
+        self.frame_index = 0  # index of the next frame to be presented.
+
+    @property
+    def bank_size(self):
+        return len(self.patterns)
+
+    def make_bank(self, boolean_array: np.ndarray, seq_array: np.ndarray):
+        """
+        :param boolean_array: boolean array (n_patterns, h / scale, w / scale) to write the logical patterns to.
+        :param seq_array: uint8 array (n_patterns, h, w), or packed binary, to write the rendered bank to.
+        """
+        boolean_array[:] = self.patterns
+        if self.geometry is None:
+            utils.render_sequence(boolean_array, self.scale, seq_array)
+        else:
+            self.geometry.render(boolean_array, seq_array)
+
+    def make_indices(self, index_array: np.ndarray):
+        """
+        Writes the bank indices of the next frames.
+
+        :param index_array: integer array (n_frames,)
+        """
+        n = len(index_array)
+        if self.order == 'cycle':
+            index_array[:] = np.arange(self.frame_index, self.frame_index + n) % self.bank_size
+        else:
+            index_array[:] = self.streams.frame(self.frame_index).integers(self.bank_size, size=n)
+        self.frame_index += n
+
+    def params(self) -> dict:
+        """ parameters of the generator (the patterns are saved as the pattern bank). """
+        return {'generator': 'PatternBank', 'seed': self.streams.seed, 'order': self.order, 'scale': self.scale}
+
+
+def main():
+    parser = utils.setup_parser()
+    parser.description = 'Presents a bank of patterns through the frame look-up table of the DMD.'
+    parser.add_argument('patternfile', help='path to logical patterns (.npy) file, boolean (n, h / scale, w / scale)')
+    parser.add_argument('--order', choices=PatternBank.ORDERS, default='random', help='presentation order')
+    args = parser.parse_args()
+    MaskGeometry.disk_cache = True  # reuses the geometry of the mask across sessions.
+
+    fullpath = os.path.abspath(args.savefile)
+    if not args.overwrite and os.path.exists(args.savefile):
+        errst = "{} already exists.".format(fullpath)
+        raise FileExistsError(errst)
+
+    mask = np.load(args.maskfile)
+    generator = PatternBank(np.load(args.patternfile), mask, args.scale, args.order, args.seed)
+
+    presentations_per = min([60000, args.nframes])
+
+    if not args.no_phys:
+        openephys = ephys_comms.OpenEphysComms()
+
+    n_runs = int(np.ceil(args.nframes / presentations_per))
+    assert n_runs > 0
+    with utils.make_saver(args, fullpath) as saver, utils.make_dmd(args) as dmd:
+        saver.store_mask_array(mask)
+        saver.store_generator_params(generator.params())
+        uuid = saver.uuid
+        if not args.no_phys:
+            openephys.record_start(uuid, fullpath)
+
+        def run_start(i, run_id):
+            print("Starting presentation run {} of {} ({}).".format(i + 1, n_runs, run_id))
+            if not args.no_phys:
+                openephys.record_presentation(run_id)
+
+        # the runs are presented in one session, without stopping the projection between them.
+        presenter = FlutPresenter(dmd, generator, saver, presentations_per, image_scale=args.scale,
+                                  picture_time=args.pic_time, packed=args.packed)
+        presenter.run_session(n_runs, on_run_start=run_start)
+
+
+if __name__ == '__main__':
+    main()
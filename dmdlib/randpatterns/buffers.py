@@ -0,0 +1,109 @@
+"""
+Pool of staging buffers for the sequences of a presenter.
+
+A buffer holds the logical patterns (boolean, (n_frames, h / scale, w / scale)) and the rendered frames for upload
+of one sequence. The generator fills it in place, and the upload and the saver read it without copying. Each user
+holds a reference, and the buffer returns to the pool when the last one is released, so its patterns are not
+overwritten while they wait to be written. The number of buffers is fixed: acquire blocks while all of them are in
+use, so the memory use does not grow during a session and no arrays are allocated per sequence.
+"""
+
+import threading
+import time
+
+
+class StagingBuffer:
+    """
+    Patterns and frames arrays of one sequence, with a reference count (see BufferPool).
+    """
+    def __init__(self, pool, patterns, frames):
+        """
+        :param pool: BufferPool that the buffer returns to.
+        :param patterns: boolean array of the logical patterns.
+        :param frames: uint8 array of the rendered frames for upload.
+        """
+        self.patterns = patterns
+        self.frames = frames
+        self._pool = pool
+        self._refs = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self.patterns.nbytes + self.frames.nbytes
+
+    def retain(self) -> 'StagingBuffer':
+        """ adds a reference, which has to be released when the user is done with the buffer. """
+        self._pool._retain(self)
+        return self
+
+    def release(self):
+        """ drops a reference. The buffer returns to the pool when none are left. """
+        self._pool._release(self)
+
+
+class BufferPool:
+    """
+    Fixed number of StagingBuffers. They are allocated when first needed, so an unused pool takes no memory.
+    """
+    def __init__(self, n_buffers, make_buffer):
+        """
+        :param n_buffers: number of buffers.
+        :param make_buffer: function returning the (patterns, frames) arrays of a new buffer.
+        """
+        if n_buffers < 1:
+            raise ValueError('The pool needs at least one buffer.')
+        self.n_buffers = n_buffers
+        self._make_buffer = make_buffer
+        self._buffers = []
+        self._free = []
+        self._cond = threading.Condition()
+        self.waits = 0  # acquisitions that waited for a buffer to be released.
+        self.wait_s = 0.
+
+    @property
+    def nbytes(self) -> int:
+        """ memory of the allocated buffers. """
+        return sum(b.nbytes for b in self._buffers)
+
+    def acquire(self) -> StagingBuffer:
+        """ returns a free buffer holding one reference, waiting while all buffers are in use. """
+        with self._cond:
+            if not self._free and len(self._buffers) == self.n_buffers:
+                t = time.perf_counter()
+                while not self._free:
+                    self._cond.wait()
+                self.waits += 1
+                self.wait_s += time.perf_counter() - t
+            if self._free:
+                buffer = self._free.pop()  # the last released is the most likely to be cached.
+            else:
+                buffer = StagingBuffer(self, *self._make_buffer())
+                self._buffers.append(buffer)
+            buffer._refs = 1
+        return buffer
+
+    def _retain(self, buffer: StagingBuffer):
+        with self._cond:
+            if buffer._refs < 1:
+                raise ValueError('The buffer is not in use.')
+            buffer._refs += 1
+
+    def _release(self, buffer: StagingBuffer):
+        with self._cond:
+            if buffer._refs < 1:
+                raise ValueError('The buffer was released more often than it was acquired and retained.')
+            buffer._refs -= 1
+            if buffer._refs == 0:
+                self._free.append(buffer)
+                self._cond.notify()
+
+    def summary(self) -> dict:
+        return {
+            'buffers': len(self._buffers),
+            'mb': self.nbytes / 2 ** 20,
+            'waits': self.waits,
+            'wait_s': self.wait_s,
+        }
+
+    def __str__(self):
+        return 'Buffer pool: ' + ', '.join('{}={:.3g}'.format(k, v) for k, v in self.summary().items())
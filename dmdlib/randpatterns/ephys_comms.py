@@ -1,11 +1,20 @@
 """
 Module handling the communication with OpenEphys.
+
+OpenEphysComms sends each message on a new socket and blocks until OpenEphys replies. OpenEphysChannel keeps one
+connection in a background thread, so that messages and event markers can be sent from the presentation without
+waiting for OpenEphys.
 """
+import queue
+import threading
+import time
+import numpy as np
 import zmq
 
 TIMEOUT_MS = 250  # time to wait for ZMQ socket to respond before error.
 HOSTNAME = 'localhost'
 PORT = 5556
+MARKER_SEPARATOR = '; '  # between the markers of a batch.
 
 _ctx = zmq.Context()  # should be only one made per process.
 
@@ -69,5 +78,198 @@ class OpenEphysComms:
         self.send_message(msg)
 
 
+class OpenEphysChannel:
+    """
+    Long-lived connection to the OpenEphys ZMQ socket, owned by a background thread.
+
+    send and mark only queue their text, so they can be called from the presentation loop or the projection monitor
+    without waiting for OpenEphys. Markers are joined into one message (separated by MARKER_SEPARATOR) when
+    max_batch of them are waiting or the first has waited batch_interval seconds, so their text should carry their
+    time. Messages and markers are sent in the order they were queued.
+
+    A request that gets no reply within timeout_ms is retried on a new socket (a REQ socket can't send again before a
+    reply), up to retries times, and is then dropped. Messages that fail to be sent (ie ZMQError) and messages queued
+    while max_queue are waiting are dropped too. flush raises OpenEphysError if messages were dropped.
+
+    Reported in summary():
+        sent, markers, dropped: messages delivered, markers queued and messages dropped.
+        timeouts, reconnects: requests without a reply in time, and the sockets opened to retry.
+        latency: time from sending a message to the reply.
+    """
+    def __init__(self, hostname=HOSTNAME, port=PORT, timeout_ms=TIMEOUT_MS, retries=2, max_batch=50,
+                 batch_interval=.05, max_queue=10000, clock=time.perf_counter):
+        """
+        :param hostname: where to connect to OpenEphys ZMQ socket (default: 'localhost')
+        :param port: port to connect openephys socket (default: 5556)
+        :param timeout_ms: time to wait for the reply to a message.
+        :param retries: number of times a message is sent again when OpenEphys doesn't reply.
+        :param max_batch: largest number of markers sent in one message.
+        :param batch_interval: longest time in seconds a marker waits for more markers.
+        :param max_queue: largest number of messages and markers waiting to be sent.
+        :param clock: function returning the host time in seconds.
+        """
+        self.hostname = hostname
+        self.port = port
+        self.timeout_ms = timeout_ms
+        self.retries = retries
+        self.max_batch = max_batch
+        self.batch_interval = batch_interval
+        self._clock = clock
+        self.sent = 0
+        self.markers = 0
+        self.batches = 0
+        self._dropped_full = 0  # counted by the callers of send and mark.
+        self._dropped_sending = 0  # counted by the thread.
+        self.last_error = None  # last exception raised while sending.
+        self.timeouts = 0
+        self.reconnects = 0
+        self.latency_s = []
+        self._reported_dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._sock = None
+        self._opened = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def send(self, msg: str):
+        """ queues a message. """
+        self._put(('message', msg))
+
+    def mark(self, text: str):
+        """ queues an event marker, which is sent with the markers queued around it. """
+        self.markers += 1
+        self._put(('marker', text))
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self._dropped_full += 1
+
+    @property
+    def dropped(self) -> int:
+        """ number of messages that were not sent. """
+        return self._dropped_full + self._dropped_sending
+
+    def flush(self, timeout=None):
+        """
+        Waits until the messages and markers queued before are sent or dropped.
+
+        Raises OpenEphysError if messages were dropped since the last flush.
+
+        :param timeout: time in seconds (default: no limit).
+        :return: False if the timeout expired.
+        """
+        done = threading.Event()
+        self._queue.put(('flush', done))
+        if not done.wait(timeout):
+            return False
+        dropped = self.dropped
+        if dropped > self._reported_dropped:
+            n = dropped - self._reported_dropped
+            self._reported_dropped = dropped
+            raise OpenEphysError('{} messages could not be sent to OpenEphys.'.format(n))
+        return True
+
+    def close(self):
+        """ sends the queued messages and markers, and stops the thread. """
+        if self._thread.is_alive():
+            self._queue.put(('close', None))
+            self._thread.join()
+
+    def record_start(self, uuid: str, filepath: str):
+        """ queues the messages of OpenEphysComms.record_start. """
+        self.send('Pattern file saved at: {}.'.format(filepath))
+        self.send('Pattern file uuid: {}.'.format(uuid))
+
+    def record_presentation(self, group_name: str):
+        """ queues the message of OpenEphysComms.record_presentation. """
+        self.send('Starting presentation {}'.format(group_name))
+
+    def _run(self):
+        batch = []
+        deadline = None  # time at which the batch is sent.
+        try:
+            while True:
+                timeout = None if deadline is None else max(deadline - self._clock(), 0.)
+                try:
+                    kind, item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    kind, item = 'timeout', None
+                if kind == 'marker':
+                    batch.append(item)
+                    if deadline is None:
+                        deadline = self._clock() + self.batch_interval
+                    if len(batch) < self.max_batch:
+                        continue
+                if batch:  # before the messages queued after the markers.
+                    self.batches += 1
+                    self._try_deliver(MARKER_SEPARATOR.join(batch))
+                    batch, deadline = [], None
+                if kind == 'message':
+                    self._try_deliver(item)
+                elif kind == 'flush':
+                    item.set()
+                elif kind == 'close':
+                    break
+        finally:
+            if self._sock is not None:
+                self._sock.close(linger=0)
+                self._sock = None
+
+    def _try_deliver(self, msg: str):
+        """ delivers a message, dropping it if sending raises, so that the thread keeps serving the queue. """
+        try:
+            self._deliver(msg)
+        except Exception as e:
+            self.last_error = e
+            self._dropped_sending += 1
+            if self._sock is not None:  # its state is unknown.
+                self._sock.close(linger=0)
+                self._sock = None
+
+    def _deliver(self, msg: str):
+        """ sends a message and waits for the reply, reconnecting after a timeout. """
+        for _ in range(self.retries + 1):
+            if self._sock is None:
+                self.reconnects += self._opened
+                self._opened = True
+                self._sock = _ctx.socket(zmq.REQ)
+                self._sock.connect('tcp://{}:{}'.format(self.hostname, self.port))
+            t = self._clock()
+            self._sock.send_string(msg)
+            if self._sock.poll(self.timeout_ms):
+                self._sock.recv_string()
+                self.latency_s.append(self._clock() - t)
+                self.sent += 1
+                return
+            self.timeouts += 1
+            self._sock.close(linger=0)  # the unanswered request would block the socket.
+            self._sock = None
+        self._dropped_sending += 1
+
+    def summary(self) -> dict:
+        latency = self.latency_s
+        return {
+            'sent': self.sent,
+            'markers': self.markers,
+            'batches': self.batches,
+            'dropped': self.dropped,
+            'timeouts': self.timeouts,
+            'reconnects': self.reconnects,
+            'mean_latency_ms': float(np.mean(latency)) * 1e3 if latency else 0.,
+            'max_latency_ms': float(np.max(latency)) * 1e3 if latency else 0.,
+        }
+
+    def __str__(self):
+        return 'OpenEphys: ' + ', '.join('{}={:.3g}'.format(k, v) for k, v in self.summary().items())
+
+
 class OpenEphysError(Exception):
     pass
@@ -0,0 +1,170 @@
+"""
+Logical pixel geometry of a DMD mask, shared by the pattern generators.
+"""
+
+import hashlib
+import os
+import numpy as np
+from dmdlib.randpatterns import utils
+
+
+def default_cache_dir():
+    """ directory of the geometries cached on disk, next to the mask maker configuration. """
+    if os.name == 'nt':
+        root = os.path.join(os.environ['APPDATA'], 'dmdlib')
+    else:  # assume posix
+        root = os.path.join(os.path.expanduser('~'), '.dmdlib')
+    return os.path.join(root, 'mask_geometry')
+
+
+class MaskGeometry:
+    """
+    Unmasked logical pixels and region of interest (ROI) of a mask at a scale, computed once per (mask, scale).
+
+    Only the mirrors of the ROI box (the bounding box of the unmasked logical pixels) are rendered, the rest of the
+    upload arrays is cleared. The kernels only check the mask for the mirrors of partial blocks, the logical pixels
+    that are partly masked (see utils.render_coordinates).
+
+    Attributes:
+        unmasked: boolean array (h / scale, w / scale) of the logical pixels with at least one unmasked mirror (as
+        utils.find_unmasked_px).
+        unmasked_idx: flat indices of the unmasked logical pixels.
+        full: boolean array (h / scale, w / scale) of the logical pixels whose mirrors are all unmasked.
+        box: (row start, row stop, column start, column stop) of the ROI in logical pixels.
+        mirror_box: the ROI box in mirrors.
+    """
+    _cache = {}  # key: MaskGeometry, for this process.
+    disk_cache = False  # if True, get uses default_cache_dir() unless another directory is given.
+
+    def __init__(self, mask, scale, unmasked=None, full=None):
+        """
+        :param mask: boolean mask of the DMD shape.
+        :param scale: logical pixel size in mirrors.
+        :param unmasked: precomputed unmasked array (ie from the disk cache).
+        :param full: precomputed full array.
+        """
+        utils.start_parallel_threads()  # before the generators' kernels run in worker threads.
+        self.mask = np.ascontiguousarray(mask, dtype=bool)
+        self.scale = int(scale)
+        if unmasked is None or full is None:
+            h, w = self.mask.shape[0] // self.scale, self.mask.shape[1] // self.scale
+            blocks = self.mask[:h * self.scale, :w * self.scale].reshape(h, self.scale, w, self.scale)
+            unmasked = blocks.any(axis=(1, 3))
+            full = blocks.all(axis=(1, 3))
+        self.unmasked = unmasked
+        self.full = full
+        self.unmasked_idx = np.flatnonzero(unmasked)
+        self._rows, self._cols = np.divmod(self.unmasked_idx, unmasked.shape[1])
+        self.n_unmasked = len(self.unmasked_idx)
+        rows = np.flatnonzero(unmasked.any(axis=1))
+        cols = np.flatnonzero(unmasked.any(axis=0))
+        if len(rows):
+            self.box = (int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1)
+        else:
+            self.box = (0, 0, 0, 0)
+        self.mirror_box = tuple(b * self.scale for b in self.box)
+        y0, y1, x0, x1 = self.box
+        # the mask only needs to be applied in the box if some of its blocks are partly or fully masked.
+        self._box_full = bool(full[y0:y1, x0:x1].all())
+        self._packed_mask = None
+
+    @staticmethod
+    def mask_key(mask, scale) -> str:
+        """ hash of a mask and scale. """
+        mask = np.asarray(mask, dtype=bool)
+        digest = hashlib.sha1(np.packbits(mask).tobytes())
+        digest.update('{}x{}/{}'.format(mask.shape[0], mask.shape[1], int(scale)).encode())
+        return digest.hexdigest()
+
+    @classmethod
+    def get(cls, mask, scale, cache_dir=None):
+        """
+        Returns the geometry of a mask, from the cache of this process or the cache directory if it was computed
+        before, and caches it otherwise.
+
+        :param mask: boolean mask of the DMD shape.
+        :param scale: logical pixel size in mirrors.
+        :param cache_dir: directory of the geometries cached on disk. By default, default_cache_dir() if disk_cache is
+        set (as the scripts do), otherwise the disk is not used.
+        """
+        key = cls.mask_key(mask, scale)
+        if key in cls._cache:
+            return cls._cache[key]
+        if cache_dir is None and cls.disk_cache:
+            cache_dir = default_cache_dir()
+        path = None if cache_dir is None else os.path.join(cache_dir, key + '.npz')
+        geometry = None
+        if path is not None and os.path.exists(path):
+            try:
+                with np.load(path) as cached:
+                    geometry = cls(mask, scale, cached['unmasked'], cached['full'])
+            except (OSError, KeyError, ValueError):  # unreadable, it is computed again.
+                geometry = None
+        if geometry is None:
+            geometry = cls(mask, scale)
+            if path is not None:
+                geometry._save(path)
+        cls._cache[key] = geometry
+        return geometry
+
+    def _save(self, path):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp, 'wb') as f:
+                np.savez(f, unmasked=self.unmasked, full=self.full)
+            os.replace(tmp, path)  # other processes never read a partial file.
+        except OSError:
+            pass  # the cache is only an optimization.
+
+    def scatter(self, values, seq_array_bool):
+        """
+        Writes the values of the unmasked logical pixels into frames (the other pixels are not changed).
+
+        :param values: boolean array (n_frames, n_unmasked).
+        :param seq_array_bool: boolean array (n_frames, h / scale, w / scale).
+        """
+        seq_array_bool[:, self._rows, self._cols] = values
+
+    def clear_outside(self, seq_array):
+        """
+        Clears the mirrors outside of the ROI box (whole bytes for packed arrays).
+
+        :param seq_array: upload array (n, h, w), or packed binary (n, h, w / 8) without the SXGA+ padding bytes.
+        """
+        y0, y1, x0, x1 = self.mirror_box
+        if seq_array.shape[2] < self.mask.shape[1]:
+            x0, x1 = x0 >> 3, (x1 + 7) >> 3
+        seq_array[:, :y0] = 0
+        seq_array[:, y1:] = 0
+        seq_array[:, y0:y1, :x0] = 0
+        seq_array[:, y0:y1, x1:] = 0
+
+    def render(self, seq_array_bool, seq_array):
+        """
+        Same as utils.render_sequence with the mask, but only renders the mirrors of the ROI box (the others are
+        cleared).
+
+        :param seq_array_bool: boolean array (n, h / scale, w / scale)
+        :param seq_array: uint8 array (n, h, w) or packed binary (n, h, packed row bytes).
+        """
+        y0, y1, x0, x1 = self.box
+        my0, my1, mx0, mx1 = self.mirror_box
+        if seq_array.shape[2] < self.mask.shape[1]:
+            self.clear_outside(utils.packed_rows(seq_array, self.mask.shape[1]))
+        else:
+            self.clear_outside(seq_array)
+        if y0 == y1:
+            return
+        if seq_array.shape[2] >= self.mask.shape[1]:
+            box = seq_array[:, my0:my1, mx0:mx1]
+            utils.zoomer(seq_array_bool[:, y0:y1, x0:x1], self.scale, box)
+            if not self._box_full:
+                box *= self.mask[my0:my1, mx0:mx1]
+        else:
+            # the columns of packed rows are shared by 8 mirrors, only the rows are restricted to the box.
+            packed = utils.packed_rows(seq_array, self.mask.shape[1])[:, my0:my1]
+            utils.zoomer_packed(seq_array_bool[:, y0:y1], self.scale, packed)
+            if self._packed_mask is None:
+                self._packed_mask = np.packbits(self.mask, axis=-1)
+            packed &= self._packed_mask[my0:my1, :packed.shape[2]]
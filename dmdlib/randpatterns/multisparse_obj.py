@@ -1,11 +1,10 @@
-import numba as nb
 import numpy as np
 from dmdlib.core.ALP import AlpDmd
 from dmdlib.randpatterns import utils
+from dmdlib.randpatterns.geometry import MaskGeometry
 from dmdlib.randpatterns import ephys_comms
 import os
-from dmdlib.randpatterns import saving
-from dmdlib.randpatterns.presenter import Presenter
+from dmdlib.randpatterns.presenter import presenter_from_args
 if os.name == 'nt':
     appdataroot = os.environ['APPDATA']
     appdatapath = os.path.join(appdataroot, 'dmdlib')
@@ -14,17 +13,21 @@ if os.name == 'nt':
 class MultiSparse:
     """
     Stimulus generator for sparse random patterns drawn from varying probability distributions.
+
+    The probability is switched every switch_frequency frames. Like SparseNoise, every frame (and the probability of
+    every block of frames) is drawn from its own counter-based random stream, so frames can be regenerated.
     """
-    def __init__(self, probabilities, switch_frequency, mask=None, scale=1):
+    def __init__(self, probabilities, switch_frequency, mask=None, scale=1, seed=None):
         self.random_probs = np.array(probabilities)
         self.switch_frequency = int(switch_frequency)
-        self._frame_count = 0  # saves state
         self.scale = scale
-        self._last_p = -1.
+        self.streams = utils.FrameStreams(seed)
+        self.frame_index = 0  # index of the next frame to be generated.
         if mask is not None:
             self.mask = mask
-            self.unmasked = utils.find_unmasked_px(mask, scale)
-            self.n_unmasked_pix = self.unmasked.sum()
+            self.geometry = MaskGeometry.get(mask, scale)
+            self.unmasked = self.geometry.unmasked
+            self.n_unmasked_pix = self.geometry.n_unmasked
 
     def make_patterns(self, boolean_array: np.ndarray, whole_seq_array: np.ndarray, debug):
         """
@@ -33,51 +36,45 @@ class MultiSparse:
         This makes sparse random patterns drawn from varying probability distributions.
 
         :param boolean_array: boolean array that is of shape ( n_frames, h / scale, w / scale)
-        :param whole_seq_array: array of uint8 values of shave (n_frames, h, w)
+        :param whole_seq_array: array of uint8 values of shape (n_frames, h, w), or packed binary (see AlpFrameSequence)
         :param debug: not implemented.
         """
 
         n_frames, h, w = boolean_array.shape
-        total_randnums = n_frames * self.n_unmasked_pix
-
-        probs = np.zeros(total_randnums)
-        self._frame_count = self._gen_probs(probs, self._frame_count, self.n_unmasked_pix, self.switch_frequency,
-                                            self.random_probs, self._last_p)
-        self._last_p = probs[-1]  # save this for the next iteration if we're in the middle of a presentation block.
-        a = np.random.binomial(1, probs, total_randnums)
-        utils.reshape(a, self.unmasked, boolean_array)
-        utils.zoomer(boolean_array, self.scale, whole_seq_array)
-        whole_seq_array *= self.mask
-
-    @staticmethod
-    @nb.jit
-    def _gen_probs(array, frame_count, px_per_frame, switch_freq, probabilities, last_p) -> int:
-        """
-        Generates an array of probabilities for input to the binomial.
-
-        Returns the updated frame count: framecount + pixels_generated // pixels_per frame.
-        Note that this lags by 1, because 0%anything is True, so it is iterated at the beginning of the next generation
-        cycle.
-
-        :param array: array to modify (in place)
-        :param frame_count: current number of frames that have been presented.
-        :param px_per_frame: number of pixels per frame (for defining stride)
-        :param switch_freq: number of frames prior to switching probabilities.
-        :param probabilities:
-        :param last_p:
-        :return:
-        """
+        self.frames(self.frame_index, boolean_array)
+        self.frame_index += n_frames
+        self.geometry.render(boolean_array, whole_seq_array)
 
-        n_probs = len(probabilities)
-        current_p = last_p  # this will be updated when necessary.
+    def frames(self, start, boolean_array: np.ndarray):
+        """
+        Writes the logical pixel values of frames start, start + 1, ... into boolean_array. This does not change the
+        state of the generator, so it can be used to regenerate frames (also from multiple threads).
 
-        for i_px in range(array.shape[0]):
-            if not i_px % px_per_frame:  # moving to the next frame.
-                if not frame_count % switch_freq:
-                    current_p = probabilities[np.random.randint(0, n_probs)]
-                frame_count += 1
-            array[i_px] = current_p
-        return frame_count
+        :param start: index of the first frame.
+        :param boolean_array: boolean array of shape (n_frames, h / scale, w / scale).
+        """
+        n_frames = boolean_array.shape[0]
+        randbool = np.empty((n_frames, self.n_unmasked_pix), dtype=bool)
+        randnums = np.empty(self.n_unmasked_pix)
+        for i in range(n_frames):
+            p = self.block_probability((start + i) // self.switch_frequency)
+            self.streams.frame(start + i).random(out=randnums)
+            np.less(randnums, p, out=randbool[i])
+        self.geometry.scatter(randbool, boolean_array)
+
+    def block_probability(self, block):
+        """ probability used for a block of switch_frequency frames. """
+        i = self.streams.frame(block, substream=1).integers(len(self.random_probs))
+        return self.random_probs[i]
+
+    def params(self) -> dict:
+        """ parameters needed to regenerate the patterns of this generator (with the mask). """
+        return {'generator': 'MultiSparse', 'seed': self.streams.seed, 'probabilities': self.random_probs.tolist(),
+                'switch_frequency': self.switch_frequency, 'scale': self.scale}
+
+    @classmethod
+    def from_params(cls, params: dict, mask):
+        return cls(params['probabilities'], params['switch_frequency'], mask, params['scale'], params['seed'])
 
 
 def main():
@@ -88,6 +85,7 @@ def main():
     parser.add_argument('--switch_freq', type=int, default=500,
                         help='number of frames between switching stimulus probabilities.')
     args = parser.parse_args()
+    MaskGeometry.disk_cache = True  # reuses the geometry of the mask across sessions.
     frac = args.fraction_on
 
     if any([x > 1. or x < 0. for x in frac]):
@@ -100,29 +98,36 @@ def main():
         raise FileExistsError(errst)
 
     mask = np.load(args.maskfile)
-    generator = MultiSparse(frac, args.switch_freq, mask, args.scale)
+    generator = MultiSparse(frac, args.switch_freq, mask, args.scale, args.seed)
 
     presentations_per = min([60000, args.nframes])
 
     if not args.no_phys:
-        openephys = ephys_comms.OpenEphysComms()
+        openephys = ephys_comms.OpenEphysChannel()
 
     n_runs = int(np.ceil(args.nframes / presentations_per))
     assert n_runs > 0
-    with saving.HfiveSaver(fullpath, args.overwrite) as saver, AlpDmd() as dmd:
+    with utils.make_saver(args, fullpath, logical_mask=generator.unmasked) as saver, \
+            utils.make_dmd(args) as dmd:
         saver.store_mask_array(mask)
+        saver.store_generator_params(generator.params())
         uuid = saver.uuid
         if not args.no_phys:
             openephys.record_start(uuid, fullpath)
-        run_id = saver.current_group_id
-        for i in range(n_runs):
+            openephys.flush()  # raises OpenEphysError if OpenEphys does not reply.
+
+        def run_start(i, run_id):
             print("Starting presentation run {} of {} ({}).".format(i + 1, n_runs, run_id))
             if not args.no_phys:
                 openephys.record_presentation(run_id)
-            presenter = Presenter(dmd, generator, saver, presentations_per, image_scale=args.scale,
-                                  picture_time=args.pic_time, )
-            presenter.run()
-            run_id = saver.iter_pattern_group()
+
+        # the runs are presented in one session, without stopping the projection between them.
+        presenter = presenter_from_args(args, dmd, generator, saver, presentations_per,
+                                        markers=None if args.no_phys else openephys)
+        presenter.run_session(n_runs, on_run_start=run_start)
+    if not args.no_phys:
+        openephys.close()
+        print(openephys)
 
 
 
@@ -2,7 +2,12 @@ from dmdlib.core.ALP import *
 import numpy as np
 from tqdm import tqdm
 import time
+import queue
+import threading
 from .saving import HfiveSaver
+from .autotune import autotune
+from .projection import ProjectionLog, ProjectionMonitor
+from .buffers import BufferPool, StagingBuffer
 
 
 class Presenter:
@@ -10,7 +15,8 @@ class Presenter:
     Manages coordination of pattern generation, upload, and saving.
     """
     def __init__(self, dmd: AlpDmd, pattern_generator, saver: HfiveSaver, total_presentations=-1,
-                 nseqs=3, pix_per_seq=250, nbits=1, picture_time=10000, image_scale=4, seq_debug=False):
+                 nseqs=3, pix_per_seq=250, nbits=1, picture_time=10000, image_scale=4, seq_debug=False, packed=False,
+                 poll_interval=.1, max_nseqs=None, monitor=True, staging_buffers=3, markers=None):
         """
         :param dmd: AlpDmd object
         :param save_path: path to savefile. This file should exist!!
@@ -23,54 +29,199 @@ class Presenter:
         :param picture_time: time in microseconds to display each frame.
         :param image_scale: defines the logical pixel size for the random patterns relative to the physical DMD pixels.
         :param seq_debug: Passed to sequence generator.
+        :param packed: upload 1-bit sequences as packed binary data (8 mirrors per byte). The pattern generator then
+        writes packed rows (see utils.render_sequence).
+        :param poll_interval: time in seconds between checks of the projection progress. With the monitor, this is the
+        longest time between checks.
+        :param max_nseqs: if larger than nseqs, a sequence is added during the run (up to max_nseqs) whenever the
+        frames left in the device queue are displayed faster than the last refresh took. See autotune.autotune for
+        choosing nseqs, pix_per_seq and max_nseqs.
+        :param monitor: poll the projection progress in a ProjectionMonitor thread, which wakes the presentation loop
+        when a sequence has finished. If False, the loop polls every poll_interval.
+        :param staging_buffers: number of buffers that sequences are generated into (see buffers.BufferPool). A buffer
+        is reused when its sequence is uploaded and saved, so this bounds the sequences waiting to be written.
+        :param markers: object with a non-blocking mark(text) method (ie ephys_comms.OpenEphysChannel), which is sent
+        a marker when each sequence starts to be displayed: 'Sequence <group>/<leaf> queue <queue id> onset <time>',
+        with the time in seconds of the projection log.
         """
         self.dmd = dmd
         dmd.proj_mode('master')
+        dmd.seq_queue_mode()  # sequences are enqueued several ahead, the legacy mode only has one waiting position.
         self.saver = saver
         self.pattern_generator = pattern_generator
         self._last_upload_num = 0
         self.image_scale = image_scale
         self._sequence_freshness = {}
         self.pix_per_seq = pix_per_seq
+        self.packed = packed
+        self.nbits = nbits
+        self.picture_time = picture_time
+        self.max_nseqs = max(nseqs, max_nseqs or 0)
+        self.sequences_added = 0
+        self._refresh_s = 0.  # time the last refresh took.
         self.sequences = self._setup_sequences(nseqs, nbits, pix_per_seq, picture_time)
-        self.seq_array_bool = np.zeros(
-            (pix_per_seq, self.dmd.h // self.image_scale, self.dmd.w // self.image_scale), dtype=bool
-        )
+        self.buffers = BufferPool(staging_buffers, self._make_buffer)
         self.sequence_counter = 0
         self.total_presentations = total_presentations
         self.dmd_proj_status = None
         self.frames_presented = 0
         self.seq_debug = seq_debug
+        self.poll_interval = poll_interval
+        self.projection_log = None  # type: ProjectionLog
+        self.use_monitor = monitor
+        self.monitor = None  # type: ProjectionMonitor
+        self._uploaded_leaf = {}  # sequence id: leaf of the upload it holds.
+        self._uploaded_run = {}  # sequence id: run of the upload it holds.
+        self.n_runs = 1
+        self._seqs_per_run = 0
+        self._run_groups = []  # pattern group of each run that has been uploaded to.
+        self._displayed_run = 0
+        self._on_run_start = None
+        self._save_stalls_reported = len(saver.queue_stats.stalls)
+        self.markers = markers
+        self._marked_queue_id = None
 
     def run(self):
         """
-        starts a run.
+        starts a run. The onset and offset frames of the sequences, and any underruns, late uploads and duplicated
+        sequences, are saved with the saver's store_projection_log at the end (see projection.ProjectionLog), and the
+        host times of the displayed frames with store_frame_timestamps (see projection.FrameClock).
         """
+        self.run_session(1)
+
+    def run_session(self, n_runs, on_run_start=None):
+        """
+        Presents n_runs runs of total_presentations frames each without stopping the projection, reusing the allocated
+        sequences. Each run is saved to its own pattern group: the saver moves to the next group (iter_pattern_group)
+        before the first upload of a run, so the next run is queued behind the end of the current one and the
+        transition costs no frames. The projection log of each run is saved to its group at the end of the session.
+
+        :param n_runs: number of runs.
+        :param on_run_start: function called with the run index and its pattern group name when the run starts to be
+        displayed (for the first run, before the projection starts), ie to send markers to the recording system.
+        """
+        self.n_runs = n_runs
+        self._seqs_per_run = max(int(np.ceil(self.total_presentations / self.pix_per_seq)), 0)
+        self._run_groups = [self.saver.current_group_id]
+        self._displayed_run = 0
+        self._on_run_start = on_run_start
+        self._marked_queue_id = None
+        if on_run_start is not None:
+            on_run_start(0, self._run_groups[0])
+        self.projection_log = ProjectionLog(self.picture_time)
+        if self.use_monitor:
+            self.monitor = ProjectionMonitor(self.dmd, max_interval=self.poll_interval,
+                                             on_poll=self.projection_log.update, on_transition=self._mark_displayed)
         self._upload_initial_sequences()
         for s in sorted(self.sequences.values()):  # start in order.
-            s.start_projection()
+            self._start_sequence(s)
+        try:
+            if self.monitor is not None:
+                self.monitor.start()
+            self._present()
+        finally:
+            if self.monitor is not None:
+                self.monitor.stop()
+        self._update_projector_progress()
+        self._run_displayed(len(self._run_groups) - 1)
+        self.projection_log.finish()
+        attributes = self.projection_log.timestamp_attributes()
+        for run, group in enumerate(self._run_groups):
+            self.saver.store_projection_log(self.projection_log.sequences(run), self.projection_log.events(run), group)
+            self.saver.store_frame_timestamps(self.projection_log.timestamps(run), attributes, group)
+        summary = self.projection_log.summary()
+        if summary['underruns'] or summary['late_uploads'] or summary['duplicates']:
+            print(self.projection_log)
+        print(self.projection_log.frame_clock)
+        print(self.saver.queue_stats)
+        print(self.buffers)
+        if self.monitor is not None:
+            print(self.monitor)
 
-        with tqdm(total=self.total_presentations, desc='Presenting images', unit='img') as pbar:
-            while self.dmd.projecting == ALP_PROJ_ACTIVE:
+    def _present(self):
+        """ presentation loop: refreshes the sequences that have been displayed until all frames are uploaded. """
+        transitions = 0
+        n_uploads = self._seqs_per_run * self.n_runs
+        with tqdm(total=self.total_presentations * self.n_runs, desc='Presenting images', unit='img') as pbar:
+            # the queue can run empty (underrun) before all frames are uploaded, the run continues.
+            while self.dmd.projecting == ALP_PROJ_ACTIVE or self.sequence_counter < n_uploads:
                 # update progress bar:
                 progress_struct = self._update_projector_progress()
+                idle = progress_struct.nFlags & ALP_FLAG_QUEUE_IDLE
                 frames_uploaded_total = self.sequence_counter * self.pix_per_seq
-                frames_in_buffer = (progress_struct.nWaitingSequences + 1) * self.pix_per_seq
+                frames_in_buffer = 0 if idle else (progress_struct.nWaitingSequences + 1) * self.pix_per_seq
                 _frames_presented = frames_uploaded_total - frames_in_buffer
                 pbar.update(_frames_presented - self.frames_presented)
                 self.frames_presented = _frames_presented
+                if not idle:
+                    self._run_displayed(self._uploaded_run.get(progress_struct.SequenceId, 0))
 
                 # upload new frame sequences:
-                if frames_uploaded_total < self.total_presentations:
-                    refresh = self._gen_refresh(progress_struct.SequenceId)
+                if self.sequence_counter < n_uploads:
+                    refresh = self._gen_refresh(None if idle else progress_struct.SequenceId)
+                    if refresh and self._queue_draining(progress_struct):
+                        added = self._add_sequence()
+                        if added is not None:
+                            refresh.insert(0, added)
+                            pbar.write('Sequence queue is draining, added a sequence ({} in total).'.format(
+                                len(self.sequences)))
                     for seq_id in refresh:
+                        if self.sequence_counter >= n_uploads:  # an added sequence may complete the session.
+                            break
                         seq = self.sequences[seq_id]  #type: AlpFrameSequence
+                        t = time.perf_counter()
                         self.update_sequence(seq)
-                        seq.start_projection()
+                        self._start_sequence(seq)
+                        self._refresh_s = time.perf_counter() - t
+                        self._report_save_stalls(pbar)
                         self._update_projector_progress()  # call this often to make sure we don't miss a sequence.
-                time.sleep(.1)  # sleep for 100 ms
+                if self.monitor is not None:
+                    transitions = self.monitor.wait(transitions, self.poll_interval)
+                else:
+                    time.sleep(self.poll_interval)
             pbar.update(self.pix_per_seq)
 
+    def _report_save_stalls(self, pbar):
+        """ reports the stalls of the presentation loop that the save queue caused since the last report. """
+        stalls = self.saver.queue_stats.stalls
+        for in_flight, stall_s in stalls[self._save_stalls_reported:]:
+            pbar.write('Saving fell behind: waited {:.0f} ms for {:.0f} MB of queued writes to complete.'.format(
+                stall_s * 1e3, in_flight / 2 ** 20))
+        self._save_stalls_reported = len(stalls)
+
+    def _start_sequence(self, sequence: AlpFrameSequence):
+        """ enqueues a sequence for display and registers it in the projection log. """
+        sequence.start_projection()
+        self.projection_log.enqueued(self._uploaded_leaf[int(sequence)], int(sequence), self.dmd.queue_id,
+                                     self.pix_per_seq, self._uploaded_run[int(sequence)])
+        if self.monitor is not None:
+            self.monitor.kick()  # the queue may have been empty.
+
+    def _run_displayed(self, run):
+        """ calls on_run_start for the runs up to run, which have started to be displayed. """
+        while self._displayed_run < run:
+            self._displayed_run += 1
+            if self._on_run_start is not None:
+                self._on_run_start(self._displayed_run, self._run_groups[self._displayed_run])
+
+    def _mark_displayed(self, progress):
+        """ called by the monitor thread when a sequence starts to be displayed: it is due to be refreshed. """
+        self._mark_onset(progress)
+        if not progress.nFlags & ALP_FLAG_QUEUE_IDLE and progress.SequenceId in self._sequence_freshness:
+            self._sequence_freshness[progress.SequenceId] = False
+
+    def _mark_onset(self, progress):
+        """ sends a marker if a sequence has started to be displayed since the last one (before it is refreshed). """
+        if self.markers is None or progress.nFlags & ALP_FLAG_QUEUE_IDLE:
+            return
+        if progress.CurrentQueueId == self._marked_queue_id or progress.SequenceId not in self._uploaded_leaf:
+            return
+        self._marked_queue_id = progress.CurrentQueueId
+        seq_id = progress.SequenceId
+        self.markers.mark('Sequence {}/{} queue {} onset {:.6f}'.format(
+            self._run_groups[self._uploaded_run[seq_id]], self._uploaded_leaf[seq_id], progress.CurrentQueueId,
+            self.projection_log.now()))
+
     def _update_projector_progress(self):
         """
         Routine to check the projector to see which sequence is currently in process of presentation. Once it is being
@@ -79,6 +230,9 @@ class Presenter:
 
         unfresh = 0
         progress = self.dmd.get_projecting_progress()
+        if self.projection_log is not None and self.monitor is None:  # the monitor updates the log otherwise.
+            self.projection_log.update(progress)
+            self._mark_onset(progress)
         curr_seq = progress.SequenceId
         try:
             self._sequence_freshness[curr_seq] = False
@@ -90,6 +244,33 @@ class Presenter:
                 raise e
         return progress
 
+    def _queue_draining(self, progress) -> bool:
+        """
+        Returns True if the frames left in the device queue will be displayed before a refresh completes.
+
+        :param progress: AlpProjProgress of the projection.
+        """
+        frames_left = progress.nWaitingSequences * self.pix_per_seq + progress.nFrameCounter
+        return frames_left * self.picture_time * 1e-6 < self._refresh_s + self.poll_interval
+
+    def _add_sequence(self):
+        """
+        Allocates another sequence if max_nseqs and the device memory allow it. It is stale, so the caller has to
+        update it.
+
+        :return: id of the new sequence, or None.
+        """
+        if len(self.sequences) >= self.max_nseqs or self.dmd.avail_memory < self.nbits * self.pix_per_seq:
+            return None
+        margin, min_diff = self._pulse_spacing(self.picture_time, self.max_nseqs)
+        existing = [s.syncpulsewidth for s in self.sequences.values()]
+        pw, = self._make_seq_pulse_lens(1, self.picture_time - margin, min_val=min_diff, min_diff=min_diff,
+                                        existing=existing)
+        seq = self._alloc_sequence(self.nbits, self.pix_per_seq, self.picture_time, pw)
+        self.sequences[int(seq)] = seq
+        self.sequences_added += 1
+        return int(seq)
+
     def _gen_refresh(self, current_sequence_id):
         """
         Helper function that generates a list of sequences that is due to be refreshed.
@@ -114,35 +295,116 @@ class Presenter:
         :param sequence: AlpFrameSequence to upload to.
         """
 
-        self.pattern_generator.make_patterns(self.seq_array_bool, sequence.array, self.seq_debug)
-        sid = int(sequence)
-        seq_meta_dict = {
+        self._start_upload()
+        buffer = self.buffers.acquire()
+        try:
+            first_frame = getattr(self.pattern_generator, 'frame_index', None)
+            self.pattern_generator.make_patterns(buffer.patterns, buffer.frames, self.seq_debug)
+            save_array = self._save_array(buffer.patterns, first_frame)
+            self._store_sequence(buffer, save_array, self._sequence_metadata(sequence, first_frame))
+            sequence.upload_array(buffer.frames, copy=False)
+        finally:
+            buffer.release()
+        self._sequence_uploaded(sequence)
+
+    def _make_buffer(self):
+        """ returns the logical patterns and frames arrays of a staging buffer. """
+        patterns = np.zeros((self.pix_per_seq, self.dmd.h // self.image_scale, self.dmd.w // self.image_scale),
+                            dtype=bool)
+        return patterns, self.dmd.make_sequence_array(self.pix_per_seq, self.packed)
+
+    def _store_sequence(self, buffer: StagingBuffer, save_array, metadata):
+        """ saves a sequence. If the saver gets the buffer's patterns, the buffer is held until they are written. """
+        if save_array is buffer.patterns:
+            buffer.retain()
+            try:
+                self.saver.store_sequence_array(save_array, metadata, on_written=buffer.release)
+            except BaseException:
+                buffer.release()
+                raise
+        else:
+            self.saver.store_sequence_array(save_array, metadata)
+
+    def _upload_run(self, upload):
+        """ returns the run of an upload (index in the session). Extra initial uploads belong to the last run. """
+        if not self._seqs_per_run:
+            return 0
+        return min(upload // self._seqs_per_run, self.n_runs - 1)
+
+    def _start_upload(self):
+        """ moves the saver to the next pattern group if the next upload is the first of a run. """
+        run = self._upload_run(self.sequence_counter)
+        if 0 < run == len(self._run_groups):
+            self._run_groups.append(self.saver.iter_pattern_group())
+
+    def _sequence_uploaded(self, sequence: AlpFrameSequence):
+        """ marks a sequence as fresh, holding the last saved sequence. """
+        run = self._upload_run(self.sequence_counter)
+        self._sequence_freshness[int(sequence)] = True
+        self._uploaded_run[int(sequence)] = run
+        self._uploaded_leaf[int(sequence)] = self.sequence_counter - run * self._seqs_per_run
+        self.sequence_counter += 1
+
+    def _sequence_metadata(self, sequence: AlpFrameSequence, first_frame=None) -> dict:
+        """ metadata saved with each sequence's patterns. """
+        meta = {
             'sync_pulse_dur_us': sequence.syncpulsewidth,
-            'seq_id': sid,
+            'seq_id': int(sequence),
             'image_scale': self.image_scale,
             'picture_time_us': sequence.picturetime
         }
-        self.saver.store_sequence_array(self.seq_array_bool.astype(bool), seq_meta_dict)  # watch out when
-        sequence.upload_array()
-        self._sequence_freshness[sid] = True
-        self.sequence_counter += 1
+        if first_frame is not None:  # seeded generators can regenerate frames from their index.
+            meta['first_frame'] = first_frame
+        return meta
+
+    def _save_array(self, seq_array_bool, first_frame):
+        """
+        Returns the array to pass to the saver: the patterns themselves (not a copy, see _store_sequence), or the
+        indices of the frames if the saver does not save frames. Generators that make coordinate lists
+        (last_coordinates) hand them to savers that accept them instead of the patterns. This must be called right
+        after make_patterns.
+        """
+        if self.saver.save_frames:
+            coordinates = getattr(self.pattern_generator, 'last_coordinates', None)
+            if coordinates is not None and self.saver.accepts_coordinates:
+                return coordinates  # a new list is made for each sequence.
+            return seq_array_bool
+        if first_frame is None:
+            raise ValueError('The saver only saves frame indices, but the pattern generator has no frame index.')
+        return np.arange(first_frame, first_frame + len(seq_array_bool))
 
     def _setup_sequences(self, nseqs, nbits, pix_per_seq, picture_time):
         seqs = {}
-        seq_pulse_lens = self._make_seq_pulse_lens(nseqs, picture_time - 500)
+        # spaced for max_nseqs, so that sequences added during the run get distinct pulse widths.
+        margin, min_diff = self._pulse_spacing(picture_time, max(nseqs, self.max_nseqs))
+        seq_pulse_lens = self._make_seq_pulse_lens(nseqs, picture_time - margin, min_val=min_diff, min_diff=min_diff)
         for i in range(nseqs):
-            seq = self.dmd.seq_alloc(nbits, pix_per_seq)
-            seqid = seq.seq_id.value
-            seqs[seqid] = seq
-            pw = seq_pulse_lens[i]
-            seq.set_timing(picturetime=picture_time, syncpulsewidth=pw)
-            self._sequence_freshness[seqid] = False
-            if nbits == 1:
-                self.dmd._AlpSeqControl(seq.seq_id, ALP_BIN_MODE, ALP_BIN_UNINTERRUPTED)
+            seq = self._alloc_sequence(nbits, pix_per_seq, picture_time, seq_pulse_lens[i])
+            seqs[int(seq)] = seq
         return seqs
 
+    def _alloc_sequence(self, nbits, pix_per_seq, picture_time, pulse_width) -> AlpFrameSequence:
+        """ allocates a stale sequence with its timing. """
+        seq = self.dmd.seq_alloc(nbits, pix_per_seq, self.packed)
+        seqid = seq.seq_id.value
+        seq.set_timing(picturetime=picture_time, syncpulsewidth=pulse_width)
+        self._sequence_freshness[seqid] = False
+        if nbits == 1:
+            self.dmd._AlpSeqControl(seq.seq_id, ALP_BIN_MODE, ALP_BIN_UNINTERRUPTED)
+        return seq
+
+    @staticmethod
+    def _pulse_spacing(picture_time, nseqs):
+        """
+        Returns (margin, min_diff): pulse widths must fit within the picture time, so the spacing is reduced for short
+        picture times.
+        """
+        margin = min(500, picture_time // 4)
+        min_diff = min(100, (picture_time - margin) // (2 * nseqs))
+        return margin, min_diff
+
     @staticmethod
-    def _make_seq_pulse_lens(n_vals, max_val, min_val=100, min_diff=100):
+    def _make_seq_pulse_lens(n_vals, max_val, min_val=100, min_diff=100, existing=()):
         """
         Makes a "random" list of integers between min_time and max_time and ensures that each value spaced at least min_diff
         away from all the other values.
@@ -151,6 +413,7 @@ class Presenter:
         :param max_val: maximum value that any number in the list can have
         :param min_val: minimum value that any number in the list can have
         :param min_diff: all values must be at least this far apart from each other.
+        :param existing: pulse lengths already in use, the new values are spaced from these as well.
         :return: list of pulse lengths.
         """
 
@@ -165,7 +428,7 @@ class Presenter:
             good = False
             while not good:
                 val = np.random.randint(min_val, max_val)
-                good = distance_checker(val, pulse_lens, min_diff)
+                good = distance_checker(val, pulse_lens + list(existing), min_diff)
             pulse_lens.append(val)
         return pulse_lens
 
@@ -175,3 +438,247 @@ class Presenter:
 
     def __del__(self):
         self.shutdown()
+
+
+class PipelinedPresenter(Presenter):
+    """
+    Presenter that generates patterns in a worker thread, running up to read_ahead sequences ahead of the upload. The
+    presentation loop only saves, uploads and enqueues sequences that are ready. The staging buffers are shared with
+    the worker, so there are at least read_ahead + 2 of them.
+
+    Stall counters and timings for both stages are kept in the stats attribute (PipelineStats). If the presentation
+    loop stalls, pattern generation is limiting the frame rate; if the generator stalls, upload or projection is.
+    """
+    def __init__(self, *args, read_ahead=3, **kwargs):
+        """
+        Takes the same parameters as Presenter, and:
+
+        :param read_ahead: number of generated sequences that can wait for upload.
+        """
+        # one more is being filled by the worker while the queue is full, and one is being uploaded.
+        kwargs['staging_buffers'] = max(kwargs.get('staging_buffers', 0), read_ahead + 2)
+        super(PipelinedPresenter, self).__init__(*args, **kwargs)
+        self.read_ahead = read_ahead
+        self.stats = PipelineStats()
+        self._ready = queue.Queue(maxsize=read_ahead)
+        self._stop = threading.Event()
+        self._worker = None
+        self._n_generated = 0  # sequences the worker makes in this session.
+        self._n_taken = 0
+
+    def run_session(self, n_runs, on_run_start=None):
+        """
+        starts a session (see Presenter.run_session).
+        """
+        n_sequences = max(len(self.sequences), int(np.ceil(self.total_presentations / self.pix_per_seq)) * n_runs)
+        self._stop.clear()
+        self._n_generated, self._n_taken = n_sequences, 0
+        self._worker = threading.Thread(target=self._generate, args=(n_sequences,), daemon=True)
+        self._worker.start()
+        try:
+            super(PipelinedPresenter, self).run_session(n_runs, on_run_start)
+        finally:
+            self._stop.set()
+            self._worker.join()
+            while not self._ready.empty():  # generated beyond the end of the session.
+                item = self._ready.get()
+                if not isinstance(item, Exception):
+                    item[0].release()
+        print(self.stats)
+
+    def _generate(self, n_sequences):
+        """
+        Worker thread: fills free buffers with patterns and puts them in the ready queue.
+        """
+        try:
+            for _ in range(n_sequences):
+                buffer = self.buffers.acquire()
+                t = time.perf_counter()
+                first_frame = getattr(self.pattern_generator, 'frame_index', None)
+                self.pattern_generator.make_patterns(buffer.patterns, buffer.frames, self.seq_debug)
+                save_array = self._save_array(buffer.patterns, first_frame)
+                self.stats.generate_s.append(time.perf_counter() - t)
+                if not self._put_ready((buffer, save_array, first_frame)):
+                    buffer.release()
+                    return
+        except Exception as e:  # raised in the presentation thread.
+            self._put_ready(e)
+
+    def _put_ready(self, item) -> bool:
+        """ puts item in the ready queue, waiting while it is full. Returns False if the run is stopped. """
+        t = time.perf_counter()
+        stalled = False
+        while not self._stop.is_set():
+            try:
+                self._ready.put(item, timeout=.05)
+                if stalled:
+                    self.stats.generator_stalls += 1
+                    self.stats.generator_stall_s += time.perf_counter() - t
+                return True
+            except queue.Full:
+                stalled = True
+        return False
+
+    def update_sequence(self, sequence: AlpFrameSequence):
+        """
+        Saves and uploads the next generated sequence.
+
+        :param sequence: AlpFrameSequence to upload to.
+        """
+        self.stats.queue_depths.append(self._ready.qsize())
+        t = time.perf_counter()
+        if self._ready.empty():
+            self.stats.upload_stalls += 1
+        item = self._next_ready()
+        self.stats.upload_wait_s += time.perf_counter() - t
+        if isinstance(item, Exception):
+            raise item
+        self._start_upload()
+        buffer, save_array, first_frame = item
+        try:
+            self._store_sequence(buffer, save_array, self._sequence_metadata(sequence, first_frame))
+            t = time.perf_counter()
+            sequence.upload_array(buffer.frames, copy=False)
+            self.stats.upload_s.append(time.perf_counter() - t)
+        finally:
+            buffer.release()
+        self._sequence_uploaded(sequence)
+
+    def _next_ready(self):
+        """ takes the next item from the ready queue, raising instead of waiting for one that will never come. """
+        if self._n_taken >= self._n_generated:
+            raise RuntimeError('All {} sequences of the session have been uploaded.'.format(self._n_generated))
+        while True:
+            try:
+                item = self._ready.get(timeout=.05)
+                break
+            except queue.Empty:
+                if self._worker is None or not self._worker.is_alive():
+                    try:  # it may have put its last item just before it stopped.
+                        item = self._ready.get_nowait()
+                        break
+                    except queue.Empty:
+                        raise RuntimeError('The pattern generation thread stopped before generating the '
+                                           'sequence.') from None
+        self._n_taken += 1
+        return item
+
+
+class PipelineStats:
+    """
+    Counters and timings of the PipelinedPresenter stages.
+    """
+    def __init__(self):
+        self.generate_s = []  # time to generate each sequence.
+        self.upload_s = []  # time to upload each sequence.
+        self.queue_depths = []  # number of ready sequences when an upload is due.
+        self.upload_stalls = 0  # uploads that had to wait for generation.
+        self.upload_wait_s = 0.
+        self.generator_stalls = 0  # generated sequences that had to wait for a free queue position.
+        self.generator_stall_s = 0.
+
+    def summary(self) -> dict:
+        return {
+            'sequences': len(self.upload_s),
+            'mean_generate_s': float(np.mean(self.generate_s)) if self.generate_s else 0.,
+            'mean_upload_s': float(np.mean(self.upload_s)) if self.upload_s else 0.,
+            'mean_queue_depth': float(np.mean(self.queue_depths)) if self.queue_depths else 0.,
+            'upload_stalls': self.upload_stalls,
+            'upload_wait_s': self.upload_wait_s,
+            'generator_stalls': self.generator_stalls,
+            'generator_stall_s': self.generator_stall_s,
+        }
+
+    def __str__(self):
+        return 'Pipeline: ' + ', '.join('{}={:.3g}'.format(k, v) for k, v in self.summary().items())
+
+
+class FlutPresenter(Presenter):
+    """
+    Presenter that uploads a bank of patterns once and then only writes the display order of each sequence into the
+    frame look-up table (FLUT) of the device.
+
+    Every sequence holds the whole bank and reads its pix_per_seq frames from its own region of the FLUT, so a region
+    can be rewritten while the other sequences are displayed. The pattern generator must provide:
+        bank_size: number of patterns in the bank.
+        make_bank(boolean_array, seq_array): writes the logical patterns and the rendered bank for upload.
+        make_indices(index_array): writes the bank indices of the next frames.
+    The bank is saved once (saver.store_pattern_bank), and each sequence is saved as its bank indices.
+    """
+    def __init__(self, dmd: AlpDmd, pattern_generator, saver: HfiveSaver, total_presentations=-1, nseqs=3,
+                 pix_per_seq=None, **kwargs):
+        """
+        Takes the same parameters as Presenter, except:
+
+        :param pix_per_seq: frames displayed per sequence. By default, the FLUT is divided evenly between the
+        sequences.
+        """
+        bank_size = pattern_generator.bank_size
+        self.flut_bits = 9 if bank_size <= 2 ** 9 else 18
+        units = 1 if self.flut_bits == 9 else 2  # FLUT offsets and sizes are set in 9-bit entries.
+        region = (dmd.flut_max_entries // nseqs) // 256 * 256
+        if region == 0:
+            raise ValueError('The FLUT is too small for {} sequences.'.format(nseqs))
+        if pix_per_seq is None:
+            pix_per_seq = region // units
+        elif pix_per_seq * units > region:
+            raise ValueError('At most {} frames per sequence fit in the FLUT with {} sequences.'.format(
+                region // units, nseqs))
+        self._flut_region = region // units
+        self._flut_offsets = {}
+        self.bank_size = bank_size
+        super(FlutPresenter, self).__init__(dmd, pattern_generator, saver, total_presentations, nseqs=nseqs,
+                                            pix_per_seq=pix_per_seq, **kwargs)
+
+    def _add_sequence(self):
+        return None  # the FLUT is divided between the sequences when they are set up.
+
+    def _setup_sequences(self, nseqs, nbits, pix_per_seq, picture_time):
+        seqs = super(FlutPresenter, self)._setup_sequences(nseqs, nbits, self.bank_size, picture_time)
+        for i, seq in enumerate(sorted(seqs.values())):
+            self._flut_offsets[int(seq)] = i * self._flut_region
+            seq.set_flut(pix_per_seq, self._flut_offsets[int(seq)], self.flut_bits)
+        return seqs
+
+    def _upload_initial_sequences(self):
+        bank_bool = np.zeros((self.bank_size, self.dmd.h // self.image_scale, self.dmd.w // self.image_scale),
+                             dtype=bool)
+        bank = self.dmd.make_sequence_array(self.bank_size, self.packed)
+        self.pattern_generator.make_bank(bank_bool, bank)
+        self.saver.store_pattern_bank(bank_bool)
+        for s in tqdm(self.sequences.values(), desc="Uploading pattern bank", unit='seq'):  #type: AlpFrameSequence
+            s.upload_array(bank, copy=False)
+        for s in self.sequences.values():
+            self.update_sequence(s)
+
+    def update_sequence(self, sequence: AlpFrameSequence):
+        """
+        Writes the display order of the next frames into the sequence's FLUT region.
+
+        :param sequence: AlpFrameSequence to update.
+        """
+        self._start_upload()
+        first_frame = getattr(self.pattern_generator, 'frame_index', None)
+        indices = np.zeros(self.pix_per_seq, dtype=np.int64)
+        self.pattern_generator.make_indices(indices)
+        self.dmd.flut_write(indices, self._flut_offsets[int(sequence)], self.flut_bits)
+        self.saver.store_sequence_array(indices, self._sequence_metadata(sequence, first_frame))
+        self._sequence_uploaded(sequence)
+
+
+def presenter_from_args(args, dmd: AlpDmd, pattern_generator, saver: HfiveSaver, total_presentations,
+                        markers=None) -> Presenter:
+    """
+    Makes a Presenter (or PipelinedPresenter) for the command line arguments parsed by utils.setup_parser. With
+    --autotune, the sequences are set up from measured generation and upload times (see autotune.autotune).
+
+    :param markers: see Presenter.
+    """
+    kwargs = dict(image_scale=args.scale, picture_time=args.pic_time, packed=args.packed, markers=markers)
+    if args.autotune:
+        kwargs.update(autotune(dmd, pattern_generator, args.pic_time, args.scale, args.packed,
+                               pipelined=bool(args.read_ahead)))
+    if args.read_ahead:
+        return PipelinedPresenter(dmd, pattern_generator, saver, total_presentations, read_ahead=args.read_ahead,
+                                  **kwargs)
+    return Presenter(dmd, pattern_generator, saver, total_presentations, **kwargs)
@@ -0,0 +1,522 @@
+"""
+Bookkeeping of the sequences that the device displays, from polls of the projection progress (AlpProjProgress), a
+model of the host time at which each frame is displayed, and a monitor thread that polls the progress around the
+sequence boundaries.
+"""
+
+import time
+import threading
+from collections import deque
+import numpy as np
+from dmdlib.core._alp_defns import ALP_FLAG_QUEUE_IDLE, ALP_FLAG_SEQUENCE_INDEFINITE, AlpProjProgress
+
+# times are in seconds from the start of the log. Frames are counted in display order, repeats included.
+SEQUENCE_DTYPE = np.dtype([
+    ('leaf', np.int32),  # saved sequence (leaf of the pattern group).
+    ('seq_id', np.int32),  # device sequence.
+    ('queue_id', np.int64),
+    ('n_frames', np.int32),  # frames per repetition.
+    ('repeats', np.int32),  # times the sequence was displayed.
+    ('enqueued_s', np.float64),  # host time of AlpProjStart.
+    ('onset_s', np.float64),  # estimated host time of the first frame.
+    ('onset_frame', np.int64),  # index of the first displayed frame.
+    ('offset_frame', np.int64),  # index after the last displayed frame.
+    ('gap_frames', np.int32),  # picture times without display before the onset (underrun).
+    ('late', np.bool_),  # enqueued after the previous sequence had finished.
+    ('observed', np.bool_),  # seen displayed by a poll. If not, the onset is inferred from the previous sequence.
+])
+
+# host times are time.perf_counter_ns, which other processes on the host can read to align their data.
+TIMESTAMP_DTYPE = np.dtype([
+    ('leaf', np.int32),
+    ('onset_frame', np.int64),
+    ('n_frames', np.int64),  # displayed frames, repeats included.
+    ('onset_ns', np.int64),  # modelled host time of the first frame.
+    ('interval_ns', np.float64),  # modelled time between frames.
+    ('segment', np.int32),  # display segment (see FrameClock).
+])
+
+EVENT_KINDS = ('underrun', 'late_upload', 'duplicate')
+EVENT_DTYPE = np.dtype([
+    ('kind', 'S16'),  # one of EVENT_KINDS.
+    ('leaf', np.int32),  # sequence the event applies to.
+    ('frame', np.int64),  # displayed frame index at which it happens.
+    ('n_frames', np.int64),  # picture times of an underrun, or frames displayed again for a duplicate.
+    ('t_s', np.float64),
+])
+
+
+class ProjectionLog:
+    """
+    Keeps the onset and offset frame of every enqueued sequence, and detects:
+        underrun: the device queue ran empty before the sequence started, so frames were missing for gap_frames
+        picture times.
+        late_upload: the sequence was enqueued after the previous one had finished.
+        duplicate: an upload was displayed more than once, because its sequence was enqueued again without a new
+        upload or it repeated.
+    The onset of each sequence is estimated from the progress poll that first sees it displayed. Sequences that are
+    displayed completely between polls are assumed to follow the previous one without a gap, unless they were enqueued
+    later. The log can be updated from a monitor thread while sequences are enqueued in another.
+
+    Every poll that sees a sequence displayed is also an observation of the host time of a frame for the frame_clock
+    (FrameClock), which gives the timestamps of the displayed frames.
+
+    A log can span the runs of a session that are displayed without stopping: sequences are enqueued with their run,
+    and the records of a run are returned with frames counted from the start of the run.
+    """
+    def __init__(self, picture_time, clock=time.perf_counter_ns):
+        """
+        :param picture_time: time in microseconds to display each frame.
+        :param clock: function returning the host time in nanoseconds.
+        """
+        self.frame_s = picture_time * 1e-6
+        self._clock = clock
+        self.t0_ns = clock()  # host time of the start of the log.
+        self.wall_t0_ns = time.time_ns()
+        self.frame_clock = FrameClock(picture_time)
+        self._records = {}  # queue id: record (SEQUENCE_DTYPE fields).
+        self._order = []  # queue ids in order of enqueueing.
+        self._pending = deque()  # queue ids that have not been seen displayed yet.
+        self._current = None  # record being displayed.
+        self._last = None  # last record with a known onset.
+        self._leaves = set()
+        self._events = []
+        self._lock = threading.Lock()
+
+    def now(self) -> float:
+        """ seconds since the start of the log. """
+        return (self._clock() - self.t0_ns) * 1e-9
+
+    def enqueued(self, leaf, seq_id, queue_id, n_frames, run=0):
+        """
+        Registers a sequence right after it is started (AlpProjStart).
+
+        :param leaf: index of the saved sequence in the pattern group.
+        :param seq_id: device sequence id.
+        :param queue_id: queue id of the start (AlpDmd.queue_id).
+        :param n_frames: frames per repetition.
+        :param run: index of the run (pattern group) of the session.
+        """
+        with self._lock:
+            self._enqueued(leaf, seq_id, queue_id, n_frames, run)
+
+    def _enqueued(self, leaf, seq_id, queue_id, n_frames, run=0):
+        record = {'leaf': leaf, 'seq_id': seq_id, 'queue_id': queue_id, 'n_frames': n_frames, 'repeats': 1,
+                  'enqueued_s': self.now(), 'onset_s': np.nan, 'onset_frame': -1, 'offset_frame': -1,
+                  'gap_frames': 0, 'late': False, 'observed': False, 'duplicate': (run, leaf) in self._leaves,
+                  'run': run}
+        self._leaves.add((run, leaf))
+        self._records[queue_id] = record
+        self._order.append(queue_id)
+        self._pending.append(queue_id)
+
+    def update(self, progress: AlpProjProgress, t_ns=None):
+        """
+        Updates the bookkeeping from a projection progress poll.
+
+        :param progress: the result of the poll.
+        :param t_ns: host time of the poll (clock). By default, the poll was made right before this call.
+        """
+        with self._lock:
+            t = self.now() if t_ns is None else (t_ns - self.t0_ns) * 1e-9
+            self._update(progress, t)
+
+    def _update(self, progress: AlpProjProgress, t):
+        if progress.nFlags & ALP_FLAG_QUEUE_IDLE:
+            self._complete_current()
+            while self._pending:  # all of them have been displayed.
+                self._resolve(self._records[self._pending.popleft()], None)
+            return
+        record = self._records.get(progress.CurrentQueueId)
+        if record is None or (record is not self._current and record['onset_frame'] >= 0):
+            return  # not enqueued through this log, or an earlier poll.
+        indefinite = progress.nFlags & ALP_FLAG_SEQUENCE_INDEFINITE
+        iteration = progress.nSequenceCounterUnderflow if indefinite else 0
+        frames_done = iteration * record['n_frames'] + progress.nFramesPerSubSequence - progress.nFrameCounter
+        if record is not self._current:
+            self._complete_current()
+            while self._pending and self._pending[0] != progress.CurrentQueueId:
+                self._resolve(self._records[self._pending.popleft()], None)
+            if self._pending:
+                self._pending.popleft()
+            # the displayed frame started up to one picture time ago, the midpoint is used.
+            onset = t - (frames_done + .5) * self.frame_s
+            self._resolve(record, onset)
+            self._current = record
+        if iteration + 1 > record['repeats']:
+            record['repeats'] = iteration + 1
+            record['offset_frame'] = record['onset_frame'] + record['repeats'] * record['n_frames']
+        self.frame_clock.observe(record['onset_frame'] + frames_done, t)
+
+    def finish(self):
+        """ completes the bookkeeping at the end of the projection. """
+        with self._lock:
+            self._complete_current()
+            while self._pending:
+                self._resolve(self._records[self._pending.popleft()], None)
+
+    def _resolve(self, record, onset):
+        """ sets the onset of a record, and records the events of its start. """
+        prev = self._last
+        if prev is None:
+            onset_frame, expected = 0, record['enqueued_s']
+        else:
+            onset_frame = prev['offset_frame']
+            expected = prev['onset_s'] + prev['repeats'] * prev['n_frames'] * self.frame_s
+        record['late'] = prev is not None and record['enqueued_s'] > expected + .5 * self.frame_s
+        if onset is None:
+            onset = max(expected, record['enqueued_s'])
+        else:
+            record['observed'] = True
+            onset = max(onset, record['enqueued_s'])
+        record['onset_s'] = onset
+        record['onset_frame'] = onset_frame
+        record['offset_frame'] = onset_frame + record['repeats'] * record['n_frames']
+        gap = onset - expected
+        if prev is not None and gap > self.frame_s:  # estimates are within half a picture time.
+            record['gap_frames'] = int(round(gap / self.frame_s))
+            self._event('underrun', record, onset_frame, record['gap_frames'], expected)
+            self.frame_clock.new_segment(onset_frame)
+        if record['late']:
+            self._event('late_upload', record, onset_frame, 0, record['enqueued_s'])
+        if record['duplicate']:
+            self._event('duplicate', record, onset_frame, record['n_frames'], onset)
+        self._last = record
+
+    def _complete_current(self):
+        record, self._current = self._current, None
+        if record is not None and record['repeats'] > 1:
+            first_repeat = record['onset_frame'] + record['n_frames']
+            self._event('duplicate', record, first_repeat, (record['repeats'] - 1) * record['n_frames'],
+                        record['onset_s'] + record['n_frames'] * self.frame_s)
+
+    def _event(self, kind, record, frame, n_frames, t):
+        self._events.append((kind, record['leaf'], frame, n_frames, t, record['run']))
+
+    def _run_records(self, run):
+        """ returns the records of a run (all if run is None) in order of enqueueing, and its first frame. """
+        records = [self._records[q] for q in self._order if run is None or self._records[q]['run'] == run]
+        first_frame = 0
+        if run is not None and records and records[0]['onset_frame'] >= 0:
+            first_frame = records[0]['onset_frame']
+        return records, first_frame
+
+    def sequences(self, run=None) -> np.ndarray:
+        """
+        returns the sequence records (SEQUENCE_DTYPE) in order of enqueueing.
+
+        :param run: only return the records of this run, with frames counted from its start.
+        """
+        fields = SEQUENCE_DTYPE.names
+        with self._lock:
+            records, first_frame = self._run_records(run)
+            rows = [tuple(r[k] for k in fields) for r in records]
+        seqs = np.array(rows, dtype=SEQUENCE_DTYPE)
+        for k in ('onset_frame', 'offset_frame'):
+            seqs[k][seqs[k] >= 0] -= first_frame
+        return seqs
+
+    def timestamps(self, run=None) -> np.ndarray:
+        """
+        returns the modelled host times of the displayed sequences (TIMESTAMP_DTYPE): frame i of a sequence was
+        displayed at onset_ns + i * interval_ns. Sequences in segments without observations keep their estimated
+        onsets.
+
+        :param run: only return the sequences of this run, with frames counted from its start.
+        """
+        with self._lock:
+            records, first_frame = self._run_records(run)
+            interval = self.frame_clock.interval_s
+            rows = []
+            for r in records:
+                if r['onset_frame'] < 0:
+                    continue
+                segment = self.frame_clock.segment_of(r['onset_frame'])
+                onset = self.frame_clock.frame_time(r['onset_frame'])
+                if onset is None:
+                    onset = r['onset_s']
+                rows.append((r['leaf'], r['onset_frame'] - first_frame, r['offset_frame'] - r['onset_frame'],
+                             self.t0_ns + int(round(onset * 1e9)), interval * 1e9, segment))
+        return np.array(rows, dtype=TIMESTAMP_DTYPE)
+
+    def timestamp_attributes(self) -> dict:
+        """ returns the clock model parameters to save with the timestamps. """
+        with self._lock:
+            attrs = {'t0_ns': self.t0_ns, 'wall_t0_ns': self.wall_t0_ns}
+            attrs.update(self.frame_clock.summary())
+        return attrs
+
+    def events(self, run=None) -> np.ndarray:
+        """
+        returns the underruns, late uploads and duplicates (EVENT_DTYPE) in order of detection.
+
+        :param run: only return the events of this run, with frames counted from its start.
+        """
+        with self._lock:
+            _, first_frame = self._run_records(run)
+            rows = [e[:2] + (e[2] - first_frame,) + e[3:5] for e in self._events if run is None or e[5] == run]
+        return np.array(rows, dtype=EVENT_DTYPE)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return self._summary()
+
+    def _summary(self) -> dict:
+        kinds = [e[0] for e in self._events]
+        return {
+            'sequences': len(self._order),
+            'frames': self._last['offset_frame'] if self._last else 0,
+            'underruns': kinds.count('underrun'),
+            'underrun_frames': sum(e[3] for e in self._events if e[0] == 'underrun'),
+            'late_uploads': kinds.count('late_upload'),
+            'duplicates': kinds.count('duplicate'),
+            'unobserved': sum(not r['observed'] for r in self._records.values() if r['onset_frame'] >= 0),
+        }
+
+    def __str__(self):
+        return 'Projection: ' + ', '.join('{}={}'.format(k, v) for k, v in self.summary().items())
+
+
+class FrameClock:
+    """
+    Running linear model of the host time at which each displayed frame starts.
+
+    A poll at host time t that sees frame k displayed is an observation of t - interval / 2 for the start of frame k.
+    The display is divided into segments at underruns, within which frames follow each other without gaps: frame k of
+    a segment starts at onset(segment) + k * interval. The interval is common to all segments and is fitted with the
+    onsets by least squares. Its deviation from the picture time is the drift of the device clock against the host
+    clock, and the residuals give the jitter of the observations (which includes the quantization of the frame counter,
+    about picture time / sqrt(12)).
+    """
+    def __init__(self, picture_time):
+        """
+        :param picture_time: nominal time in microseconds to display each frame.
+        """
+        self.nominal_s = picture_time * 1e-6
+        # per segment: first frame, first observation time, and the sums n, sx, sy, sxx, sxy, syy of the frames and
+        # times relative to them.
+        self._segments = [[0, None, 0, 0., 0., 0., 0., 0.]]
+
+    def new_segment(self, first_frame):
+        """ starts a segment at first_frame, after a gap in the display. """
+        self._segments.append([first_frame, None, 0, 0., 0., 0., 0., 0.])
+
+    def observe(self, frame, t):
+        """
+        :param frame: index of the frame displayed at the poll.
+        :param t: host time of the poll in seconds.
+        """
+        seg = self._segments[-1]
+        if frame < seg[0]:
+            return  # a late observation of an earlier segment.
+        y = t - self.nominal_s / 2
+        if seg[1] is None:
+            seg[1] = y
+        x, y = frame - seg[0], y - seg[1]
+        seg[2] += 1
+        seg[3] += x
+        seg[4] += y
+        seg[5] += x * x
+        seg[6] += x * y
+        seg[7] += y * y
+
+    @staticmethod
+    def _centered(seg):
+        n, sx, sy, sxx, sxy, syy = seg[2:]
+        return sxx - sx * sx / n, sxy - sx * sy / n, syy - sy * sy / n
+
+    @property
+    def interval_s(self) -> float:
+        """ fitted time between frames, the nominal picture time until there are enough observations. """
+        sxx = sxy = 0.
+        for seg in self._segments:
+            if seg[2] > 1:
+                cxx, cxy, _ = self._centered(seg)
+                sxx += cxx
+                sxy += cxy
+        if sxx <= 0:
+            return self.nominal_s
+        return sxy / sxx
+
+    def segment_of(self, frame) -> int:
+        for i in range(len(self._segments) - 1, -1, -1):
+            if frame >= self._segments[i][0]:
+                return i
+        return 0
+
+    def frame_time(self, frame):
+        """
+        returns the modelled host time in seconds at which a frame started, or None if its segment has no
+        observations.
+        """
+        seg = self._segments[self.segment_of(frame)]
+        if seg[2] == 0:
+            return None
+        interval = self.interval_s
+        onset = seg[1] + (seg[4] - interval * seg[3]) / seg[2]
+        return onset + interval * (frame - seg[0])
+
+    def summary(self) -> dict:
+        interval = self.interval_s
+        n = sum(seg[2] for seg in self._segments)
+        used = [seg for seg in self._segments if seg[2] > 0]
+        rss = 0.
+        for seg in used:
+            if seg[2] > 1:
+                cxx, cxy, cyy = self._centered(seg)
+                rss += cyy - 2 * interval * cxy + interval * interval * cxx
+        dof = n - len(used) - 1
+        return {
+            'interval_ns': interval * 1e9,
+            'drift_ppm': (interval / self.nominal_s - 1) * 1e6,
+            'jitter_ns': float(np.sqrt(max(rss, 0.) / dof)) * 1e9 if dof > 0 else 0.,
+            'n_observations': n,
+            'n_segments': len(self._segments),
+        }
+
+    def __str__(self):
+        return 'Frame clock: interval={interval_ns:.0f} ns, drift={drift_ppm:.1f} ppm, jitter={jitter_ns:.0f} ns, ' \
+               'observations={n_observations}, segments={n_segments}'.format(**self.summary())
+
+
+class ProjectionMonitor:
+    """
+    Thread that polls the projection progress when a sequence boundary is due, instead of at a fixed interval.
+
+    After each poll, the end of the displayed sequence is predicted from nFrameCounter and nPictureTime. The thread
+    sleeps until lead seconds before the earliest time it can end, and then polls every fine_interval until the next
+    sequence is displayed. Waiting threads (wait) and the on_transition callback are notified of each transition,
+    which is either the start of a sequence or the queue running empty.
+
+    Reported in summary():
+        wake_latency: time from the start of a sequence to the poll that saw it (upper bound: the start is after the
+        previous poll, and at most frames_done + 1 picture times before this one).
+        polls, poll_s: number of progress polls and the time spent in them.
+        missed: sequences that were displayed completely between two polls. Queue ids are assumed to increase by one
+        for each enqueued sequence.
+    """
+    def __init__(self, dmd, max_interval=.1, fine_interval=5e-4, lead=2e-3, on_poll=None, on_transition=None,
+                 clock=time.perf_counter_ns):
+        """
+        :param dmd: AlpDmd object.
+        :param max_interval: longest time in seconds between polls, ie while the queue is empty.
+        :param fine_interval: time in seconds between polls while a boundary is due. The resolution of the sleep
+        depends on the OS (~1 ms on Windows).
+        :param lead: time in seconds before the earliest predicted boundary at which fine polling begins.
+        :param on_poll: function called with the AlpProjProgress and host time (clock, the midpoint of the inquiry) of
+        every poll, in the monitor thread.
+        :param on_transition: function called with the AlpProjProgress of every transition, in the monitor thread.
+        :param clock: function returning the host time in nanoseconds.
+        """
+        self.dmd = dmd
+        self.max_interval = max_interval
+        self.fine_interval = fine_interval
+        self.lead = lead
+        self.on_poll = on_poll
+        self.on_transition = on_transition
+        self._clock = clock
+        self.transitions = 0
+        self.missed = 0
+        self.polls = 0
+        self.poll_s = 0.
+        self.wake_latency_s = []
+        self._condition = threading.Condition()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._error = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def kick(self):
+        """ polls immediately, ie after a sequence is enqueued to an empty queue. """
+        self._wake.set()
+
+    def wait(self, seen, timeout=None) -> int:
+        """
+        Waits until more than seen transitions have happened, or for timeout seconds.
+
+        :param seen: number of transitions that the caller has handled.
+        :param timeout: time in seconds.
+        :return: the number of transitions.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.transitions > seen or self._error is not None, timeout)
+            if self._error is not None:
+                raise self._error
+            return self.transitions
+
+    def _run(self):
+        progress = AlpProjProgress()
+        last_queue_id = None
+        last_poll = None
+        try:
+            while not self._stop.is_set():
+                t = self._clock()
+                self.dmd.get_projecting_progress(progress)
+                now = self._clock()
+                self.polls += 1
+                self.poll_s += (now - t) * 1e-9
+                if self.on_poll is not None:
+                    self.on_poll(progress, (t + now) // 2)
+                idle = progress.nFlags & ALP_FLAG_QUEUE_IDLE
+                queue_id = None if idle else progress.CurrentQueueId
+                if queue_id != last_queue_id:
+                    if queue_id is not None and last_poll is not None:  # not started before monitoring.
+                        frames_done = progress.nFramesPerSubSequence - progress.nFrameCounter
+                        latency = (frames_done + 1) * progress.nPictureTime * 1e-6
+                        self.wake_latency_s.append(min(latency, (now - last_poll) * 1e-9))
+                        if last_queue_id is not None and queue_id > last_queue_id + 1:
+                            self.missed += queue_id - last_queue_id - 1
+                    last_queue_id = queue_id
+                    if self.on_transition is not None:
+                        self.on_transition(progress)
+                    with self._condition:
+                        self.transitions += 1
+                        self._condition.notify_all()
+                last_poll = t
+                self._wake.wait(self._next_poll(progress, idle))
+                self._wake.clear()
+        except Exception as e:  # raised in the waiting thread.
+            with self._condition:
+                self._error = e
+                self._condition.notify_all()
+
+    def _next_poll(self, progress: AlpProjProgress, idle) -> float:
+        """ returns the time in seconds until the next poll. """
+        if idle:
+            return self.max_interval
+        # the displayed frame can be nearly finished, so the sequence ends after at least nFrameCounter - 1 frames.
+        remaining = (progress.nFrameCounter - 1) * progress.nPictureTime * 1e-6
+        return min(max(remaining - self.lead, self.fine_interval), self.max_interval)
+
+    def summary(self) -> dict:
+        latency = self.wake_latency_s
+        return {
+            'transitions': self.transitions,
+            'missed': self.missed,
+            'polls': self.polls,
+            'poll_s': self.poll_s,
+            'mean_wake_latency_ms': float(np.mean(latency)) * 1e3 if latency else 0.,
+            'max_wake_latency_ms': float(np.max(latency)) * 1e3 if latency else 0.,
+        }
+
+    def __str__(self):
+        return 'Monitor: ' + ', '.join('{}={:.3g}'.format(k, v) for k, v in self.summary().items())
@@ -0,0 +1,155 @@
+"""
+Regenerates presented patterns from the saved generator parameters and mask.
+
+Seeded pattern generators (SparseNoise, MultiSparse) draw every frame from its own random stream, so any range of
+frames can be reconstructed on demand and in parallel. This allows saving only the frame indices of each sequence
+(HfiveSaver(save_frames=False)) instead of the patterns.
+
+For SparseSaver files, the parameters and mask are in the COMMONPREFIX_generator.json and COMMONPREFIX_mask.npy files
+and can be passed to make_generator.
+"""
+from concurrent import futures
+import json
+import numpy as np
+import tables as tb
+from dmdlib.randpatterns.saving import unpack_frames
+from dmdlib.randpatterns.sparsenoise_obj import SparseNoise
+from dmdlib.randpatterns.multisparse_obj import MultiSparse
+
+GENERATORS = {
+    'SparseNoise': SparseNoise,
+    'MultiSparse': MultiSparse,
+}
+
+
+def make_generator(params: dict, mask: np.ndarray):
+    """
+    Makes a pattern generator from the parameters returned by its params() method.
+
+    :param params: generator parameters dictionary.
+    :param mask: boolean pixel mask used in the recording.
+    """
+    return GENERATORS[params['generator']].from_params(params, mask)
+
+
+def load_generator(path):
+    """
+    Makes the pattern generator used in a recording saved by HfiveSaver.
+
+    :param path: path to the .h5 file.
+    """
+    with tb.open_file(path, 'r') as f:
+        params = json.loads(f.get_node_attr('/', 'generator_params'))
+        mask = f.get_node('/pixel_mask').read()
+    return make_generator(params, mask)
+
+
+def regenerate_frames(generator, start, stop, n_workers=None, chunk_size=500) -> np.ndarray:
+    """
+    Regenerates a range of frames in parallel.
+
+    :param generator: seeded pattern generator (ie from load_generator).
+    :param start: index of the first frame.
+    :param stop: index after the last frame.
+    :param n_workers: number of threads (default: number of processors).
+    :param chunk_size: number of frames generated by each job.
+    :return: boolean array (stop - start, h / scale, w / scale) of logical pixels.
+    """
+    h, w = generator.unmasked.shape
+    frames = np.zeros((stop - start, h, w), dtype=bool)
+    with futures.ThreadPoolExecutor(n_workers) as executor:
+        jobs = [executor.submit(generator.frames, start + i, frames[i:i + chunk_size])
+                for i in range(0, stop - start, chunk_size)]
+        for job in jobs:
+            job.result()  # raise any exceptions.
+    return frames
+
+
+def read_stored_sequence(f: tb.File, group, leaf) -> np.ndarray:
+    """
+    Reads a sequence as it was stored by HfiveSaver (one leaf per sequence) or HfiveStreamSaver (one frames array
+    per group, indexed by the group's sequences table). Packed frames are unpacked.
+
+    :param f: open tables file.
+    :param group: pattern group name (ie 'aaa').
+    :param leaf: sequence leaf number.
+    :return: stored frames or frame indices of the sequence.
+    """
+    attrs = f.root._v_attrs
+    if 'pattern_layout' in attrs and attrs['pattern_layout'] == 'stream':
+        group_node = f.get_node('/patterns/{}'.format(group))
+        rows = group_node.sequences.read_where('leaf == {:d}'.format(leaf))
+        if not len(rows):
+            raise KeyError('No sequence {} in group {}.'.format(leaf, group))
+        start, n_rows, n_frames = int(rows['start'][0]), int(rows['n_rows'][0]), int(rows['n_frames'][0])
+        node = group_node.frames
+        data = node[start:start + n_rows]
+    else:
+        node = f.get_node('/patterns/{}/{:06d}'.format(group, leaf))
+        data = node.read()
+        n_frames = node.attrs['n_frames'] if 'n_frames' in node.attrs else len(data)
+    if 'packing' in node.attrs:
+        logical_mask = f.root.logical_mask.read() if '/logical_mask' in f else None
+        data = unpack_frames(data, node.attrs['packing'], node.attrs['frame_shape'], logical_mask, n_frames)
+    return data
+
+
+def regenerate_sequence(path, group, leaf, generator=None, n_workers=None) -> np.ndarray:
+    """
+    Returns the patterns of a sequence saved by HfiveSaver or HfiveStreamSaver, regenerating them if only frame
+    indices were saved, or looking them up in the pattern bank if the sequence was presented from a bank.
+
+    :param path: path to the .h5 file.
+    :param group: pattern group name (ie 'aaa').
+    :param leaf: sequence leaf number.
+    :param generator: generator to use (default: loaded from the file).
+    :param n_workers: number of threads used for regeneration.
+    :return: boolean array (n_frames, h / scale, w / scale)
+    """
+    with tb.open_file(path, 'r') as f:
+        attrs = f.root._v_attrs
+        storage = attrs['pattern_storage'] if 'pattern_storage' in attrs else 'frames'
+        data = read_stored_sequence(f, group, leaf)
+        if storage == 'bank_indices':
+            return f.root.pattern_bank.read()[np.asarray(data, dtype=np.int64)]
+    if storage == 'frames':
+        return data
+    if generator is None:
+        generator = load_generator(path)
+    return regenerate_frames(generator, int(data[0]), int(data[-1]) + 1, n_workers)
+
+
+def read_projection_log(path, group) -> (np.ndarray, np.ndarray):
+    """
+    Reads the display bookkeeping of a pattern group saved by HfiveSaver or HfiveStreamSaver. Frames of sequences
+    with 'duplicate' events were displayed more than once, and 'underrun' events mark gaps in the display (see
+    projection.ProjectionLog).
+
+    :param path: path to the .h5 file.
+    :param group: pattern group name (ie 'aaa').
+    :return: sequences (projection.SEQUENCE_DTYPE) and events (projection.EVENT_DTYPE) structured arrays.
+    """
+    with tb.open_file(path, 'r') as f:
+        node = f.get_node('/projection/{}'.format(group))
+        return node.sequences.read(), node.events.read()
+
+
+def read_frame_timestamps(path, group) -> (np.ndarray, dict):
+    """
+    Reads the host times (time.perf_counter_ns) of the displayed frames of a pattern group saved by HfiveSaver or
+    HfiveStreamSaver, in display order. Frames of sequences that were displayed more than once appear once per
+    display.
+
+    :param path: path to the .h5 file.
+    :param group: pattern group name (ie 'aaa').
+    :return: int64 array of frame onsets in nanoseconds, and dictionary of the clock model parameters (see
+    projection.FrameClock).
+    """
+    with tb.open_file(path, 'r') as f:
+        table = f.get_node('/projection/{}/timestamps'.format(group))
+        rows = table.read()
+        attributes = {k: table.attrs[k] for k in table.attrs._v_attrnamesuser}
+    onsets = [r['onset_ns'] + np.round(np.arange(r['n_frames']) * r['interval_ns']).astype(np.int64) for r in rows]
+    if not onsets:
+        return np.zeros(0, dtype=np.int64), attributes
+    return np.concatenate(onsets), attributes
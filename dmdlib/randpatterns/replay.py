@@ -0,0 +1,397 @@
+"""
+Presents patterns read from a recording instead of generating them live, for exact replays of a session or for
+protocols rendered offline with prerender.
+
+FileSource reads the sequences of an HfiveSaver or HfiveStreamSaver .h5 file, or of a SparseSaver set, in a
+background thread that also decompresses, unpacks, regenerates (frame index storage) or looks them up in the pattern
+bank, up to read_ahead sequences ahead of the presenter. The presentation loop then only copies and renders the frames,
+so the frame rate is limited by the upload bandwidth instead of the generator.
+"""
+
+from concurrent import futures
+from collections import deque
+from glob import glob
+import argparse
+import csv
+import json
+import os
+import queue
+import threading
+import numpy as np
+import tables as tb
+from scipy import sparse
+from tqdm import tqdm
+from dmdlib.randpatterns import utils
+from dmdlib.randpatterns import ephys_comms
+from dmdlib.randpatterns import regenerate
+from dmdlib.randpatterns.geometry import MaskGeometry
+from dmdlib.randpatterns.presenter import presenter_from_args
+
+
+class FileSource:
+    """
+    Pattern generator that presents the frames stored in a recording, in order of pattern group and leaf. The
+    stored sequences do not need to have the presenter's sequence length.
+    """
+    def __init__(self, path, mask=None, scale=None, groups=None, read_ahead=4):
+        """
+        :param path: .h5 file, or the path prefix (or .json store file) of a SparseSaver set.
+        :param mask: boolean mask of the DMD shape, by default the mask of the recording.
+        :param scale: logical pixel size in mirrors, by default the scale of the recording's generator.
+        :param groups: pattern groups to present (default: all of them).
+        :param read_ahead: number of sequences that are read ahead of the presentation.
+        """
+        self.path, self._index, source_mask, self.source_params, self._read = index_recording(path, groups)
+        self.groups = sorted(set(g for g, _, _ in self._index))
+        self.mask = source_mask if mask is None else mask
+        if self.mask is None:
+            raise ValueError('The recording has no mask, it must be given.')
+        if scale is None:
+            if 'scale' not in self.source_params:
+                raise ValueError('The recording has no generator scale, it must be given.')
+            scale = self.source_params['scale']
+        self.scale = scale
+        self.geometry = MaskGeometry.get(self.mask, scale)
+        self.unmasked = self.geometry.unmasked
+        self.frame_index = 0  # index of the next frame to be presented.
+        self._chunk = None
+        self._offset = 0
+        self._ready = queue.Queue(maxsize=read_ahead)
+        self._stop = threading.Event()
+        self._reader = threading.Thread(target=self._read_ahead, daemon=True)
+        self._reader.start()
+
+    @property
+    def n_frames(self) -> int:
+        """ number of frames in the source. """
+        return sum(n for _, _, n in self._index)
+
+    def make_patterns(self, boolean_array: np.ndarray, whole_seq_array: np.ndarray, debug):
+        """
+        Copies the next frames of the source into boolean_array and renders them.
+
+        :param boolean_array: boolean array that is of shape ( n_frames, h / scale, w / scale)
+        :param whole_seq_array: array of uint8 values of shape (n_frames, h, w), or packed binary (see AlpFrameSequence)
+        :param debug: not implemented.
+        """
+        n_frames = len(boolean_array)
+        filled = 0
+        while filled < n_frames:
+            if self._chunk is None or self._offset == len(self._chunk):
+                self._chunk, self._offset = self._next_chunk(), 0
+            n = min(n_frames - filled, len(self._chunk) - self._offset)
+            boolean_array[filled:filled + n] = self._chunk[self._offset:self._offset + n]
+            self._offset += n
+            filled += n
+        self.frame_index += n_frames
+        self.geometry.render(boolean_array, whole_seq_array)
+
+    def _next_chunk(self) -> np.ndarray:
+        item = self._ready.get()
+        if isinstance(item, Exception):  # raised in the reader thread.
+            raise item
+        if item is None:
+            self._ready.put(None)  # later calls fail as well.
+            raise EOFError('All {} frames of {} have been presented.'.format(self.n_frames, self.path))
+        return item
+
+    def _read_ahead(self):
+        """ reader thread: puts the sequences in the ready queue, then None. """
+        try:
+            for frames in self._read(self.path, self._index, self.source_params, self.mask, self.scale):
+                if not self._put(frames):
+                    return
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item) -> bool:
+        """ puts item in the ready queue, waiting while it is full. Returns False if the source is closed. """
+        while not self._stop.is_set():
+            try:
+                self._ready.put(item, timeout=.05)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def close(self):
+        """ stops the reader thread. """
+        self._stop.set()
+        self._reader.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def params(self) -> dict:
+        """ parameters of the generator: the source recording and the parameters of the generator it was made with. """
+        return {'generator': 'FileSource', 'source': self.path, 'groups': self.groups, 'scale': self.scale,
+                'source_params': self.source_params}
+
+
+def index_recording(path, groups=None):
+    """
+    Indexes the sequences of a recording.
+
+    :param path: .h5 file, or the path prefix (or .json store file) of a SparseSaver set.
+    :param groups: pattern groups to index (default: all of them).
+    :return: absolute path (prefix), [(group, leaf or file, n_frames)] in presentation order, the mask, the generator
+    parameters, and the function read(path, index, params, mask, scale, sparse_frames=False) yielding the logical
+    frames of each indexed sequence. With sparse_frames, SparseSaver sequences are yielded as boolean csr matrices
+    (n_frames, h / scale * w / scale) instead of dense arrays.
+    """
+    if path.endswith('.json'):
+        path = path[:-len('.json')]
+    path = os.path.abspath(path)
+    if path.endswith('.h5'):
+        return (path,) + _index_h5(path, groups) + (_read_h5,)
+    return (path,) + _index_sparse(path, groups) + (_read_sparse,)
+
+
+def _index_h5(path, groups=None):
+    """ returns [(group, leaf, n_frames)], the mask and the generator parameters of a recording. """
+    with tb.open_file(path, 'r') as f:
+        attrs = f.root._v_attrs
+        params = json.loads(attrs['generator_params']) if 'generator_params' in attrs else {}
+        mask = f.root.pixel_mask.read() if '/pixel_mask' in f else None
+        stream = 'pattern_layout' in attrs and attrs['pattern_layout'] == 'stream'
+        index = []
+        for group in groups or sorted(f.root.patterns._v_children):
+            group_node = f.get_node('/patterns/{}'.format(group))
+            if stream:
+                rows = group_node.sequences.read()
+                index.extend((group, int(r['leaf']), int(r['n_frames'])) for r in rows)
+            else:
+                for name in sorted(group_node._v_children):
+                    node = group_node._v_children[name]
+                    n_frames = node.attrs['n_frames'] if 'n_frames' in node.attrs else len(node)
+                    index.append((group, int(name), int(n_frames)))
+    return index, mask, params
+
+
+def _read_h5(path, index, params, mask, scale, sparse_frames=False):
+    """ yields the logical frames of the indexed sequences of a recording. The frames are always dense. """
+    with tb.open_file(path, 'r') as f:
+        attrs = f.root._v_attrs
+        storage = attrs['pattern_storage'] if 'pattern_storage' in attrs else 'frames'
+        bank = f.root.pattern_bank.read() if storage == 'bank_indices' else None
+        generator = regenerate.make_generator(params, mask) if storage == 'frame_indices' else None
+        for group, leaf, _ in index:
+            data = regenerate.read_stored_sequence(f, group, leaf)
+            if storage == 'bank_indices':
+                yield bank[np.asarray(data, dtype=np.int64)]
+            elif storage == 'frame_indices':
+                frames = np.zeros((len(data),) + generator.unmasked.shape, dtype=bool)
+                generator.frames(int(data[0]), frames)
+                yield frames
+            else:
+                yield np.asarray(data, dtype=bool)
+
+
+def _index_sparse(path_start, groups=None):
+    """ returns [(group, file, n_frames)], the mask and the generator parameters of a SparseSaver set. """
+    files = sorted(glob(path_start + '_*.sparse.npz'))
+    if not files:
+        raise ValueError('No sequences are saved as {}_*.sparse.npz, frames must be saved to replay a SparseSaver set.'
+                         .format(path_start))
+    with open(path_start + '_framedata.csv') as f:
+        rows = list(csv.DictReader(f))  # in the order the sequences were saved, as are the file names.
+    index = []
+    for path, row in zip(files, rows):
+        group = path[len(path_start) + 1:].split(':')[0]
+        if groups is None or group in groups:
+            index.append((group, path, int(row['n'])))
+    mask = np.load(path_start + '_mask.npy') if os.path.exists(path_start + '_mask.npy') else None
+    params = {}
+    if os.path.exists(path_start + '_generator.json'):
+        with open(path_start + '_generator.json') as f:
+            params = json.load(f)
+    return index, mask, params
+
+
+def _read_sparse(path_start, index, params, mask, scale, sparse_frames=False):
+    """ yields the logical frames of the indexed sequences of a SparseSaver set. """
+    bank = np.load(path_start + '_bank.npy') if os.path.exists(path_start + '_bank.npy') else None
+    h, w = mask.shape[0] // scale, mask.shape[1] // scale
+    for _, npz_path, n_frames in index:
+        data = sparse.load_npz(npz_path)
+        if bank is not None:
+            yield bank[data.toarray().ravel().astype(np.int64)]
+        elif sparse_frames:
+            yield data.tocsr().astype(bool)
+        else:
+            yield data.toarray().reshape(n_frames, h, w).astype(bool)
+
+
+def prerender(generator, saver, n_frames, frames_per_run=None, pix_per_seq=250, n_workers=None):
+    """
+    Renders the frames of a seeded generator (see regenerate) in parallel and saves them as a presentation would:
+    one pattern group per run of frames_per_run frames, with a sequence of pix_per_seq frames per leaf. The
+    generator's frames method is run by n_workers threads, a few sequences ahead of the saver.
+
+    :param generator: seeded pattern generator with frames(start, boolean_array).
+    :param saver: saver to store the sequences with.
+    :param n_frames: total number of frames.
+    :param frames_per_run: frames per pattern group (default: all in one group).
+    :param pix_per_seq: frames per saved sequence.
+    :param n_workers: number of threads (default: number of processors).
+    """
+    frames_per_run = frames_per_run or n_frames
+    shape = generator.unmasked.shape
+    sequences = []  # (run, first frame, n_frames)
+    for run_start in range(0, n_frames, frames_per_run):
+        run_stop = min(run_start + frames_per_run, n_frames)
+        for start in range(run_start, run_stop, pix_per_seq):
+            sequences.append((run_start // frames_per_run, start, min(pix_per_seq, run_stop - start)))
+
+    def render(start, n):
+        frames = np.zeros((n,) + shape, dtype=bool)
+        generator.frames(start, frames)
+        return frames
+
+    n_workers = n_workers or os.cpu_count()
+    with futures.ThreadPoolExecutor(n_workers) as executor:
+        jobs = deque()
+        run = 0
+        for i in tqdm(range(len(sequences)), desc='Rendering sequences', unit='seq'):
+            while len(jobs) < 2 * n_workers and i + len(jobs) < len(sequences):
+                _, start, n = sequences[i + len(jobs)]
+                jobs.append(executor.submit(render, start, n))
+            seq_run, start, _ = sequences[i]
+            if seq_run != run:
+                saver.iter_pattern_group()
+                run = seq_run
+            saver.store_sequence_array(jobs.popleft().result(), {'first_frame': start,
+                                                                 'image_scale': generator.scale})
+
+
+def whole_sequence_runs(n_frames, frames_per_run, pix_per_seq, nseqs=1):
+    """
+    Presenters upload whole sequences and present the same number of frames in every run, so the frames of a source
+    are presented in runs of whole sequences. The frames that don't fill a run are not presented.
+
+    :param n_frames: number of frames in the source.
+    :param frames_per_run: largest number of frames per run.
+    :param pix_per_seq: frames per sequence.
+    :param nseqs: number of sequences that the presenter uploads before it starts.
+    :return: (frames per run, number of runs).
+    """
+    frames_per_run = min(frames_per_run, n_frames) // pix_per_seq * pix_per_seq
+    n_runs = n_frames // frames_per_run if frames_per_run else 0
+    if n_runs * frames_per_run < nseqs * pix_per_seq:
+        raise ValueError('The {} frames of the source do not fill the {} initial sequences of {} frames.'.format(
+            n_frames, nseqs, pix_per_seq))
+    return frames_per_run, n_runs
+
+
+def main():
+    parser = utils.setup_parser()
+    parser.description = 'Presents the patterns of a recording or of a protocol rendered with prerender.'
+    parser.add_argument('source', help='path to the .h5 file, or the path prefix of a SparseSaver set, to present')
+    parser.add_argument('--groups', nargs='*', default=None, help='pattern groups to present (default: all)')
+    parser.add_argument('--source_read_ahead', type=int, default=4, help='sequences read ahead of the presentation')
+    args = parser.parse_args()
+    MaskGeometry.disk_cache = True  # reuses the geometry of the mask across sessions.
+    if args.seeds_only:  # the frame indices of a file source can't be regenerated, the frames have to be saved.
+        raise ValueError('--seeds_only can not be used to replay a recording.')
+
+    fullpath = os.path.abspath(args.savefile)
+    if not args.overwrite and os.path.exists(args.savefile):
+        errst = "{} already exists.".format(fullpath)
+        raise FileExistsError(errst)
+
+    mask = np.load(args.maskfile)
+    with FileSource(args.source, mask, args.scale, args.groups, args.source_read_ahead) as generator:
+        n_frames = min(args.nframes, generator.n_frames)
+        presentations_per = min([args.frames_per_run, n_frames])
+
+        if not args.no_phys:
+            openephys = ephys_comms.OpenEphysChannel()
+
+        with utils.make_saver(args, fullpath, logical_mask=generator.unmasked) as saver, \
+                utils.make_dmd(args) as dmd:
+            saver.store_mask_array(mask)
+            saver.store_generator_params(generator.params())
+            uuid = saver.uuid
+            if not args.no_phys:
+                openephys.record_start(uuid, fullpath)
+                openephys.flush()  # raises OpenEphysError if OpenEphys does not reply.
+
+            presenter = presenter_from_args(args, dmd, generator, saver, presentations_per,
+                                            markers=None if args.no_phys else openephys)
+            # the sequence length is only known once the presenter is set up (ie autotuned).
+            presentations_per, n_runs = whole_sequence_runs(n_frames, presentations_per, presenter.pix_per_seq,
+                                                            len(presenter.sequences))
+            presenter.total_presentations = presentations_per
+            if n_runs * presentations_per < n_frames:
+                print('Presenting {} of the {} frames: {} runs of {} frames, in sequences of {} frames.'.format(
+                    n_runs * presentations_per, n_frames, n_runs, presentations_per, presenter.pix_per_seq))
+
+            def run_start(i, run_id):
+                print("Starting presentation run {} of {} ({}).".format(i + 1, n_runs, run_id))
+                if not args.no_phys:
+                    openephys.record_presentation(run_id)
+
+            presenter.run_session(n_runs, on_run_start=run_start)
+    if not args.no_phys:
+        openephys.close()
+        print(openephys)
+
+
+def prerender_main():
+    parser = setup_prerender_parser()
+    args = parser.parse_args()
+    MaskGeometry.disk_cache = True  # reuses the geometry of the mask across sessions.
+
+    fullpath = os.path.abspath(args.savefile)
+    if not args.overwrite and os.path.exists(args.savefile):
+        errst = "{} already exists.".format(fullpath)
+        raise FileExistsError(errst)
+
+    if any([x > 1. or x < 0. for x in args.fraction_on]):
+        errst = 'Fraction arguments must be between 0 and 1.'
+        raise ValueError(errst)
+    mask = np.load(args.maskfile)
+    params = {'seed': args.seed, 'scale': args.scale}
+    if args.generator == 'sparsenoise':
+        params.update(generator='SparseNoise', probability=args.fraction_on[0])
+    else:
+        params.update(generator='MultiSparse', probabilities=args.fraction_on, switch_frequency=args.switch_freq)
+    generator = regenerate.make_generator(params, mask)
+
+    from dmdlib.randpatterns import saving
+    with saving.HfiveStreamSaver(fullpath, args.overwrite, packing=args.pack_storage,
+                                 logical_mask=generator.unmasked) as saver:
+        saver.store_mask_array(mask)
+        saver.store_generator_params(generator.params())
+        prerender(generator, saver, args.nframes, args.frames_per_run, args.pix_per_seq, args.workers)
+
+
+def setup_prerender_parser():
+    parser = argparse.ArgumentParser(description='Renders the patterns of a protocol in parallel for replay.')
+    parser.add_argument('savefile', help='path to save the rendered patterns (.h5) file')
+    parser.add_argument('maskfile', help='path to mask file (.npy) file')
+    parser.add_argument('generator', choices=['sparsenoise', 'multisparse'], help='pattern generator')
+    parser.add_argument('fraction_on', type=float, nargs='+',
+                        help='fraction of pixels on per frame (between 0 and 1), one for sparsenoise')
+    parser.add_argument('--switch_freq', type=int, default=500,
+                        help='number of frames between switching stimulus probabilities (multisparse).')
+    parser.add_argument('--overwrite', action='store_true', help='overwrite datafile?')
+    parser.add_argument('--nframes', type=int, default=750000, help='total number of frames to render')
+    parser.add_argument('--scale', type=int, default=4,
+                        help='scale factor for pixels. NxN physical pixels are treated as a single logical pixel')
+    parser.add_argument('--frames_per_run', type=int, default=60000, help='number of frames of each pattern group')
+    parser.add_argument('--pix_per_seq', type=int, default=250, help='number of frames of each saved sequence')
+    parser.add_argument('--seed', type=int, default=None, help='session seed for pattern generation (default: random)')
+    parser.add_argument('--pack_storage', choices=['bits', 'unmasked', 'coordinates'], default=None,
+                        help='store frames bit-packed, optionally keeping only the unmasked logical pixels, or as the '
+                             'coordinates of the on pixels')
+    parser.add_argument('--workers', type=int, default=None, help='number of rendering threads (default: processors)')
+    return parser
+
+
+if __name__ == '__main__':
+    main()
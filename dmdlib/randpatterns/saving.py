@@ -2,6 +2,10 @@
 This contains apparatuses for saving patterns to the
 """
 from concurrent import futures
+from collections import deque
+from functools import partial
+import threading
+import time
 import tables as tb
 import uuid
 from scipy import sparse
@@ -17,15 +21,158 @@ import csv
 warnings.filterwarnings('ignore', category=tb.NaturalNameWarning)
 
 
+PACKINGS = (None, 'bits', 'unmasked', 'coordinates')
+MAX_QUEUE_BYTES = 2 ** 30  # default budget of sequence data waiting to be written.
+MAX_STRING_BYTES = 256  # default width of the string metadata columns of HfiveStreamSaver.
+
+
+class FrameCoordinates:
+    """
+    Coordinate list of the on pixels of a sequence of boolean frames, as made by sparse pattern generators. Savers
+    with accepts_coordinates can be given this instead of the dense frames.
+    """
+    ndim = 3
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, shape):
+        """
+        :param indptr: the on pixels of frame i are indices[indptr[i]:indptr[i + 1]].
+        :param indices: flat (logical) pixel indices within the frame.
+        :param shape: (n_frames, h, w) of the frames.
+        """
+        self.indptr = indptr
+        self.indices = indices
+        self.shape = tuple(shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.indptr.nbytes + self.indices.nbytes
+
+    def frame_numbers(self) -> np.ndarray:
+        """ :return: frame number of each entry of indices. """
+        return np.repeat(np.arange(len(self)), np.diff(self.indptr))
+
+    def to_csr(self) -> sparse.csr_matrix:
+        """ :return: boolean csr matrix (n_frames, h * w). """
+        n, h, w = self.shape
+        data = np.ones(len(self.indices), dtype=bool)
+        return sparse.csr_matrix((data, self.indices, self.indptr), shape=(n, h * w))
+
+    def to_dense(self) -> np.ndarray:
+        """ :return: boolean array (n_frames, h, w). """
+        n, h, w = self.shape
+        frames = np.zeros((n, h * w), dtype=bool)
+        frames[self.frame_numbers(), self.indices] = True
+        frames.shape = self.shape
+        return frames
+
+
+def pack_frames(frames: np.ndarray, packing, logical_mask=None) -> np.ndarray:
+    """
+    Packs boolean frames for storage.
+
+    :param frames: boolean array (n_frames, h, w).
+    :param packing: None (frames are returned as is), 'bits' (np.packbits along the last axis), 'unmasked' (only
+    the pixels within logical_mask are kept, and these are packed for each frame) or 'coordinates' (int32 array
+    (n_on, 2) of the frame number and flat pixel index of each on pixel).
+    :param logical_mask: boolean array (h, w) of the unmasked logical pixels, required for 'unmasked' packing.
+    :return: packed array.
+    """
+    if packing == 'coordinates':
+        if isinstance(frames, FrameCoordinates):
+            frame_numbers, indices = frames.frame_numbers(), frames.indices
+        else:
+            frame_numbers, indices = np.nonzero(frames.reshape(len(frames), -1))
+        return np.stack((frame_numbers, indices), axis=1).astype(np.int32)
+    if isinstance(frames, FrameCoordinates):
+        frames = frames.to_dense()
+    if packing is None:
+        return frames
+    elif packing == 'bits':
+        return np.packbits(frames, axis=-1)
+    elif packing == 'unmasked':
+        return np.packbits(frames[:, logical_mask], axis=-1)
+    raise ValueError('Unknown packing: {}'.format(packing))
+
+
+def unpack_frames(data: np.ndarray, packing, frame_shape, logical_mask=None, n_frames=None) -> np.ndarray:
+    """
+    Inverse of pack_frames.
+
+    :param data: packed array as returned by pack_frames.
+    :param packing: packing used to store the data.
+    :param frame_shape: (h, w) of the unpacked frames.
+    :param logical_mask: boolean array (h, w) of the unmasked logical pixels, required for 'unmasked' packing.
+    :param n_frames: number of frames, required for 'coordinates' packing.
+    :return: boolean array (n_frames, h, w).
+    """
+    if packing is None or packing == 'none':
+        return data
+    elif packing == 'coordinates':
+        frames = np.zeros((n_frames, int(np.prod(frame_shape))), dtype=bool)
+        frames[data[:, 0], data[:, 1]] = True
+        frames.shape = (n_frames,) + tuple(frame_shape)
+        return frames
+    elif packing == 'bits':
+        return np.unpackbits(data, axis=-1, count=frame_shape[-1]).astype(bool)
+    elif packing == 'unmasked':
+        frames = np.zeros((len(data),) + tuple(frame_shape), dtype=bool)
+        frames[:, logical_mask] = np.unpackbits(data, axis=-1, count=int(logical_mask.sum()))
+        return frames
+    raise ValueError('Unknown packing: {}'.format(packing))
+
+
+def _check_packing(packing, logical_mask):
+    if packing not in PACKINGS:
+        raise ValueError('packing must be one of {}.'.format(PACKINGS))
+    if packing == 'unmasked' and logical_mask is None:
+        raise ValueError("'unmasked' packing requires the logical_mask.")
+
+
+def _create_projection_tables(f: tb.File, group_name, sequences: np.ndarray, events: np.ndarray):
+    group = f.create_group('/projection', group_name, createparents=True)
+    f.create_table(group, 'sequences', obj=sequences)
+    f.create_table(group, 'events', obj=events)
+    f.flush()
+
+
+def _create_timestamp_table(f: tb.File, group_name, timestamps: np.ndarray, attributes: dict):
+    table = f.create_table('/projection/{}'.format(group_name), 'timestamps', obj=timestamps, createparents=True)
+    for k, v in attributes.items():
+        table.set_attr(k, v)
+    f.flush()
+
+
 class Saver(ABC):
     """
     Base class for saving data in another thread
+
+    Sequences wait for the writer thread in a queue that holds at most max_queue_bytes of data. When it is full,
+    storing a sequence blocks until enough writes have completed (backpressure), so a writer that falls behind slows
+    the presentation down instead of filling the memory. The queue depth, bytes in flight, write latencies and every
+    stall are kept in queue_stats (SaveQueueStats).
     """
+    accepts_coordinates = False  # True if store_sequence_array can be given FrameCoordinates instead of frames.
 
-    def __init__(self, nthreads=1):
+    def __init__(self, nthreads=1, save_frames=True, max_queue_bytes=MAX_QUEUE_BYTES):
+        """
+        :param nthreads: number of threads for saving.
+        :param save_frames: if False, sequences are saved as the indices of their frames instead of the patterns.
+        The patterns are regenerated from the generator parameters (see store_generator_params).
+        :param max_queue_bytes: budget of sequence data waiting to be written. A sequence larger than the budget is
+        queued when the queue is empty.
+        """
+        self.save_frames = save_frames
         self.uuid = str(uuid.uuid4())
-        self._futures = []
+        self._futures = deque()  # in order of submission.
         self._executor = futures.ThreadPoolExecutor(nthreads)  # IO bound so we'll use threads here.
+        self.max_queue_bytes = max_queue_bytes
+        self.queue_stats = SaveQueueStats()
+        self._queue_bytes = 0
+        self._queue_length = 0
+        self._queue_cond = threading.Condition()
         self._group_id_counter = AlphaCounter()
         # self.current_group_id = ''
         self.current_leaf_id = 0
@@ -36,21 +183,41 @@ class Saver(ABC):
         Checks if any futures are completed. If no futures are completed, return immediately. If any are completed with exceptions, raise
         the exceptions in the main thread.
         """
+        while self._futures and (wait or self._futures[0].done()):
+            fut = self._futures.popleft()  # type: futures.Future
+            if fut.exception():  # waits for the future to complete.
+                raise fut.exception()
 
-        if wait:
-            timeout = None
-        else:
-            timeout = 0
-
-        try:
-            completed = futures.as_completed(self._futures, timeout)
-            for fut in completed:  # type: futures.Future
-                self._futures.remove(fut)
-                if fut.exception():
-                    raise fut.exception()
-
-        except futures.TimeoutError:
-            pass
+    def _submit_sequence(self, fn, data, *args, on_written=None):
+        """
+        Submits a sequence write fn(*args) to the writer thread once the queue has room for the sequence data.
+        on_written() is called when the write is done, whether or not it failed.
+        """
+        nbytes = data.nbytes
+        with self._queue_cond:
+            stats = self.queue_stats
+            stats.depths.append(self._queue_length)
+            if self._queue_bytes and self._queue_bytes + nbytes > self.max_queue_bytes:
+                t, in_flight = time.perf_counter(), self._queue_bytes
+                while self._queue_bytes and self._queue_bytes + nbytes > self.max_queue_bytes:
+                    self._queue_cond.wait()
+                stats.stalls.append((in_flight, time.perf_counter() - t))
+            self._queue_bytes += nbytes
+            self._queue_length += 1
+            stats.peak_bytes = max(stats.peak_bytes, self._queue_bytes)
+            stats.peak_depth = max(stats.peak_depth, self._queue_length)
+        fut = self._executor.submit(fn, *args)
+        fut.add_done_callback(partial(self._sequence_written, nbytes, time.perf_counter(), on_written))
+        self._futures.append(fut)
+
+    def _sequence_written(self, nbytes, t_submitted, on_written, fut):
+        with self._queue_cond:
+            self._queue_bytes -= nbytes
+            self._queue_length -= 1
+            self.queue_stats.write_s.append(time.perf_counter() - t_submitted)
+            self._queue_cond.notify_all()
+        if on_written is not None:
+            on_written()
 
     def __enter__(self):
         return self
@@ -69,13 +236,32 @@ class Saver(ABC):
         pass
 
     @abstractmethod
-    def store_sequence_array(self, array: np.ndarray):
+    def store_sequence_array(self, array: np.ndarray, attributes=None, on_written=None):
+        """
+        Savers may keep the array until it is written, so it must not be modified until on_written() is called.
+        """
         pass
 
     @abstractmethod
     def store_affine_matrix(self, matrix: np.ndarray):
         pass
 
+    @abstractmethod
+    def store_generator_params(self, params: dict):
+        pass
+
+    @abstractmethod
+    def store_pattern_bank(self, bank: np.ndarray):
+        pass
+
+    @abstractmethod
+    def store_projection_log(self, sequences: np.ndarray, events: np.ndarray, group=None):
+        pass
+
+    @abstractmethod
+    def store_frame_timestamps(self, timestamps: np.ndarray, attributes: dict, group=None):
+        pass
+
     def iter_pattern_group(self) -> str:
         """
         iterates the pattern group name to next
@@ -90,30 +276,43 @@ class HfiveSaver(Saver):
     """
     Saver object for pattern stimuation patterns.
     """
+    accepts_coordinates = True
 
-    def __init__(self, save_path, overwrite=False, attributes=None):
+    def __init__(self, save_path, overwrite=False, attributes=None, save_frames=True, packing=None,
+                 logical_mask=None, max_queue_bytes=MAX_QUEUE_BYTES):
         """
         :param save_path: Path to where you want to save.
         :param overwrite:  default False. Set true to allow overwrite of existing files. Be careful.
         :param attributes: optional attributes dictionary to save as attributes of the root file.
+        :param save_frames: default True. If False, each sequence leaf holds the indices of its frames instead of the
+        patterns (root attribute 'pattern_storage' is 'frame_indices').
+        :param packing: None, 'bits', 'unmasked' or 'coordinates' (see pack_frames). Packed leaves have 'packing' and 'frame_shape'
+        attributes, and the logical mask used for 'unmasked' packing is saved to /logical_mask.
+        :param logical_mask: boolean array of the unmasked logical pixels (ie generator.unmasked).
+        :param max_queue_bytes: budget of sequence data waiting to be written (see Saver).
         """
-        super(HfiveSaver, self).__init__(nthreads=1)  # this MUST be 1 here, because writes to h5 are not threadsafe.
+        _check_packing(packing, logical_mask)
+        # nthreads MUST be 1 here, because writes to h5 are not threadsafe.
+        super(HfiveSaver, self).__init__(nthreads=1, save_frames=save_frames, max_queue_bytes=max_queue_bytes)
         self.path = save_path
+        self.packing = packing
+        self.logical_mask = logical_mask
         self._patterngroupid = 'patterns'
         self._setup_store(save_path, self.uuid, overwrite, attributes)
 
 
 
-    def store_sequence_array(self, seq_array, attributes=None):
+    def store_sequence_array(self, seq_array, attributes=None, on_written=None):
         """
         Adds a sequence to the h5 file into the current group. Relies on the state of the store to save. This
         wraps the _store_sequence static method, which can be used in another thread.
 
         WATCH OUT FOR THREAD SAFETY HERE. If you modify the array before it is written to disk, everything
-        will break!!
+        will break!! Use on_written to know when the array can be reused.
 
         :param seq_array: numpy array to be saved
         :param attributes: metadata to be saved with the array.
+        :param on_written: optional function called (in the writer thread) once the array is written.
         """
 
         self._check_futures()
@@ -123,25 +322,33 @@ class HfiveSaver(Saver):
         groupname = '/{}/{}'.format(self._patterngroupid, self.current_group_id)
         leafname = '{:06n}'.format(self.current_leaf_id)
 
-        a = self._executor.submit(self._store_sequence, self.path, groupname, leafname, seq_array, attributes)
-        self._futures.append(a)
+        self._submit_sequence(self._store_sequence, seq_array, self.path, groupname, leafname, seq_array, attributes,
+                              self.packing, self.logical_mask, on_written=on_written)
         self.current_leaf_id += 1
 
     @staticmethod
-    def _store_sequence(filename, save_groupname, leafname, data, metadata):
+    def _store_sequence(filename, save_groupname, leafname, data, metadata, packing=None, logical_mask=None):
         """
         static method for use in separate thread. This allows saving in another process, but it does not
         allow access to class state. As implemented, this is wrapped by store_sequence_array
 
         :return:
         """
-
+        frame_shape = data.shape[1:]
+        n_frames = len(data)
+        if data.ndim < 3:  # frame indices are not packed.
+            packing = None
+        data = pack_frames(data, packing, logical_mask)
         with tb.open_file(filename, 'r+') as f:
             arr = f.create_carray(save_groupname, leafname, obj=data, filters=tb.Filters(4, shuffle=False),
                                   createparents=True)
             # shuffle doesn't help w/ random data.
             for k, v in metadata.items():
                 arr.set_attr(k, v)
+            if packing is not None:
+                arr.set_attr('packing', packing)
+                arr.set_attr('frame_shape', frame_shape)
+                arr.set_attr('n_frames', n_frames)
 
     def store_mask_array(self, mask_array: np.ndarray):
         """
@@ -161,6 +368,51 @@ class HfiveSaver(Saver):
         with tb.open_file(self.path, 'r+') as f:
             f.create_array('/', 'affine', obj=matrix)
 
+    def store_generator_params(self, params: dict):
+        """
+        Saves the pattern generator parameters (including its seed) as a json string in the root attribute
+        'generator_params'.
+        :param params: dictionary from the generator's params() method.
+        """
+        self._check_futures(wait=True)
+        with tb.open_file(self.path, 'r+') as f:
+            f.set_node_attr('/', 'generator_params', json.dumps(params))
+
+    def store_pattern_bank(self, bank: np.ndarray):
+        """
+        Saves the bank of patterns that is presented through the frame look-up table to /pattern_bank. The sequences
+        then hold the bank indices of their frames (root attribute 'pattern_storage' is 'bank_indices').
+        :param bank: boolean array (n_patterns, h, w)
+        """
+        self._check_futures(wait=True)
+        with tb.open_file(self.path, 'r+') as f:
+            f.create_carray('/', 'pattern_bank', obj=bank, filters=tb.Filters(4, shuffle=False))
+            f.set_node_attr('/', 'pattern_storage', 'bank_indices')
+
+    def store_projection_log(self, sequences: np.ndarray, events: np.ndarray, group=None):
+        """
+        Saves the display bookkeeping of a group to the tables /projection/<group>/sequences and
+        /projection/<group>/events (see projection.ProjectionLog).
+        :param sequences: structured array of the displayed sequences (projection.SEQUENCE_DTYPE).
+        :param events: structured array of underruns, late uploads and duplicates (projection.EVENT_DTYPE).
+        :param group: pattern group name, by default the current group.
+        """
+        self._check_futures(wait=True)
+        with tb.open_file(self.path, 'r+') as f:
+            _create_projection_tables(f, group or self.current_group_id, sequences, events)
+
+    def store_frame_timestamps(self, timestamps: np.ndarray, attributes: dict, group=None):
+        """
+        Saves the host times of the displayed frames of a group to the table /projection/<group>/timestamps, with the
+        clock model parameters as its attributes (see projection.FrameClock).
+        :param timestamps: structured array of the displayed sequences (projection.TIMESTAMP_DTYPE).
+        :param attributes: dictionary of clock model parameters (ProjectionLog.timestamp_attributes).
+        :param group: pattern group name, by default the current group.
+        """
+        self._check_futures(wait=True)
+        with tb.open_file(self.path, 'r+') as f:
+            _create_timestamp_table(f, group or self.current_group_id, timestamps, attributes)
+
     def _setup_store(self, path, uuid_str, overwrite=False, attributes=None):
         """
 
@@ -174,11 +426,213 @@ class HfiveSaver(Saver):
             print('Overwriting file at {}'.format(path))
         with tb.open_file(path, 'w', title="Rand_pat_file_v1:{}".format(uuid_str)) as f:
             f.create_group('/', self._patterngroupid, tb.Filters(5))
+            f.set_node_attr('/', 'pattern_storage', 'frames' if self.save_frames else 'frame_indices')
+            f.set_node_attr('/', 'pattern_packing', self.packing or 'none')
+            if self.packing == 'unmasked':
+                f.create_array('/', 'logical_mask', obj=self.logical_mask)
             if attributes and type(attributes) == dict:
                 for k, v in attributes.items():
                     f.set_node_attr('/', k, v)
 
 
+class HfiveStreamSaver(Saver):
+    """
+    Saver for pattern stimulation patterns that keeps the h5 file open in its writer thread. The frames of each
+    pattern group (run) are appended to one extendable array, /patterns/GROUP/frames, with one frame per chunk. The
+    table /patterns/GROUP/sequences has one row per sequence with its leaf number, its offset ('start') and number of
+    rows ('n_rows') in the frames array, its number of frames ('n_frames') and its metadata. Rows are frames unless
+    the frames are stored as coordinates.
+    """
+    accepts_coordinates = True
+
+    def __init__(self, save_path, overwrite=False, attributes=None, save_frames=True, packing=None,
+                 logical_mask=None, flush_every=50, max_queue_bytes=MAX_QUEUE_BYTES, max_string_bytes=MAX_STRING_BYTES):
+        """
+        :param save_path: Path to where you want to save.
+        :param overwrite:  default False. Set true to allow overwrite of existing files. Be careful.
+        :param attributes: optional attributes dictionary to save as attributes of the root file.
+        :param save_frames: default True. If False, the frame indices of each sequence are saved instead of the
+        patterns (see HfiveSaver).
+        :param packing: None, 'bits', 'unmasked' or 'coordinates' (see HfiveSaver). The frames arrays get the 'packing' and
+        'frame_shape' attributes.
+        :param logical_mask: boolean array of the unmasked logical pixels (ie generator.unmasked).
+        :param flush_every: number of sequences written between flushes of the file to disk.
+        :param max_queue_bytes: budget of sequence data waiting to be written (see Saver).
+        :param max_string_bytes: width of the string metadata columns. Longer (utf-8 encoded) strings raise a
+        ValueError instead of being truncated.
+        """
+        _check_packing(packing, logical_mask)
+        # nthreads MUST be 1 here: the file handle is only used by the writer thread.
+        super(HfiveStreamSaver, self).__init__(nthreads=1, save_frames=save_frames, max_queue_bytes=max_queue_bytes)
+        self.path = save_path
+        self.packing = packing
+        self.logical_mask = logical_mask
+        self._patterngroupid = 'patterns'
+        self._flush_every = flush_every
+        self.max_string_bytes = max_string_bytes
+        self._file = None  # type: tb.File
+        self._groups = {}  # group name: (frames array, sequences table), only used by the writer thread.
+        self._n_unflushed = 0
+        if not overwrite and os.path.exists(save_path):
+            raise FileExistsError('File already exists and overwrite is False.')
+        elif overwrite and os.path.exists(save_path):
+            print('Overwriting file at {}'.format(save_path))
+        self._executor.submit(self._open, save_path, self.uuid, attributes).result()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._executor.submit(self._close)
+        super(HfiveStreamSaver, self).__exit__(exc_type, exc_val, exc_tb)
+        self._check_futures(wait=True)
+
+    def store_sequence_array(self, seq_array, attributes=None, on_written=None):
+        """
+        Appends a sequence to the current group's frames array. The array is written in another thread, so it must
+        not be modified until it is written.
+
+        :param seq_array: numpy array to be saved
+        :param attributes: metadata to be saved with the array.
+        :param on_written: optional function called (in the writer thread) once the array is written.
+        """
+        self._check_futures()
+        if attributes is None:
+            attributes = {}
+        for k, v in attributes.items():
+            if isinstance(v, str) and len(v.encode()) > self.max_string_bytes:
+                raise ValueError('Metadata {} is longer than max_string_bytes ({}).'.format(k, self.max_string_bytes))
+        self._submit_sequence(self._append, seq_array, self.current_group_id, self.current_leaf_id, seq_array,
+                              attributes, on_written=on_written)
+        self.current_leaf_id += 1
+
+    def store_mask_array(self, mask_array: np.ndarray):
+        """
+        Saves pixel array representing the masked pixels in the recording.
+        :param mask_array: boolean numpy ndarray
+        """
+        self._executor.submit(self._create_array, 'pixel_mask', mask_array).result()
+
+    def store_affine_matrix(self, matrix: np.ndarray):
+        """
+        Adds affine transform matrix to the recording file.
+        :param matrix: affine transform matrix
+        """
+        self._executor.submit(self._create_array, 'affine', matrix).result()
+
+    def store_generator_params(self, params: dict):
+        """
+        Saves the pattern generator parameters as a json string in the root attribute 'generator_params'.
+        :param params: dictionary from the generator's params() method.
+        """
+        self._executor.submit(self._file.set_node_attr, '/', 'generator_params', json.dumps(params)).result()
+
+    def store_pattern_bank(self, bank: np.ndarray):
+        """
+        Saves the bank of patterns that is presented through the frame look-up table (see HfiveSaver).
+        :param bank: boolean array (n_patterns, h, w)
+        """
+        self._executor.submit(self._create_array, 'pattern_bank', bank).result()
+        self._executor.submit(self._file.set_node_attr, '/', 'pattern_storage', 'bank_indices').result()
+
+    def store_projection_log(self, sequences: np.ndarray, events: np.ndarray, group=None):
+        """
+        Saves the display bookkeeping of a group (see HfiveSaver).
+        :param sequences: structured array of the displayed sequences (projection.SEQUENCE_DTYPE).
+        :param events: structured array of underruns, late uploads and duplicates (projection.EVENT_DTYPE).
+        :param group: pattern group name, by default the current group.
+        """
+        self._executor.submit(_create_projection_tables, self._file, group or self.current_group_id, sequences,
+                              events).result()
+
+    def store_frame_timestamps(self, timestamps: np.ndarray, attributes: dict, group=None):
+        """
+        Saves the host times of the displayed frames of a group (see HfiveSaver).
+        :param timestamps: structured array of the displayed sequences (projection.TIMESTAMP_DTYPE).
+        :param attributes: dictionary of clock model parameters (ProjectionLog.timestamp_attributes).
+        :param group: pattern group name, by default the current group.
+        """
+        self._executor.submit(_create_timestamp_table, self._file, group or self.current_group_id, timestamps,
+                              attributes).result()
+
+    # the following methods run in the writer thread.
+
+    def _open(self, path, uuid_str, attributes):
+        self._file = tb.open_file(path, 'w', title="Rand_pat_file_v1:{}".format(uuid_str))
+        self._file.create_group('/', self._patterngroupid, tb.Filters(5))
+        self._file.set_node_attr('/', 'pattern_storage', 'frames' if self.save_frames else 'frame_indices')
+        self._file.set_node_attr('/', 'pattern_layout', 'stream')
+        self._file.set_node_attr('/', 'pattern_packing', self.packing or 'none')
+        if self.packing == 'unmasked':
+            self._file.create_array('/', 'logical_mask', obj=self.logical_mask)
+        if attributes and type(attributes) == dict:
+            for k, v in attributes.items():
+                self._file.set_node_attr('/', k, v)
+
+    def _close(self):
+        self._file.close()
+
+    def _create_array(self, name, obj):
+        self._file.create_array('/', name, obj=obj)
+        self._file.flush()
+
+    def _append(self, group_name, leaf, data, metadata):
+        n_frames = len(data)
+        packing = self.packing if data.ndim == 3 else None  # frame indices are not packed.
+        frame_shape = data.shape[1:]
+        data = pack_frames(data, packing, self.logical_mask)
+        if group_name not in self._groups:
+            self._groups[group_name] = self._create_group(group_name, data, metadata, packing, frame_shape)
+        frames, sequences = self._groups[group_name]
+        row = sequences.row
+        row['leaf'] = leaf
+        row['start'] = frames.nrows
+        row['n_frames'] = n_frames
+        row['n_rows'] = len(data)
+        for k, v in metadata.items():
+            if k in sequences.colnames:
+                row[k] = v
+        row.append()
+        frames.append(data)
+        self._n_unflushed += 1
+        if self._n_unflushed >= self._flush_every:
+            self._file.flush()
+            self._n_unflushed = 0
+
+    def _create_group(self, group_name, data: np.ndarray, metadata: dict, packing, frame_shape):
+        """ creates the frames array and sequences table of a group, using the first sequence for their types. """
+        group = self._file.create_group('/' + self._patterngroupid, group_name)
+        row_shape = data.shape[1:]
+        if row_shape and packing != 'coordinates':
+            chunkshape = (1,) + row_shape  # one frame per chunk.
+        else:
+            chunkshape = None
+        # shuffle doesn't help w/ random data.
+        frames = self._file.create_earray(group, 'frames', atom=tb.Atom.from_dtype(data.dtype),
+                                          shape=(0,) + row_shape, filters=tb.Filters(4, shuffle=False),
+                                          chunkshape=chunkshape)
+        if packing is not None:
+            frames.set_attr('packing', packing)
+            frames.set_attr('frame_shape', frame_shape)
+        description = {'leaf': tb.Int32Col(pos=0), 'start': tb.Int64Col(pos=1), 'n_rows': tb.Int64Col(pos=2),
+                       'n_frames': tb.Int32Col(pos=3)}
+        for k, v in metadata.items():
+            col = self._column_for(v, self.max_string_bytes)
+            if col is not None and k not in description:
+                description[k] = col
+        sequences = self._file.create_table(group, 'sequences', description)
+        return frames, sequences
+
+    @staticmethod
+    def _column_for(value, string_bytes):
+        if isinstance(value, (bool, np.bool_)):
+            return tb.BoolCol()
+        elif isinstance(value, (int, np.integer)):
+            return tb.Int64Col()
+        elif isinstance(value, (float, np.floating)):
+            return tb.Float64Col()
+        elif isinstance(value, str):
+            return tb.StringCol(string_bytes)
+        return None
+
+
 class SparseSaver(Saver):
     """
     Saver for sparse matrices.
@@ -188,16 +642,18 @@ class SparseSaver(Saver):
     sparse package. Frame metadata is saved within a csv file, which has the suffix and extension 
     '_framedata.csv'.
     """
+    accepts_coordinates = True
 
-    def __init__(self, working_dir, file_prefix, overwrite=False, attributes=None):
+    def __init__(self, working_dir, file_prefix, overwrite=False, attributes=None, save_frames=True):
         """
 
         :param working_dir:
         :param file_prefix:
         :param overwrite:
         :param attributes:
+        :param save_frames: if False, only the frame data csv is written for each sequence (no sparse matrices).
         """
-        super(SparseSaver, self).__init__()
+        super(SparseSaver, self).__init__(save_frames=save_frames)
 
         self._file_prefix = file_prefix
         self._working_dir = working_dir
@@ -227,29 +683,43 @@ class SparseSaver(Saver):
             raise FileExistsError('Files exist with the pattern: {}'.format(pattern))
 
 
-    def store_sequence_array(self, seq_array:np.ndarray, attributes=None):
+    def store_sequence_array(self, seq_array:np.ndarray, attributes=None, on_written=None):
         """
 
-        :param seq_array: Sequence array to save. If this is a 3d array, it will be saved as a 2d sparse matrix.
+        :param seq_array: Sequence array to save. If this is a 3d array or FrameCoordinates, it will be saved as a 2d
+        sparse matrix.
         :param attributes: Dictionary
+        :param on_written: optional function called once the array is written (before this returns).
         :return:
         """
 
-        if seq_array.ndim == 3:
+        if not self.save_frames:
+            if attributes is None:
+                attributes = {}
+            attributes['first_frame'], attributes['n'] = seq_array[0], len(seq_array)
+        elif isinstance(seq_array, FrameCoordinates):
+            if attributes is None:
+                attributes = {}
+            attributes['n'], attributes['h'], attributes['w'] = seq_array.shape
+            seq_array = seq_array.to_csr()
+        elif seq_array.ndim == 3:
             if attributes is None:
                 attributes = {}
             npix, h, w = seq_array.shape
             attributes['n'], attributes['h'], attributes['w'] = npix, h, w
-            seq_array.shape = npix, w * h
+            seq_array = seq_array.reshape(npix, w * h)  # a view, the caller's array keeps its shape.
 
         if attributes is not None:
             if self._framedata_csv is None:
                 self._setup_framedata(list(attributes.keys()))
             self._framedata_csv.writerow(attributes)
 
-        savepath = "{}_{}:{:06d}.sparse.npz".format(self._path_start, self.current_group_id, self.current_leaf_id)
-        self._store_sequence(savepath, seq_array)
+        if self.save_frames:
+            savepath = "{}_{}:{:06d}.sparse.npz".format(self._path_start, self.current_group_id, self.current_leaf_id)
+            self._store_sequence(savepath, seq_array)
         self.current_leaf_id += 1
+        if on_written is not None:
+            on_written()
         return
 
     @staticmethod
@@ -269,6 +739,35 @@ class SparseSaver(Saver):
         np.save(path, matrix)
         pass
 
+    def store_generator_params(self, params: dict):
+        """ saves the pattern generator parameters (including its seed) to json file COMMONPREFIX_generator.json """
+        with open(self._path_start + '_generator.json', 'w') as f:
+            json.dump(params, f)
+
+    def store_pattern_bank(self, bank: np.ndarray):
+        """
+        saves the bank of patterns that is presented through the frame look-up table to COMMONPREFIX_bank.npy. The
+        sequence files then hold the bank indices of their frames.
+        """
+        np.save(self._path_start + '_bank.npy', bank)
+
+    def store_projection_log(self, sequences: np.ndarray, events: np.ndarray, group=None):
+        """
+        saves the display bookkeeping of a group (by default the current group, see projection.ProjectionLog) to
+        COMMONPREFIX_GROUP_projection.npz, with the arrays 'sequences' and 'events'.
+        """
+        np.savez(self._path_start + '_{}_projection.npz'.format(group or self.current_group_id),
+                 sequences=sequences, events=events)
+
+    def store_frame_timestamps(self, timestamps: np.ndarray, attributes: dict, group=None):
+        """
+        saves the host times of the displayed frames of a group (by default the current group, see
+        projection.FrameClock) to COMMONPREFIX_GROUP_timestamps.npz, with the array 'timestamps' and an array for each
+        clock model parameter.
+        """
+        np.savez(self._path_start + '_{}_timestamps.npz'.format(group or self.current_group_id),
+                 timestamps=timestamps, **attributes)
+
     def _setup_store(self, path, uuid_str, extra_data=None):
         """ writes a json file specifying information about the run like uuid and data description
          This is only run once when the store is made. """
@@ -286,6 +785,35 @@ class SparseSaver(Saver):
         self._framedata_csv.writeheader()
 
 
+class SaveQueueStats:
+    """
+    Counters and timings of the save queue (see Saver).
+    """
+    def __init__(self):
+        self.depths = []  # sequences waiting or being written when a sequence is submitted.
+        self.write_s = []  # time from submission to completion of each write.
+        self.stalls = []  # (bytes in flight, seconds waited) of each submission that waited for room in the queue.
+        self.peak_bytes = 0
+        self.peak_depth = 0
+
+    def summary(self) -> dict:
+        latencies = np.percentile(self.write_s, [50, 95, 99]) * 1e3 if self.write_s else np.zeros(3)
+        return {
+            'sequences': len(self.depths),
+            'mean_depth': float(np.mean(self.depths)) if self.depths else 0.,
+            'peak_depth': self.peak_depth,
+            'peak_mb': self.peak_bytes / 2 ** 20,
+            'write_p50_ms': latencies[0],
+            'write_p95_ms': latencies[1],
+            'write_p99_ms': latencies[2],
+            'stalls': len(self.stalls),
+            'stall_s': sum(s for _, s in self.stalls),
+        }
+
+    def __str__(self):
+        return 'Save queue: ' + ', '.join('{}={:.3g}'.format(k, v) for k, v in self.summary().items())
+
+
 class AlphaCounter:
     """
     Simple counter that counts in lowercase letters instead of numbers (ie aaa, aab, aac...).
@@ -2,40 +2,129 @@
 import numpy as np
 from dmdlib.core.ALP import AlpDmd
 from dmdlib.randpatterns import utils
+from dmdlib.randpatterns.geometry import MaskGeometry
 from dmdlib.randpatterns import ephys_comms
 import os
-from dmdlib.randpatterns import saving
-from dmdlib.randpatterns.presenter import Presenter
+from collections import OrderedDict
+from dmdlib.randpatterns.presenter import presenter_from_args
+from dmdlib.randpatterns.saving import FrameCoordinates
 if os.name == 'nt':
     appdataroot = os.environ['APPDATA']
     appdatapath = os.path.join(appdataroot, 'dmdlib')
 
 
 class SparseNoise:
-    def __init__(self, probability, mask=None, scale=1):
+    """
+    Stimulus generator for sparse random patterns. Each frame is drawn from its own counter-based random stream, so
+    any frame can be regenerated from the seed and parameters (see params and regenerate module).
+
+    There are two generation methods. 'dense' draws every pixel and renders whole frames in one parallel pass
+    (utils.sparse_frames_render). 'sparse' draws only the positions of the on pixels (utils.sparse_coordinates) and
+    renders them into the reused upload buffers after clearing the pixels that were on before, so its cost scales
+    with the number of on pixels. The coordinate list of the last sequence (last_coordinates) can be saved instead
+    of the frames.
+    """
+    SPARSE_MAX_PROBABILITY = .05  # 'auto' uses the sparse method up to this probability.
+    _MAX_TRACKED_BUFFERS = 32
+
+    def __init__(self, probability, mask=None, scale=1, seed=None, method='auto'):
+        """
+        :param probability: probability of each logical pixel being on.
+        :param mask: boolean mask of the DMD shape.
+        :param scale: logical pixel size in mirrors.
+        :param seed: session seed. If None, a random seed is used (it is available from params()).
+        :param method: 'dense', 'sparse' or 'auto' (sparse for probabilities up to SPARSE_MAX_PROBABILITY). The
+        methods draw different patterns from the same seed.
+        """
+        if method == 'auto':
+            method = 'sparse' if probability <= self.SPARSE_MAX_PROBABILITY else 'dense'
+        if method not in ('dense', 'sparse'):
+            raise ValueError("method must be 'dense', 'sparse' or 'auto'.")
+        self.method = method
+        self.last_coordinates = None  # type: FrameCoordinates
+        self._rendered = OrderedDict()  # buffers: coordinates currently rendered in them (sparse method).
         self.threshold = probability
         self.scale = scale
+        self.streams = utils.FrameStreams(seed)
+        self.frame_index = 0  # index of the next frame to be generated.
+        self._key = self.streams.kernel_key()
+        self._int_threshold = utils.probability_threshold(probability)
         if mask is not None:
             self.mask = mask
-            self.unmasked = utils.find_unmasked_px(mask, scale)
-            self.n_unmasked_pix = self.unmasked.sum()
+            self.geometry = MaskGeometry.get(mask, scale)
+            self.unmasked = self.geometry.unmasked
+            self.n_unmasked_pix = self.geometry.n_unmasked
+            self._unmasked_idx = self.geometry.unmasked_idx
 
     def make_patterns(self, boolean_array: np.ndarray, whole_seq_array: np.ndarray, debug):
         """
         Modifies arrays in place with random values (on, off).
 
         :param boolean_array: boolean array that is of shape ( n_frames, h / scale, w / scale)
-        :param whole_seq_array: array of uint8 values of shave (n_frames, h, w)
+        :param whole_seq_array: array of uint8 values of shape (n_frames, h, w), or packed binary (see AlpFrameSequence)
         :param debug: not implemented.
         :return:
         """
         n_frames, h, w = boolean_array.shape
-        total_randnums = n_frames * self.n_unmasked_pix
-        randnums = np.random.rand(total_randnums)
-        randbool = randnums <= self.threshold
-        utils.reshape(randbool, self.unmasked, boolean_array)
-        utils.zoomer(boolean_array, self.scale, whole_seq_array)
-        whole_seq_array *= self.mask
+        buffers = (boolean_array.ctypes.data, boolean_array.shape, whole_seq_array.ctypes.data, whole_seq_array.shape)
+        packed = whole_seq_array.shape[2] < self.mask.shape[1]
+        if packed:
+            whole_seq_array = utils.packed_rows(whole_seq_array, self.mask.shape[1])
+        geometry = self.geometry
+        if self.method == 'dense':
+            utils.sparse_frames_render(self._key, self.frame_index, self._int_threshold, self._unmasked_idx,
+                                       self.scale, geometry.mask, geometry.full, boolean_array, whole_seq_array, packed)
+        else:
+            indptr, indices = utils.sparse_coordinates(self._key, self.frame_index, n_frames, self.threshold,
+                                                       self._unmasked_idx)
+            self._clear_rendered(buffers, boolean_array, whole_seq_array, packed)
+            utils.render_coordinates(indptr, indices, self.scale, geometry.mask, geometry.full, boolean_array,
+                                     whole_seq_array, packed, True)
+            self._rendered[buffers] = indptr, indices
+            self.last_coordinates = FrameCoordinates(indptr, indices, boolean_array.shape)
+        self.frame_index += n_frames
+
+    def _clear_rendered(self, buffers, boolean_array, whole_seq_array, packed):
+        """
+        Clears the pixels of the coordinates that were last rendered into these buffers. Buffers that were not
+        rendered before are cleared completely. The buffers must not be written to by anything else.
+        """
+        if buffers in self._rendered:
+            indptr, indices = self._rendered.pop(buffers)
+            utils.render_coordinates(indptr, indices, self.scale, self.geometry.mask, self.geometry.full,
+                                     boolean_array, whole_seq_array, packed, False)
+        else:
+            boolean_array[:] = False
+            whole_seq_array[:] = 0
+            if len(self._rendered) >= self._MAX_TRACKED_BUFFERS:
+                self._rendered.popitem(last=False)
+
+    def frames(self, start, boolean_array: np.ndarray):
+        """
+        Writes the logical pixel values of frames start, start + 1, ... into boolean_array. This does not change the
+        state of the generator, so it can be used to regenerate frames (also from multiple threads).
+
+        :param start: index of the first frame.
+        :param boolean_array: boolean array of shape (n_frames, h / scale, w / scale).
+        """
+        if self.method == 'dense':
+            utils.sparse_frames(self._key, start, self._int_threshold, self._unmasked_idx, boolean_array)
+        else:
+            n_frames, h, w = boolean_array.shape
+            indptr, indices = utils.sparse_coordinates(self._key, start, n_frames, self.threshold,
+                                                       self._unmasked_idx)
+            frame_numbers = FrameCoordinates(indptr, indices, boolean_array.shape).frame_numbers()
+            boolean_array[:] = False
+            boolean_array[frame_numbers, indices // w, indices % w] = True
+
+    def params(self) -> dict:
+        """ parameters needed to regenerate the patterns of this generator (with the mask). """
+        return {'generator': 'SparseNoise', 'seed': self.streams.seed, 'probability': self.threshold,
+                'scale': self.scale, 'method': self.method}
+
+    @classmethod
+    def from_params(cls, params: dict, mask):
+        return cls(params['probability'], mask, params['scale'], params['seed'], params.get('method', 'dense'))
 
 
 def main():
@@ -44,6 +133,7 @@ def main():
     parser.add_argument('fraction_on', type=float,
                         help='fraction of pixels on per presentation frame (between 0 and 1)')
     args = parser.parse_args()
+    MaskGeometry.disk_cache = True  # reuses the geometry of the mask across sessions.
     frac = args.fraction_on
     if frac > 1. or frac < 0.:
         errst = 'Fraction argument must be between 0 and 1.'
@@ -55,29 +145,37 @@ def main():
         raise FileExistsError(errst)
 
     mask = np.load(args.maskfile)
-    generator = SparseNoise(frac, mask, args.scale)
+    generator = SparseNoise(frac, mask, args.scale, args.seed)
 
     presentations_per = min([60000, args.nframes])
 
     if not args.no_phys:
-        openephys = ephys_comms.OpenEphysComms()
+        openephys = ephys_comms.OpenEphysChannel()
 
     n_runs = int(np.ceil(args.nframes / presentations_per))
     assert n_runs > 0
-    with saving.HfiveSaver(fullpath, args.overwrite) as saver, AlpDmd() as dmd:
+    with utils.make_saver(args, fullpath, logical_mask=generator.unmasked) as saver, \
+            utils.make_dmd(args) as dmd:
         saver.store_mask_array(mask)
+        saver.store_generator_params(generator.params())
         uuid = saver.uuid
         if not args.no_phys:
             openephys.record_start(uuid, fullpath)
-        run_id = saver.current_group_id
-        for i in range(n_runs):
+            openephys.flush()  # raises OpenEphysError if OpenEphys does not reply.
+
+        def run_start(i, run_id):
             print("Starting presentation run {} of {} ({}).".format(i + 1, n_runs, run_id))
             if not args.no_phys:
                 openephys.record_presentation(run_id)
-            presenter = Presenter(dmd, generator, saver, presentations_per, image_scale=args.scale,
-                                  picture_time=args.pic_time, )
-            presenter.run()
-            run_id = saver.iter_pattern_group()
+
+        # the runs are presented in one session, without stopping the projection between them.
+        presenter = presenter_from_args(args, dmd, generator, saver, presentations_per,
+                                        markers=None if args.no_phys else openephys)
+        presenter.run_session(n_runs, on_run_start=run_start)
+    if not args.no_phys:
+        openephys.close()
+        print(openephys)
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,217 @@
+"""
+Aligns the sync pulses recorded with the ephys data to the saved sequences.
+
+In master mode, the DMD puts out a sync pulse with every displayed frame. The Presenter gives each allocated sequence a
+distinct pulse width (saved as 'sync_pulse_dur_us' with the sequence's 'seq_id'), so the width of each pulse tells
+which device sequence was displayed. decode_pulses classifies the widths, splits the pulses into runs displayed by one
+device sequence, and matches the runs to the sequences in the order they were displayed (the projection log), so that
+each recorded pulse is mapped to the pattern group, leaf and frame of the sequence it displayed.
+
+Pulses are counted in frame steps from their spacing, so missing pulses leave gaps in the frames of a sequence
+instead of shifting them, and pulses that can't be classified or matched (glitches, extra pulses) are left unmapped.
+"""
+
+import numpy as np
+import tables as tb
+
+EXPECTED_DTYPE = np.dtype([
+    ('group', 'S16'),  # pattern group.
+    ('leaf', np.int32),
+    ('seq_id', np.int32),  # device sequence.
+    ('pulse_width_us', np.float64),  # sync pulse width of the device sequence.
+    ('n_frames', np.int32),
+    ('repeats', np.int32),  # times the sequence was displayed in a row.
+])
+
+PULSE_DTYPE = np.dtype([
+    ('group', 'S16'),  # pattern group of the displayed sequence, b'' if the pulse is not mapped.
+    ('leaf', np.int32),  # -1 if the pulse is not mapped.
+    ('frame', np.int32),  # frame of the sequence, -1 if the pulse is not mapped.
+    ('seq_id', np.int32),  # device sequence of the pulse width, -1 if it was not classified.
+])
+
+
+def expected_sequences(path, groups=None) -> np.ndarray:
+    """
+    Reads the sequences of an .h5 recording in the order they were displayed (from the projection log, or in leaf
+    order if the recording has none), with the pulse widths of their device sequences.
+
+    :param path: path to the .h5 file.
+    :param groups: pattern groups in presentation order (default: all of them).
+    :return: EXPECTED_DTYPE structured array.
+    """
+    rows = []
+    with tb.open_file(path, 'r') as f:
+        for group in groups or sorted(f.root.patterns._v_children):
+            metadata = read_sequence_metadata(f, group)
+            if '/projection/{}'.format(group) in f:
+                log = f.get_node('/projection/{}/sequences'.format(group)).read()
+                order = [(int(r['leaf']), int(r['repeats'])) for r in log]
+            else:
+                order = [(leaf, 1) for leaf in sorted(metadata)]
+            for leaf, repeats in order:
+                seq_id, width, n_frames = metadata[leaf]
+                rows.append((group, leaf, seq_id, width, n_frames, repeats))
+    return np.array(rows, dtype=EXPECTED_DTYPE)
+
+
+def read_sequence_metadata(f: tb.File, group) -> dict:
+    """
+    :param f: open tables file of a recording saved by HfiveSaver or HfiveStreamSaver.
+    :param group: pattern group name (ie 'aaa').
+    :return: {leaf: (seq_id, sync_pulse_dur_us, n_frames)}
+    """
+    attrs = f.root._v_attrs
+    group_node = f.get_node('/patterns/{}'.format(group))
+    if 'pattern_layout' in attrs and attrs['pattern_layout'] == 'stream':
+        return {int(r['leaf']): (int(r['seq_id']), float(r['sync_pulse_dur_us']), int(r['n_frames']))
+                for r in group_node.sequences.read()}
+    metadata = {}
+    for name, node in group_node._v_children.items():
+        n_frames = node.attrs['n_frames'] if 'n_frames' in node.attrs else len(node)
+        metadata[int(name)] = (int(node.attrs['seq_id']), float(node.attrs['sync_pulse_dur_us']), int(n_frames))
+    return metadata
+
+
+def pulse_widths(rising, falling) -> np.ndarray:
+    """
+    Pairs each rising edge with the next falling edge.
+
+    :param rising: sorted times of the rising edges.
+    :param falling: sorted times of the falling edges.
+    :return: width of each pulse, NaN if its falling edge is missing (the next edge is a rising edge).
+    """
+    rising = np.asarray(rising, dtype=np.float64)
+    falling = np.asarray(falling, dtype=np.float64)
+    widths = np.full(len(rising), np.nan)
+    idx = np.searchsorted(falling, rising, side='right')
+    has_fall = idx < len(falling)
+    fall = falling[np.minimum(idx, len(falling) - 1)] if len(falling) else np.zeros(len(rising))
+    next_rise = np.r_[rising[1:], np.inf]
+    paired = has_fall & (fall < next_rise)
+    widths[paired] = fall[paired] - rising[paired]
+    return widths
+
+
+def classify_widths(widths_us, sequence_widths: dict, tolerance_us=None) -> np.ndarray:
+    """
+    :param widths_us: pulse widths in microseconds.
+    :param sequence_widths: {seq_id: pulse width in microseconds}.
+    :param tolerance_us: largest difference to a sequence's width (default: half of the smallest difference between
+    the sequences' widths).
+    :return: int32 seq_id of each pulse, -1 for pulses that don't match a sequence.
+    """
+    ids = np.array(sorted(sequence_widths, key=sequence_widths.get), dtype=np.int32)
+    reference = np.array([sequence_widths[i] for i in ids], dtype=np.float64)
+    if tolerance_us is None:
+        tolerance_us = np.diff(reference).min() / 2 if len(reference) > 1 else np.inf
+    widths_us = np.asarray(widths_us, dtype=np.float64)
+    # nearest reference width: compare with the neighbours of the insertion point.
+    idx = np.clip(np.searchsorted(reference, widths_us), 1, max(len(reference) - 1, 1))
+    lower = np.maximum(idx - 1, 0)
+    upper = np.minimum(idx, len(reference) - 1)
+    nearest = np.where(np.abs(widths_us - reference[lower]) <= np.abs(widths_us - reference[upper]), lower, upper)
+    seq_ids = ids[nearest]
+    seq_ids[~(np.abs(widths_us - reference[nearest]) <= tolerance_us)] = -1  # also NaN widths.
+    return seq_ids
+
+
+def decode_pulses(rising, falling, expected: np.ndarray, time_scale_us=1e6, tolerance_us=None, lookahead=4):
+    """
+    Maps recorded sync pulses to the frames of the displayed sequences.
+
+    :param rising: sorted times of the rising edges of the sync pulses.
+    :param falling: sorted times of the falling edges.
+    :param expected: sequences in order of display (see expected_sequences).
+    :param time_scale_us: microseconds per time unit of the edges (1e6 for seconds, 1e6 / sample_rate for samples).
+    :param tolerance_us: see classify_widths.
+    :param lookahead: number of expected sequences a run of pulses is matched against. Runs that don't match any of
+    them are left unmapped, and expected sequences that are skipped are assumed to have no recorded pulses.
+    :return: PULSE_DTYPE structured array with one row per rising edge, and a summary dictionary.
+    """
+    rising = np.asarray(rising, dtype=np.float64)
+    sequence_widths = {int(e['seq_id']): float(e['pulse_width_us']) for e in expected}
+    seq_ids = classify_widths(pulse_widths(rising, falling) * time_scale_us, sequence_widths, tolerance_us)
+    pulses = np.zeros(len(rising), dtype=PULSE_DTYPE)
+    pulses['leaf'] = pulses['frame'] = -1
+    pulses['seq_id'] = seq_ids
+
+    valid = np.flatnonzero(seq_ids >= 0)
+    if len(valid) < 2:
+        return pulses, _summary(pulses, expected, 0)
+    t = rising[valid]
+    ids = seq_ids[valid]
+    interval = np.median(np.diff(t))
+    # frame steps between pulses: 1, or more where pulses are missing or the display paused.
+    steps = np.maximum(np.rint(np.diff(t) / interval), 0).astype(np.int64)
+    step = np.r_[0, np.cumsum(steps)]
+    run_starts = np.r_[0, np.flatnonzero(np.diff(ids) != 0) + 1]
+    run_stops = np.r_[run_starts[1:], len(ids)]
+
+    frames = np.full(len(valid), -1, dtype=np.int64)
+    matched = np.full(len(valid), -1, dtype=np.int64)  # expected sequence of each pulse.
+    runs = list(zip(run_starts.tolist(), run_stops.tolist()))[::-1]  # stack, next run last.
+    expected_ids = expected['seq_id'].tolist()
+    n_frames = expected['n_frames'].astype(np.int64)
+    lengths = (n_frames * expected['repeats']).tolist()
+    ends = np.cumsum([0] + lengths).tolist()  # frames before each expected sequence, without pauses.
+    n_expected = len(expected)
+    e = 0  # next expected sequence.
+    last = None  # (expected sequence, first frame step, step after its end) of the last matched run.
+    while runs:
+        a, b = runs.pop()
+        if last is not None and expected_ids[last[0]] == ids[a] and step[a] < last[2]:
+            j, start, _ = last  # pulses of the last sequence after extra pulses.
+        else:
+            # the sequence can't start before the previous one ended, plus the sequences that were skipped.
+            j = e
+            stop = min(e + lookahead, n_expected)
+            while j < stop and (expected_ids[j] != ids[a] or
+                                (last is not None and step[a] < last[2] + ends[j] - ends[e])):
+                j += 1
+            if j == stop:
+                continue  # extra pulses.
+            # missing pulses are assumed at the end of the sequence, unless it would then overlap the previous one.
+            start = step[b - 1] - lengths[j] + 1
+            if last is not None:
+                start = max(start, last[2] + ends[j] - ends[e])
+            start = min(step[a], start)
+            last = (j, start, start + lengths[j])
+            e = j + 1
+        position = step[a:b] - start
+        inside = position < lengths[j]
+        frames[a:b][inside] = position[inside] % n_frames[j]
+        matched[a:b][inside] = j
+        if not inside.all():  # the rest of the run was displayed by the next sequence (with the same seq_id).
+            runs.append((a + int(np.argmin(inside)), b))
+
+    mapped = matched >= 0
+    rows = valid[mapped]
+    pulses['group'][rows] = expected['group'][matched[mapped]]
+    pulses['leaf'][rows] = expected['leaf'][matched[mapped]]
+    pulses['frame'][rows] = frames[mapped]
+    return pulses, _summary(pulses, expected, interval * time_scale_us)
+
+
+def _summary(pulses, expected, interval_us) -> dict:
+    mapped = pulses['leaf'] >= 0
+    n_expected = int(np.sum(expected['n_frames'].astype(np.int64) * expected['repeats']))
+    return {
+        'pulses': len(pulses),
+        'mapped': int(mapped.sum()),
+        'unclassified': int(np.sum(pulses['seq_id'] < 0)),
+        'unmatched': int(np.sum((pulses['seq_id'] >= 0) & ~mapped)),
+        'expected_frames': n_expected,
+        'missing': n_expected - int(mapped.sum()),
+        'interval_us': float(interval_us),
+    }
+
+
+def decode_recording(path, rising, falling, groups=None, **kwargs):
+    """
+    Maps recorded sync pulses to the frames of an .h5 recording (see decode_pulses and expected_sequences).
+
+    :return: PULSE_DTYPE structured array with one row per rising edge, and a summary dictionary.
+    """
+    return decode_pulses(rising, falling, expected_sequences(path, groups), **kwargs)
+
@@ -8,7 +8,7 @@ import numpy as np
 import numba
 from dmdlib.randpatterns import utils
 from dmdlib.randpatterns import saving
-from dmdlib.randpatterns.presenter import Presenter
+from dmdlib.randpatterns.presenter import presenter_from_args
 from dmdlib.core.ALP import AlpDmd
 import os
 
@@ -36,7 +36,7 @@ class TestGenerator:
             self._make_text_fast(msg, boolean_array[i, :, :], margins=(2, 2, 37, 37))
             self._count += 1
 
-        utils.zoomer(boolean_array, self.scale, whole_seq_array)
+        utils.render_sequence(boolean_array, self.scale, whole_seq_array)
 
     def _make_text_fast(self, text, array, margins=(10, 10, 150, 150)):
         mask = font.getmask(text)
@@ -99,18 +99,17 @@ def main():
 
     n_runs = int(np.ceil(args.nframes / presentations_per))
     assert n_runs > 0
-    with saving.HfiveSaver(fullpath, args.overwrite) as saver, AlpDmd() as dmd:
+    with saving.HfiveSaver(fullpath, args.overwrite) as saver, utils.make_dmd(args) as dmd:
         # saver.store_mask_array(mask)
         uuid = saver.uuid
         # ephys_comms.record_start(uuid, fullpath)
-        run_id = saver.current_group_id
-        for i in range(n_runs):
+
+        def run_start(i, run_id):
             print("Starting presentation run {} of {} ({}).".format(i + 1, n_runs, run_id))
             # ephys_comms.record_presentation(run_id)
-            presenter = Presenter(dmd, generator, saver, presentations_per, scale=args.scale,
-                                  picture_time=args.pic_time, )
-            presenter.run()
-            run_id = saver.iter_pattern_group()
+
+        presenter = presenter_from_args(args, dmd, generator, saver, presentations_per)
+        presenter.run_session(n_runs, on_run_start=run_start)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,42 @@
+"""
+Tests the staging buffer pool.
+"""
+
+import unittest
+import threading
+import numpy as np
+from dmdlib.randpatterns.buffers import BufferPool
+
+
+class TestBufferPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = BufferPool(2, lambda: (np.zeros((4, 3, 3), dtype=bool), np.zeros((4, 12, 12), dtype=np.uint8)))
+
+    def test_reuse(self):
+        a = self.pool.acquire()
+        a.retain()  # eg. held by the saver.
+        a.release()
+        b = self.pool.acquire()
+        self.assertIsNot(a, b)
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(self.pool.acquire()))
+        waiter.start()
+        waiter.join(.1)
+        self.assertEqual(acquired, [])  # both buffers are in use.
+        a.release()
+        waiter.join(1.)
+        self.assertEqual(acquired, [a])
+        self.assertEqual(len(self.pool._buffers), 2)
+        self.assertEqual(self.pool.waits, 1)
+        self.assertEqual(self.pool.nbytes, 2 * (36 + 576))
+
+    def test_over_release(self):
+        a = self.pool.acquire()
+        a.release()
+        with self.assertRaises(ValueError):
+            a.release()
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4)
@@ -0,0 +1,140 @@
+"""
+Tests the OpenEphys channel against a local stand-in for the OpenEphys ZMQ socket.
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
+import zmq
+from dmdlib.core.ALP import AlpDmd
+from dmdlib.core.emulator import AlpEmulator
+from dmdlib.randpatterns.presenter import Presenter
+from dmdlib.randpatterns.saving import HfiveSaver
+from dmdlib.randpatterns.sparsenoise_obj import SparseNoise
+from dmdlib.randpatterns import ephys_comms
+
+
+class StandIn:
+    """ replies to the messages like OpenEphys, except for the first ignore messages. """
+    def __init__(self, ignore=0):
+        self.ignore = ignore
+        self.received = []
+        self._sock = ephys_comms._ctx.socket(zmq.ROUTER)  # can leave requests unanswered, unlike REP.
+        self.port = self._sock.bind_to_random_port('tcp://127.0.0.1')
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self._sock.poll(10):
+                continue
+            identity, empty, msg = self._sock.recv_multipart()
+            if self.ignore:
+                self.ignore -= 1
+                continue
+            self.received.append(msg.decode())
+            self._sock.send_multipart([identity, empty, b'received'])
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._sock.close(linger=0)
+
+
+class TestOpenEphysChannel(unittest.TestCase):
+
+    def test_messages_and_markers(self):
+        server = StandIn()
+        with ephys_comms.OpenEphysChannel('127.0.0.1', server.port, max_batch=3, batch_interval=10.) as channel:
+            channel.send('start')
+            for i in range(4):
+                channel.mark('m{}'.format(i))
+            channel.send('end')  # sends the waiting marker first.
+            self.assertTrue(channel.flush(5.))
+        server.close()
+        self.assertEqual(server.received, ['start', 'm0; m1; m2', 'm3', 'end'])
+        summary = channel.summary()
+        self.assertEqual((summary['sent'], summary['markers'], summary['batches']), (4, 4, 2))
+        self.assertEqual((summary['dropped'], summary['timeouts'], summary['reconnects']), (0, 0, 0))
+
+    def test_batch_interval(self):
+        server = StandIn()
+        with ephys_comms.OpenEphysChannel('127.0.0.1', server.port, batch_interval=.01) as channel:
+            channel.mark('a')
+            t = time.perf_counter()
+            while not server.received and time.perf_counter() - t < 5.:
+                time.sleep(.005)
+        server.close()
+        self.assertEqual(server.received, ['a'])
+
+    def test_timeouts(self):
+        server = StandIn(ignore=1)
+        channel = ephys_comms.OpenEphysChannel('127.0.0.1', server.port, timeout_ms=50, retries=1)
+        channel.send('retried')
+        self.assertTrue(channel.flush(5.))
+        self.assertEqual(server.received, ['retried'])
+        self.assertEqual((channel.timeouts, channel.reconnects, channel.dropped), (1, 1, 0))
+
+        server.ignore = 2
+        t = time.perf_counter()
+        channel.send('dropped')
+        self.assertLess(time.perf_counter() - t, .05)  # the caller doesn't wait for the reply.
+        with self.assertRaises(ephys_comms.OpenEphysError):
+            channel.flush(5.)
+        channel.send('sent')
+        self.assertTrue(channel.flush(5.))  # the error was reported.
+        channel.close()
+        server.close()
+        self.assertEqual(server.received, ['retried', 'sent'])
+        self.assertEqual(channel.dropped, 1)
+
+    def test_send_errors(self):
+        """ messages that raise in the thread are dropped, and the thread keeps serving the queue. """
+        channel = ephys_comms.OpenEphysChannel('127.0.0.1', 'no port')
+        channel.send('a')
+        channel.mark('b')
+        with self.assertRaises(ephys_comms.OpenEphysError):
+            channel.flush(5.)
+        self.assertIsInstance(channel.last_error, zmq.ZMQError)
+        self.assertEqual(channel.dropped, 2)
+        channel.send('c')
+        with self.assertRaises(ephys_comms.OpenEphysError):
+            channel.flush(5.)
+        channel.close()
+        self.assertFalse(channel._thread.is_alive())
+
+
+class TestPresenterMarkers(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_sequence_onsets(self):
+        server = StandIn()
+        path = os.path.join(self.workdir, 'markers.h5')
+        emulator = AlpEmulator(width=64, height=48, usb_bandwidth=None, conversion_bandwidth=None)
+        with ephys_comms.OpenEphysChannel('127.0.0.1', server.port, batch_interval=.01) as channel, \
+                HfiveSaver(path) as saver, AlpDmd(backend=emulator) as dmd:
+            presenter = Presenter(dmd, SparseNoise(.2, np.ones((48, 64), dtype=bool), 4), saver, 60, pix_per_seq=10,
+                                  picture_time=5000, poll_interval=.002, markers=channel)
+            presenter.run_session(2)
+            presenter.shutdown()
+            channel.flush(5.)
+        server.close()
+        markers = [m for msg in server.received for m in msg.split(ephys_comms.MARKER_SEPARATOR)]
+        self.assertEqual(len(markers), 12)
+        onsets = [m.split() for m in markers]
+        self.assertEqual([m[1] for m in onsets], ['{}/{}'.format(g, leaf) for g in ('aaa', 'aab') for leaf in range(6)])
+        self.assertEqual(sorted(float(m[-1]) for m in onsets), [float(m[-1]) for m in onsets])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4)
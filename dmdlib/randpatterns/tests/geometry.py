@@ -0,0 +1,87 @@
+"""
+Tests the mask geometry against find_unmasked_px and render_sequence, and its disk cache.
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from dmdlib.randpatterns import utils
+from dmdlib.randpatterns.geometry import MaskGeometry
+
+
+def make_mask():
+    """ ROI in rows 10 to 37 and columns 6 to 49, with a masked column inside. """
+    mask = np.zeros((48, 64), dtype=bool)
+    mask[10:38, 6:50] = True
+    mask[:, 21] = False
+    return mask
+
+
+class TestMaskGeometry(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_geometry(self):
+        mask = make_mask()
+        for scale in (1, 3, 4):
+            geometry = MaskGeometry(mask, scale)
+            self.assertTrue(np.all(geometry.unmasked == utils.find_unmasked_px(mask, scale)))
+            self.assertTrue(np.all(geometry.unmasked_idx == np.flatnonzero(geometry.unmasked)))
+            self.assertFalse(np.any(geometry.full & ~geometry.unmasked))
+            y0, y1, x0, x1 = geometry.box
+            self.assertEqual(geometry.box, (10 // scale, (37 // scale) + 1, 6 // scale, (49 // scale) + 1))
+            self.assertEqual(geometry.unmasked[y0:y1, x0:x1].sum(), geometry.n_unmasked)
+        geometry = MaskGeometry(mask, 4)
+        self.assertTrue(geometry.full[3, 2])
+        self.assertFalse(geometry.full[3, 5])  # column 21 is masked.
+        self.assertFalse(geometry.full[2, 2])  # rows 8 and 9 are masked.
+
+    def test_render(self):
+        """ render must write the frames of render_sequence, also for logical pixels that are on outside the mask. """
+        mask = make_mask()
+        rng = np.random.default_rng(0)
+        for scale, row_bytes in ((4, None), (3, None), (4, 8), (1, 8)):
+            geometry = MaskGeometry(mask, scale)
+            frames = rng.random((5,) + geometry.unmasked.shape) < .5
+            shape = (5, 48, 64) if row_bytes is None else (5, 48, row_bytes)
+            expected = np.zeros(shape, dtype=np.uint8)
+            utils.render_sequence(frames, scale, expected, mask)
+            rendered = np.full(shape, 7, dtype=np.uint8)  # also cleared outside of the ROI box.
+            geometry.render(frames, rendered)
+            self.assertTrue(np.all(rendered == expected))
+
+    def test_scatter(self):
+        geometry = MaskGeometry(make_mask(), 4)
+        values = np.random.default_rng(1).random((3, geometry.n_unmasked)) < .5
+        frames = np.zeros((3,) + geometry.unmasked.shape, dtype=bool)
+        geometry.scatter(values, frames)
+        self.assertTrue(np.all(frames[:, geometry.unmasked] == values))
+        self.assertFalse(np.any(frames[:, ~geometry.unmasked]))
+
+    def test_cache(self):
+        mask = make_mask()
+        key = MaskGeometry.mask_key(mask, 4)
+        self.assertNotEqual(key, MaskGeometry.mask_key(mask, 3))
+        MaskGeometry._cache.pop(key, None)
+        self.assertFalse(MaskGeometry.disk_cache)  # the disk is only used if asked to.
+        MaskGeometry.get(mask, 4)
+        MaskGeometry._cache.pop(key)
+        geometry = MaskGeometry.get(mask, 4, self.workdir)
+        self.assertIs(MaskGeometry.get(mask.copy(), 4, self.workdir), geometry)
+        self.assertTrue(os.path.exists(os.path.join(self.workdir, key + '.npz')))
+        MaskGeometry._cache.pop(key)
+        cached = MaskGeometry.get(mask, 4, self.workdir)  # from the disk.
+        self.assertIsNot(cached, geometry)
+        self.assertTrue(np.all(cached.full == geometry.full))
+        self.assertEqual(cached.mirror_box, geometry.mirror_box)
+        MaskGeometry._cache.pop(key)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4)
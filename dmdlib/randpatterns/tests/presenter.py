@@ -0,0 +1,227 @@
+"""
+Runs the presenters end to end against the emulated ALP device.
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+import tables as tb
+from dmdlib.core.ALP import AlpDmd
+from dmdlib.core.emulator import AlpEmulator
+from dmdlib.randpatterns.presenter import Presenter, PipelinedPresenter, FlutPresenter
+from dmdlib.randpatterns.bank import PatternBank
+from dmdlib.randpatterns.autotune import SequenceCosts, autotune, choose_sequences
+from dmdlib.randpatterns import regenerate
+from dmdlib.randpatterns.saving import HfiveSaver
+from dmdlib.randpatterns.sparsenoise_obj import SparseNoise
+
+
+class TestPresenter(unittest.TestCase):
+    presenter_class = Presenter
+    kwargs = {}
+    nframes = 100
+    pix_per_seq = 10
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'presenter.h5')
+        self.emulator = AlpEmulator(width=64, height=48, usb_bandwidth=None, conversion_bandwidth=None,
+                                    keep_data=True)
+        mask = np.ones((48, 64), dtype=bool)
+        mask[:, :8] = False
+        self.generator = SparseNoise(.2, mask, 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _run(self, **kwargs):
+        with HfiveSaver(self.path) as saver, AlpDmd(backend=self.emulator) as dmd:
+            presenter = self.presenter_class(dmd, self.generator, saver, self.nframes, pix_per_seq=self.pix_per_seq,
+                                             picture_time=5000, poll_interval=.002, **kwargs)
+            presenter.run()
+            group = saver.current_group_id
+            presenter.shutdown()
+        self.buffers = presenter.buffers
+        return group
+
+    def test_run(self):
+        group = self._run(**self.kwargs)
+        self.assertEqual(self.emulator.frames_displayed(), self.nframes)
+        self.assertEqual(self.emulator.idle_gaps, [])
+        with tb.open_file(self.path) as f:
+            leaves = f.list_nodes('/patterns/{}'.format(group))
+            self.assertEqual(len(leaves), self.nframes // self.pix_per_seq)
+            self.assertTrue(all(l.shape == (self.pix_per_seq, 12, 16) for l in leaves))
+            self.assertFalse(np.any(leaves[-1].read()[:, :, :2]))  # masked.
+            saved = np.concatenate([l.read() for l in leaves])
+        # the patterns are saved from the staging buffers, which must not be refilled before they are written.
+        self.assertTrue(np.all(saved == regenerate.regenerate_frames(self.generator, 0, self.nframes)))
+        self.assertLessEqual(len(self.buffers._buffers), self.buffers.n_buffers)
+        self.assertEqual(len(self.buffers._free), len(self.buffers._buffers))
+        sequences, events = regenerate.read_projection_log(self.path, group)
+        self.assertEqual(len(events), 0)
+        self.assertEqual(list(sequences['leaf']), list(range(len(leaves))))
+        self.assertEqual(sequences['offset_frame'][-1], self.nframes)
+        onsets, clock = regenerate.read_frame_timestamps(self.path, group)
+        self.assertEqual(len(onsets), self.nframes)
+        self.assertTrue(np.all(np.diff(onsets) > 0))
+        self.assertGreater(clock['n_observations'], 0)
+
+    def test_packed(self):
+        self._run(packed=True, **self.kwargs)
+        self.assertEqual(self.emulator.frames_displayed(), self.nframes)
+
+    def test_session(self):
+        n_runs = 3
+        started = []
+        with HfiveSaver(self.path) as saver, AlpDmd(backend=self.emulator) as dmd:
+            presenter = self.presenter_class(dmd, self.generator, saver, self.nframes, pix_per_seq=self.pix_per_seq,
+                                             picture_time=5000, poll_interval=.002, **self.kwargs)
+            presenter.run_session(n_runs, on_run_start=lambda i, group: started.append((i, group)))
+            n_allocated = len(dmd.seq_handles)
+            presenter.shutdown()
+        self.assertEqual(self.emulator.frames_displayed(), n_runs * self.nframes)
+        self.assertEqual(self.emulator.idle_gaps, [])  # no frames lost between runs.
+        self.assertEqual(n_allocated, 3)
+        self.assertEqual([i for i, _ in started], list(range(n_runs)))
+        with tb.open_file(self.path) as f:
+            self.assertEqual([g for _, g in started], sorted(f.root.patterns._v_children))
+        for _, group in started:
+            sequences, events = regenerate.read_projection_log(self.path, group)
+            self.assertEqual(len(events), 0)
+            self.assertEqual(list(sequences['leaf']), list(range(self.nframes // self.pix_per_seq)))
+            self.assertEqual(sequences['onset_frame'][0], 0)
+            self.assertEqual(sequences['offset_frame'][-1], self.nframes)
+
+
+class TestPipelinedPresenter(TestPresenter):
+    presenter_class = PipelinedPresenter
+    kwargs = {'read_ahead': 2}
+
+    def test_no_ready_sequence(self):
+        # uploads that the worker won't generate raise instead of waiting forever.
+        with HfiveSaver(self.path) as saver, AlpDmd(backend=self.emulator) as dmd:
+            presenter = PipelinedPresenter(dmd, self.generator, saver, self.nframes, pix_per_seq=self.pix_per_seq,
+                                           picture_time=5000, **self.kwargs)
+            presenter._worker = threading.Thread(target=lambda: None)
+            presenter._worker.start()
+            presenter._worker.join()
+            presenter._n_generated = 1
+            with self.assertRaises(RuntimeError):  # the worker stopped.
+                presenter._next_ready()
+            presenter._ready.put('item')
+            self.assertEqual(presenter._next_ready(), 'item')
+            with self.assertRaises(RuntimeError):  # past the sequences of the session.
+                presenter._next_ready()
+            presenter.shutdown()
+
+
+class TestAutotune(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'autotune.h5')
+        self.generator = SparseNoise(.2, np.ones((48, 64), dtype=bool), 4)
+        # 10 ms + .1 ms per frame to generate and upload each.
+        self.costs = SequenceCosts((10, 40), (.011, .014), (.011, .014))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_choose_sequences(self):
+        settings = choose_sequences(self.costs, 1000, 40000, 32, poll_interval=.1, safety=2.)
+        n, nseqs = settings['pix_per_seq'], settings['nseqs']
+        self.assertLessEqual(2 * self.costs.sequence_time(n), n * 1e-3)
+        self.assertGreaterEqual((nseqs - 1) * n * 1e-3, 2 * (.1 + self.costs.sequence_time(n)))
+        self.assertGreaterEqual(settings['max_nseqs'], nseqs)
+        # a short queue needs fewer, longer sequences.
+        short_queue = choose_sequences(self.costs, 1000, 40000, 2, poll_interval=.1, safety=2.)
+        self.assertLessEqual(short_queue['nseqs'], 3)
+        self.assertGreater(short_queue['pix_per_seq'], n)
+        with self.assertRaises(ValueError):
+            choose_sequences(self.costs, 300, 40000, 32)  # .2 ms per frame can't be refreshed at 300 us.
+        with self.assertRaises(ValueError):
+            choose_sequences(self.costs, 1000, 200, 32)  # not enough memory.
+
+    def test_autotuned_run(self):
+        emulator = AlpEmulator(width=64, height=48, usb_bandwidth=2e6, conversion_bandwidth=None)
+        with HfiveSaver(self.path) as saver, AlpDmd(backend=emulator) as dmd:
+            settings = autotune(dmd, self.generator, 2000, image_scale=4, poll_interval=.002)
+            self.assertEqual(self.generator.frame_index, 0)
+            self.assertEqual(dmd.avail_memory, emulator.memory)  # trial sequences are freed.
+            presenter = Presenter(dmd, self.generator, saver, 100, picture_time=2000, poll_interval=.002,
+                                  **settings)
+            presenter.run()
+            presenter.shutdown()
+        self.assertGreaterEqual(emulator.frames_displayed(), 100)
+        self.assertEqual(emulator.idle_gaps, [])
+
+    def test_adds_sequences(self):
+        # each refresh takes ~25 ms, and sequences are noticed up to 30 ms after they finish: two sequences of 50 ms
+        # drain the queue.
+        emulator = AlpEmulator(width=64, height=48, usb_bandwidth=1.5e5, conversion_bandwidth=None)
+        with HfiveSaver(self.path) as saver, AlpDmd(backend=emulator) as dmd:
+            presenter = Presenter(dmd, self.generator, saver, 200, nseqs=2, pix_per_seq=10, picture_time=5000,
+                                  poll_interval=.03, max_nseqs=4)
+            presenter.run()
+            pulse_widths = [s.syncpulsewidth for s in presenter.sequences.values()]
+            presenter.shutdown()
+        self.assertGreater(presenter.sequences_added, 0)
+        self.assertLessEqual(len(pulse_widths), 4)
+        self.assertEqual(len(set(pulse_widths)), len(pulse_widths))
+        self.assertEqual(emulator.frames_displayed(), 200)
+        # the queue runs empty before sequences are added, the underruns are logged.
+        summary = presenter.projection_log.summary()
+        gaps = np.array([end - start for start, end in emulator.idle_gaps]) / .005  # in picture times.
+        # onsets are estimated within half a picture time, gaps shorter than 2 may be missed.
+        self.assertGreaterEqual(summary['underruns'], np.sum(gaps > 2))
+        self.assertLessEqual(summary['underruns'], np.sum(gaps > 1))
+        self.assertAlmostEqual(summary['underrun_frames'], np.sum(gaps[gaps > 1]), delta=len(gaps) + 1)
+        self.assertEqual(summary['frames'], 200)
+
+    def test_added_sequence_ends_session(self):
+        # the sequence added when the queue drains is the last upload of the session, the refresh stops there.
+        emulator = AlpEmulator(width=64, height=48, usb_bandwidth=1.5e5, conversion_bandwidth=None)
+        with HfiveSaver(self.path) as saver, AlpDmd(backend=emulator) as dmd:
+            presenter = Presenter(dmd, self.generator, saver, 40, nseqs=2, pix_per_seq=10, picture_time=5000,
+                                  poll_interval=.03, max_nseqs=8)
+            presenter.run()
+            presenter.shutdown()
+        self.assertEqual(presenter.sequence_counter, 4)
+        self.assertEqual(emulator.frames_displayed(), 40)
+
+
+class TestFlutPresenter(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'flut.h5')
+        self.emulator = AlpEmulator(width=64, height=48, usb_bandwidth=None, conversion_bandwidth=None,
+                                    keep_data=True)
+        self.patterns = np.random.rand(6, 12, 16) < .3
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_run(self):
+        generator = PatternBank(self.patterns, np.ones((48, 64), dtype=bool), 4, seed=1)
+        with HfiveSaver(self.path) as saver, AlpDmd(backend=self.emulator) as dmd:
+            presenter = FlutPresenter(dmd, generator, saver, 60, pix_per_seq=10, picture_time=5000,
+                                      poll_interval=.002)
+            presenter.run()
+            group = saver.current_group_id
+            presenter.shutdown()
+        self.assertEqual(self.emulator.frames_displayed(), 60)
+        self.assertEqual(self.emulator.idle_gaps, [])
+        sequences = self.emulator._sequences.values()
+        self.assertTrue(all(seq.n_uploads == 1 and len(seq.data) == 6 for seq in sequences))
+        displayed = np.concatenate([frames for _, _, frames in self.emulator.flut_log])
+        saved = np.concatenate([regenerate.regenerate_sequence(self.path, group, leaf) for leaf in range(6)])
+        self.assertTrue(np.all(self.patterns[displayed] == saved))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4)
@@ -0,0 +1,151 @@
+"""
+Tests the display bookkeeping (with a simulated clock) and the projection monitor against the emulated ALP device.
+"""
+
+import unittest
+import numpy as np
+from dmdlib.core.ALP import AlpDmd
+from dmdlib.core.emulator import AlpEmulator
+from dmdlib.randpatterns.projection import ProjectionLog, ProjectionMonitor, FrameClock
+
+
+class Clock:
+    def __init__(self):
+        self.t = 100.
+
+    def __call__(self):
+        return self.t
+
+    def sleep(self, dt):
+        self.t += dt
+
+    def ns(self):
+        return int(round(self.t * 1e9))
+
+
+class TestProjectionLog(unittest.TestCase):
+    n_frames = 10
+    picture_time = 1000
+
+    def setUp(self):
+        self.clock = Clock()
+        self.emulator = AlpEmulator(width=64, height=48, usb_bandwidth=None, conversion_bandwidth=None,
+                                    clock=self.clock, sleep=self.clock.sleep)
+        self.dmd = AlpDmd(backend=self.emulator)
+        self.dmd.seq_queue_mode()
+        self.sequences = [self.dmd.seq_alloc(1, self.n_frames) for _ in range(2)]
+        for seq in self.sequences:
+            seq.set_timing(picturetime=self.picture_time)
+            seq.upload_array()
+        self.log = ProjectionLog(self.picture_time, clock=self.clock.ns)
+
+    def tearDown(self):
+        self.dmd.shutdown()
+
+    def _start(self, seq, leaf):
+        seq.start_projection()
+        self.log.enqueued(leaf, int(seq), self.dmd.queue_id, self.n_frames)
+
+    def _poll(self, dt):
+        self.clock.sleep(dt)
+        self.log.update(self.dmd.get_projecting_progress())
+
+    def test_contiguous(self):
+        a, b = self.sequences
+        self._start(a, 0)
+        self._start(b, 1)
+        self._poll(.0053)
+        self._start(a, 2)  # refreshed while b is waiting.
+        self._poll(.0102)
+        self._poll(.03)
+        self.log.finish()
+        seqs = self.log.sequences()
+        self.assertEqual(list(seqs['onset_frame']), [0, 10, 20])
+        self.assertEqual(list(seqs['offset_frame']), [10, 20, 30])
+        self.assertTrue(np.allclose(seqs['onset_s'], [0, .01, .02], atol=.0006))
+        self.assertEqual(list(seqs['observed']), [True, True, False])
+        self.assertEqual(len(self.log.events()), 0)
+        stamps = self.log.timestamps()
+        self.assertEqual(list(stamps['segment']), [0, 0, 0])
+        self.assertTrue(np.allclose(stamps['onset_ns'] - self.log.t0_ns, [0, 1e7, 2e7], atol=6e5))
+
+    def test_underrun(self):
+        a, b = self.sequences
+        self._start(a, 0)
+        self._start(b, 1)
+        self._poll(.025)  # both have finished.
+        self._start(a, 2)
+        self._poll(.001)
+        self.log.finish()
+        events = self.log.events()
+        self.assertEqual(list(events['kind']), [b'underrun', b'late_upload'])
+        self.assertTrue(np.all(events['leaf'] == 2))
+        self.assertTrue(np.all(events['frame'] == 20))
+        self.assertEqual(events['n_frames'][0], 5)
+        self.assertEqual(self.log.sequences()['gap_frames'][2], 5)
+        self.assertEqual(list(self.log.timestamps()['segment']), [0, 0, 1])
+
+    def test_duplicate(self):
+        a, b = self.sequences
+        self._start(a, 0)
+        self._start(b, 1)
+        self._start(a, 0)  # enqueued again without a new upload.
+        self._poll(.025)
+        self.log.finish()
+        events = self.log.events()
+        self.assertEqual(list(events['kind']), [b'duplicate'])
+        self.assertEqual(events['frame'][0], 20)
+        self.assertEqual(self.log.summary()['frames'], 30)
+
+
+class TestFrameClock(unittest.TestCase):
+
+    def test_drift(self):
+        """ polls at random times of a display whose frames are 50 ppm longer than nominal, with a gap. """
+        rng = np.random.default_rng(0)
+        nominal, interval = 1e-3, 1e-3 * (1 + 50e-6)
+        clock = FrameClock(nominal * 1e6)
+        onsets = {0: 5., 50000: 60.}  # first frame of each segment: onset.
+        for first, onset in onsets.items():
+            if first:
+                clock.new_segment(first)
+            for t in np.sort(rng.uniform(onset, onset + 40000 * interval, 1000)):
+                clock.observe(first + int((t - onset) // interval), t)
+        summary = clock.summary()
+        self.assertAlmostEqual(summary['drift_ppm'], 50., delta=5.)
+        self.assertAlmostEqual(summary['jitter_ns'], interval / np.sqrt(12) * 1e9, delta=30e3)
+        self.assertEqual(summary['n_segments'], 2)
+        for first, onset in onsets.items():
+            self.assertAlmostEqual(clock.frame_time(first + 20000), onset + 20000 * interval, delta=50e-6)
+
+
+class TestProjectionMonitor(unittest.TestCase):
+
+    def test_transitions(self):
+        emulator = AlpEmulator(width=64, height=48, usb_bandwidth=None, conversion_bandwidth=None)
+        with AlpDmd(backend=emulator) as dmd:
+            dmd.seq_queue_mode()
+            sequences = [dmd.seq_alloc(1, 5) for _ in range(6)]
+            for seq in sequences:
+                seq.set_timing(picturetime=4000)
+                seq.upload_array()
+            displayed = []
+            with ProjectionMonitor(dmd, max_interval=.05,
+                                   on_transition=lambda p: displayed.append(int(p.SequenceId))) as monitor:
+                for seq in sequences:
+                    seq.start_projection()
+                monitor.kick()
+                seen = 0
+                while seen < len(sequences) + 1:  # each start, and the queue running empty.
+                    seen = monitor.wait(seen, 1.)
+        self.assertEqual(displayed[:len(sequences)], [int(s) for s in sequences])
+        summary = monitor.summary()
+        self.assertEqual(summary['missed'], 0)
+        self.assertEqual(len(monitor.wake_latency_s), len(sequences))
+        self.assertLess(summary['max_wake_latency_ms'], 4.)  # polled within a picture time of the boundaries.
+        # a poll every .5 ms for each 20 ms sequence would be 240.
+        self.assertLess(summary['polls'], 150)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4)
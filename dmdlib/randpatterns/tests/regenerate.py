@@ -0,0 +1,145 @@
+"""
+Tests for seeded pattern generation and regeneration of saved patterns.
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from dmdlib.core.ALP import AlpDmd
+from dmdlib.core.emulator import AlpEmulator
+from dmdlib.randpatterns.presenter import Presenter
+from dmdlib.randpatterns.saving import HfiveSaver
+from dmdlib.randpatterns.sparsenoise_obj import SparseNoise
+from dmdlib.randpatterns.multisparse_obj import MultiSparse
+from dmdlib.randpatterns import regenerate, utils
+
+
+def make_mask():
+    mask = np.ones((48, 64), dtype=bool)
+    mask[:8, :] = False
+    return mask
+
+
+class TestSeededGenerators(unittest.TestCase):
+
+    def _check_addressable(self, generator):
+        h, w = generator.unmasked.shape
+        whole = np.zeros((40, h, w), dtype=bool)
+        generator.frames(0, whole)
+        part = np.zeros((15, h, w), dtype=bool)
+        generator.frames(17, part)
+        self.assertTrue(np.all(whole[17:32] == part))
+        self.assertTrue(np.any(whole))
+        copy = regenerate.make_generator(generator.params(), generator.mask)
+        self.assertTrue(np.all(regenerate.regenerate_frames(copy, 0, 40, chunk_size=7) == whole))
+
+    def test_sparsenoise(self):
+        self._check_addressable(SparseNoise(.1, make_mask(), 4, seed=42))
+
+    def test_multisparse(self):
+        self._check_addressable(MultiSparse([.05, .5], 10, make_mask(), 4, seed=42))
+
+    def test_make_patterns(self):
+        generator = SparseNoise(.1, make_mask(), 4, seed=3)
+        seq_array_bool = np.zeros((10, 12, 16), dtype=bool)
+        seq_array = np.zeros((10, 48, 64), dtype=np.uint8)
+        generator.make_patterns(seq_array_bool, seq_array, False)
+        generator.make_patterns(seq_array_bool, seq_array, False)
+        self.assertEqual(generator.frame_index, 20)
+        self.assertTrue(np.all(regenerate.regenerate_frames(generator, 10, 20) == seq_array_bool))
+
+    def test_fused_render(self):
+        """ make_patterns must render the same patterns as render_sequence does from frames. """
+        mask = make_mask()
+        mask[:, 5] = False
+        for scale in (1, 3, 4):
+            generator = SparseNoise(.1, mask, scale, seed=11)
+            h, w = generator.unmasked.shape
+            expected_bool = np.zeros((10, h, w), dtype=bool)
+            generator.frames(0, expected_bool)
+            for row_bytes in (None, 8):
+                shape = (10, 48, 64) if row_bytes is None else (10, 48, row_bytes)
+                expected = np.zeros(shape, dtype=np.uint8)
+                utils.render_sequence(expected_bool, scale, expected, mask)
+                seq_array_bool = np.zeros_like(expected_bool)
+                seq_array = np.full(shape, 7, dtype=np.uint8)
+                generator.frame_index = 0
+                generator.make_patterns(seq_array_bool, seq_array, False)
+                self.assertTrue(np.all(seq_array_bool == expected_bool))
+                self.assertTrue(np.all(seq_array == expected))
+
+    def test_sparse_method(self):
+        """ sparse generation into reused buffers must match its frames and render_sequence. """
+        mask = make_mask()
+        for scale, row_bytes in ((4, None), (3, 8), (1, None)):
+            generator = SparseNoise(.02, mask, scale, seed=5)
+            self.assertEqual(generator.method, 'sparse')
+            h, w = generator.unmasked.shape
+            shape = (10, 48, 64) if row_bytes is None else (10, 48, row_bytes)
+            seq_array_bool = np.zeros((10, h, w), dtype=bool)
+            seq_array = np.zeros(shape, dtype=np.uint8)
+            for _ in range(3):
+                start = generator.frame_index
+                generator.make_patterns(seq_array_bool, seq_array, False)
+                expected_bool = np.zeros_like(seq_array_bool)
+                generator.frames(start, expected_bool)
+                expected = np.zeros(shape, dtype=np.uint8)
+                utils.render_sequence(expected_bool, scale, expected, mask)
+                self.assertTrue(np.all(seq_array_bool == expected_bool))
+                self.assertTrue(np.all(seq_array == expected))
+                self.assertTrue(np.all(generator.last_coordinates.to_dense() == expected_bool))
+            self.assertTrue(np.any(seq_array_bool))
+
+    def test_sparse_probability(self):
+        generator = SparseNoise(.01, np.ones((400, 500), dtype=bool), 1, seed=1, method='sparse')
+        frames = np.zeros((20, 400, 500), dtype=bool)
+        generator.frames(0, frames)
+        self.assertAlmostEqual(frames.mean(), .01, delta=.0005)
+
+
+class TestSeedsOnlySaving(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _run(self, path, save_frames, probability=.2, packing=None):
+        emulator = AlpEmulator(width=64, height=48, usb_bandwidth=None, conversion_bandwidth=None)
+        generator = SparseNoise(probability, make_mask(), 4, seed=7)
+        with HfiveSaver(path, save_frames=save_frames, packing=packing) as saver, AlpDmd(backend=emulator) as dmd:
+            saver.store_mask_array(generator.mask)
+            saver.store_generator_params(generator.params())
+            presenter = Presenter(dmd, generator, saver, 50, pix_per_seq=10, picture_time=5000, poll_interval=.002)
+            presenter.run()
+            group = saver.current_group_id
+            presenter.shutdown()
+        return group
+
+    def test_regenerate(self):
+        frames_path = os.path.join(self.workdir, 'frames.h5')
+        seeds_path = os.path.join(self.workdir, 'seeds.h5')
+        group = self._run(frames_path, True)
+        self._run(seeds_path, False)
+        for leaf in range(5):
+            saved = regenerate.regenerate_sequence(frames_path, group, leaf)
+            regenerated = regenerate.regenerate_sequence(seeds_path, group, leaf)
+            self.assertTrue(np.all(saved == regenerated))
+        self.assertLess(os.path.getsize(seeds_path), os.path.getsize(frames_path))
+
+    def test_coordinates(self):
+        """ coordinates of sparse generation are saved by the presenter and read back as frames. """
+        frames_path = os.path.join(self.workdir, 'frames.h5')
+        coords_path = os.path.join(self.workdir, 'coords.h5')
+        group = self._run(frames_path, True, .02)
+        self._run(coords_path, True, .02, 'coordinates')
+        for leaf in range(5):
+            saved = regenerate.regenerate_sequence(frames_path, group, leaf)
+            self.assertTrue(np.all(saved == regenerate.regenerate_sequence(coords_path, group, leaf)))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4)
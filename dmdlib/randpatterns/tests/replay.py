@@ -0,0 +1,141 @@
+"""
+Tests replaying saved and pre-rendered patterns.
+"""
+
+import unittest
+import os
+import subprocess
+import sys
+import textwrap
+import shutil
+import tempfile
+import numpy as np
+import tables as tb
+import dmdlib
+from dmdlib.core.ALP import AlpDmd
+from dmdlib.core.emulator import AlpEmulator
+from dmdlib.randpatterns.presenter import Presenter
+from dmdlib.randpatterns.replay import FileSource, prerender, whole_sequence_runs
+from dmdlib.randpatterns.saving import HfiveSaver, HfiveStreamSaver, SparseSaver
+from dmdlib.randpatterns.sparsenoise_obj import SparseNoise
+from dmdlib.randpatterns import regenerate, utils
+
+
+def make_mask():
+    mask = np.ones((48, 64), dtype=bool)
+    mask[:8, :] = False
+    return mask
+
+
+class TestFileSource(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.generator = SparseNoise(.1, make_mask(), 4, seed=5)
+        self.expected = regenerate.regenerate_frames(self.generator, 0, 95)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _check_source(self, source: FileSource):
+        """ reads the source in sequences of 20 frames, which do not line up with the saved ones. """
+        self.assertEqual(source.n_frames, 95)
+        seq_array_bool = np.zeros((20, 12, 16), dtype=bool)
+        seq_array = np.zeros((20, 48, 64), dtype=np.uint8)
+        expected = np.zeros_like(seq_array)
+        for start in range(0, 80, 20):
+            source.make_patterns(seq_array_bool, seq_array, False)
+            self.assertTrue(np.all(seq_array_bool == self.expected[start:start + 20]))
+            utils.render_sequence(self.expected[start:start + 20], 4, expected, make_mask())
+            self.assertTrue(np.all(seq_array == expected))
+        with self.assertRaises(EOFError):
+            source.make_patterns(seq_array_bool, seq_array, False)
+        source.close()
+
+    def test_prerendered(self):
+        path = os.path.join(self.workdir, 'rendered.h5')
+        with HfiveStreamSaver(path, packing='unmasked', logical_mask=self.generator.unmasked) as saver:
+            saver.store_mask_array(make_mask())
+            saver.store_generator_params(self.generator.params())
+            prerender(self.generator, saver, 95, frames_per_run=50, pix_per_seq=15, n_workers=2)
+        with tb.open_file(path) as f:
+            self.assertEqual(sorted(f.root.patterns._v_children), ['aaa', 'aab'])
+        self._check_source(FileSource(path, read_ahead=2))
+
+    def test_frame_indices(self):
+        path = os.path.join(self.workdir, 'indices.h5')
+        with HfiveSaver(path, save_frames=False) as saver:
+            saver.store_mask_array(make_mask())
+            saver.store_generator_params(self.generator.params())
+            for start in range(0, 95, 30):
+                saver.store_sequence_array(np.arange(start, min(start + 30, 95)))
+        self._check_source(FileSource(path))
+
+    def test_sparse_saver(self):
+        with SparseSaver(self.workdir, 'sparse', attributes={}) as saver:
+            saver.store_mask_array(make_mask())
+            saver.store_generator_params(self.generator.params())
+            for start in range(0, 95, 30):
+                saver.store_sequence_array(self.expected[start:start + 30].copy())
+        self._check_source(FileSource(os.path.join(self.workdir, 'sparse.json')))
+
+    def test_presenter(self):
+        """ a replayed session uploads the frames of the source. """
+        path = os.path.join(self.workdir, 'rendered.h5')
+        with HfiveSaver(path) as saver:
+            saver.store_mask_array(make_mask())
+            saver.store_generator_params(self.generator.params())
+            prerender(self.generator, saver, 95, pix_per_seq=25)
+        emulator = AlpEmulator(width=64, height=48, usb_bandwidth=None, conversion_bandwidth=None, keep_data=True)
+        replay_path = os.path.join(self.workdir, 'replay.h5')
+        with FileSource(path) as source, HfiveSaver(replay_path) as saver, AlpDmd(backend=emulator) as dmd:
+            presenter = Presenter(dmd, source, saver, 80, pix_per_seq=10, picture_time=5000, poll_interval=.002)
+            presenter.run()
+            presenter.shutdown()
+        self.assertEqual(emulator.frames_displayed(), 80)
+        replayed = np.concatenate([regenerate.regenerate_sequence(replay_path, 'aaa', leaf) for leaf in range(8)])
+        self.assertTrue(np.all(replayed == self.expected[:80]))
+
+    def test_exits(self):
+        """ the interpreter exits after numba kernels ran in worker threads (numba's threads start in the main one). """
+        script = textwrap.dedent("""
+            import sys
+            import numpy as np
+            from dmdlib.randpatterns import regenerate, replay, saving, sparsenoise_obj
+            mask = np.ones((48, 64), dtype=bool)
+            generator = sparsenoise_obj.SparseNoise(.1, mask, 4, seed=5)
+            regenerate.regenerate_frames(generator, 0, 50)
+            with saving.HfiveSaver(sys.argv[1]) as saver:
+                saver.store_mask_array(mask)
+                saver.store_generator_params(generator.params())
+                replay.prerender(generator, saver, 50, pix_per_seq=10, n_workers=2)
+        """)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(dmdlib.__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]))
+        subprocess.run([sys.executable, '-c', script, os.path.join(self.workdir, 'exits.h5')], env=env, timeout=120,
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def test_whole_sequences(self):
+        """ a source whose frames are not a whole number of sequences is presented up to its last whole sequence. """
+        self.assertEqual(whole_sequence_runs(750000, 60000, 250), (60000, 12))
+        self.assertEqual(whole_sequence_runs(95, 95, 10, 3), (90, 1))
+        with self.assertRaises(ValueError):
+            whole_sequence_runs(25, 25, 10, 3)
+        path = os.path.join(self.workdir, 'rendered.h5')
+        with HfiveSaver(path) as saver:
+            saver.store_mask_array(make_mask())
+            saver.store_generator_params(self.generator.params())
+            prerender(self.generator, saver, 95, pix_per_seq=25)
+        emulator = AlpEmulator(width=64, height=48, usb_bandwidth=None, conversion_bandwidth=None)
+        with FileSource(path) as source, HfiveSaver(os.path.join(self.workdir, 'replay.h5')) as saver, \
+                AlpDmd(backend=emulator) as dmd:
+            frames_per_run, n_runs = whole_sequence_runs(source.n_frames, 40, 10, 3)
+            presenter = Presenter(dmd, source, saver, frames_per_run, pix_per_seq=10, picture_time=5000,
+                                  poll_interval=.002)
+            presenter.run_session(n_runs)
+            presenter.shutdown()
+        self.assertEqual(emulator.frames_displayed(), 80)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4)
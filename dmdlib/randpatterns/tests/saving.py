@@ -3,8 +3,10 @@ Classes for saving patterns to various formats.
 """
 
 import unittest
+import threading
 import numpy as np
-from dmdlib.randpatterns.saving import HfiveSaver, SparseSaver
+from dmdlib.randpatterns.saving import HfiveSaver, HfiveStreamSaver, SparseSaver, FrameCoordinates
+from dmdlib.randpatterns.regenerate import read_stored_sequence
 import os
 import tables as tb
 import shutil
@@ -91,6 +93,140 @@ class TestH5_write_completes(unittest.TestCase):
         os.remove(self.pth)
 
 
+class TestSaveQueue(unittest.TestCase):
+    pth = 'test_queue.h5'
+
+    def test_backpressure(self):
+        """ with the writer blocked, the third sequence waits until the queue has room for it. """
+        data = [np.random.randint(0, 2, (10, 30, 40), dtype=bool) for _ in range(4)]
+        blocked = threading.Event()
+        with HfiveSaver(self.pth, overwrite=True, max_queue_bytes=int(2.5 * data[0].nbytes)) as f:
+            f._executor.submit(blocked.wait)
+            timer = threading.Timer(.2, blocked.set)
+            timer.start()
+            for d in data:
+                f.store_sequence_array(d)
+            timer.join()
+        stats = f.queue_stats
+        self.assertIn(len(stats.stalls), (1, 2))  # the last one waits if the writer has not caught up.
+        self.assertEqual(stats.stalls[0][0], 2 * data[0].nbytes)
+        self.assertGreater(stats.stalls[0][1], .1)
+        self.assertEqual(stats.peak_bytes, 2 * data[0].nbytes)
+        self.assertEqual(len(stats.write_s), len(data))
+        self.assertEqual(stats.summary()['stalls'], len(stats.stalls))
+        with tb.open_file(self.pth, 'r') as f2:
+            self.assertEqual(len(f2.root.patterns.aaa._v_children), len(data))
+
+    def tearDown(self):
+        os.remove(self.pth)
+
+
+class TestHfiveStreamSaver(unittest.TestCase):
+    pth = 'test_stream.h5'
+
+    def test_write_read(self):
+        data = [np.random.randint(0, 2, (n, 30, 40), dtype=bool) for n in (20, 35, 10)]
+        attrs = [{'seq_id': i, 'picture_time_us': 1000} for i in range(len(data))]
+        with HfiveStreamSaver(self.pth, overwrite=True, attributes={'a1': 'hello'}) as saver:
+            saver.store_mask_array(np.ones((30, 40), dtype=bool))
+            saver.store_sequence_array(data[0], attrs[0])
+            saver.store_sequence_array(data[1], attrs[1])
+            group1 = saver.current_group_id
+            group2 = saver.iter_pattern_group()
+            saver.store_sequence_array(data[2], attrs[2])
+        with tb.open_file(self.pth, 'r') as f:
+            self.assertEqual(f.get_node_attr('/', 'a1'), 'hello')
+            self.assertTrue('/pixel_mask' in f)
+            frames = f.get_node('/patterns/{}/frames'.format(group1))
+            self.assertEqual(frames.shape, (55, 30, 40))
+            self.assertEqual(frames.chunkshape, (1, 30, 40))
+            table = f.get_node('/patterns/{}/sequences'.format(group1)).read()
+            self.assertEqual(list(table['start']), [0, 20])
+            self.assertEqual(list(table['seq_id']), [0, 1])
+            for (group, leaf), d in zip([(group1, 0), (group1, 1), (group2, 0)], data):
+                self.assertTrue(np.all(read_stored_sequence(f, group, leaf) == d))
+
+    def test_string_metadata(self):
+        """ strings longer than the first one are stored whole, and strings that don't fit raise. """
+        data = np.zeros((2, 30, 40), dtype=bool)
+        with HfiveStreamSaver(self.pth, overwrite=True, max_string_bytes=100) as saver:
+            saver.store_sequence_array(data, {'note': 'a'})
+            saver.store_sequence_array(data, {'note': 'b' * 100})
+            with self.assertRaises(ValueError):
+                saver.store_sequence_array(data, {'note': 'c' * 101})
+            group = saver.current_group_id
+        with tb.open_file(self.pth, 'r') as f:
+            notes = f.get_node('/patterns/{}/sequences'.format(group)).read()['note']
+        self.assertEqual(list(notes), [b'a', b'b' * 100])
+
+    def test_no_overwrite(self):
+        with HfiveStreamSaver(self.pth, overwrite=True):
+            pass
+        with self.assertRaises(FileExistsError):
+            HfiveStreamSaver(self.pth, overwrite=False)
+
+    def tearDown(self):
+        os.remove(self.pth)
+
+
+class TestPackedStorage(unittest.TestCase):
+    pth = 'test_packed.h5'
+
+    def setUp(self):
+        self.data = [np.random.randint(0, 2, (n, 30, 45), dtype=bool) for n in (20, 7)]
+        self.logical_mask = np.zeros((30, 45), dtype=bool)
+        self.logical_mask[5:25, 3:40] = True
+
+    def _check(self, saver_class, packing):
+        with saver_class(self.pth, overwrite=True, packing=packing, logical_mask=self.logical_mask) as saver:
+            for d in self.data:
+                saver.store_sequence_array(d)
+            group = saver.current_group_id
+        if packing == 'unmasked':
+            expected = [d & self.logical_mask for d in self.data]
+        else:
+            expected = self.data
+        with tb.open_file(self.pth, 'r') as f:
+            self.assertEqual(f.get_node_attr('/', 'pattern_packing'), packing)
+            for leaf, d in enumerate(expected):
+                retrieved = read_stored_sequence(f, group, leaf)
+                self.assertEqual(retrieved.dtype, bool)
+                self.assertTrue(np.all(retrieved == d))
+
+    def test_packed(self):
+        for saver_class in (HfiveSaver, HfiveStreamSaver):
+            for packing in ('bits', 'unmasked', 'coordinates'):
+                with self.subTest(saver=saver_class.__name__, packing=packing):
+                    self._check(saver_class, packing)
+
+    def test_frame_coordinates(self):
+        """ FrameCoordinates are stored as coordinates, or as frames by the other packings. """
+        coordinates = []
+        for d in self.data:
+            frame_numbers, indices = np.nonzero(d.reshape(len(d), -1))
+            indptr = np.searchsorted(frame_numbers, np.arange(len(d) + 1))
+            coordinates.append(FrameCoordinates(indptr, indices, d.shape))
+            self.assertTrue(np.all(coordinates[-1].to_dense() == d))
+        for saver_class in (HfiveSaver, HfiveStreamSaver):
+            for packing in (None, 'coordinates'):
+                with self.subTest(saver=saver_class.__name__, packing=packing):
+                    with saver_class(self.pth, overwrite=True, packing=packing) as saver:
+                        for c in coordinates:
+                            saver.store_sequence_array(c)
+                        group = saver.current_group_id
+                    with tb.open_file(self.pth, 'r') as f:
+                        for leaf, d in enumerate(self.data):
+                            self.assertTrue(np.all(read_stored_sequence(f, group, leaf) == d))
+
+    def test_needs_mask(self):
+        with self.assertRaises(ValueError):
+            HfiveSaver(self.pth, overwrite=True, packing='unmasked')
+
+    def tearDown(self):
+        if os.path.exists(self.pth):
+            os.remove(self.pth)
+
+
 class TestSparseSaver(unittest.TestCase):
     workingdir = 'tst'
     prefix = 'testsparse'
@@ -0,0 +1,92 @@
+"""
+Tests decoding sync pulses, synthesized from an emulated presentation, with missing and extra pulses.
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from dmdlib.core.ALP import AlpDmd
+from dmdlib.core.emulator import AlpEmulator
+from dmdlib.randpatterns.presenter import Presenter
+from dmdlib.randpatterns.saving import HfiveSaver
+from dmdlib.randpatterns.sparsenoise_obj import SparseNoise
+from dmdlib.randpatterns import syncpulses
+
+
+class TestDecodePulses(unittest.TestCase):
+    picture_time = 5000
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.workdir, 'session.h5')
+        emulator = AlpEmulator(width=64, height=48, usb_bandwidth=None, conversion_bandwidth=None)
+        with HfiveSaver(cls.path) as saver, AlpDmd(backend=emulator) as dmd:
+            presenter = Presenter(dmd, SparseNoise(.2, np.ones((48, 64), dtype=bool), 4), saver, 60, pix_per_seq=10,
+                                  picture_time=cls.picture_time, poll_interval=.002)
+            presenter.run_session(2)
+            presenter.shutdown()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workdir)
+
+    def setUp(self):
+        """ one pulse per displayed frame, in seconds, with a pause of 7 frames before the 4th sequence. """
+        self.expected = syncpulses.expected_sequences(self.path)
+        truth, rising, width = [], [], []
+        frame_step = 0
+        for i, e in enumerate(self.expected):
+            if i == 3:
+                frame_step += 7
+            for k in range(e['n_frames'] * e['repeats']):
+                truth.append((e['group'], e['leaf'], k % e['n_frames'], e['seq_id']))
+                rising.append(frame_step * self.picture_time * 1e-6)
+                width.append(e['pulse_width_us'] * 1e-6)
+                frame_step += 1
+        self.truth = np.array(truth, dtype=syncpulses.PULSE_DTYPE)
+        self.rising = np.array(rising) + 30.
+        self.width = np.array(width)
+
+    def _decode(self, keep, extra_rising=(), extra_width=()):
+        rising = np.r_[self.rising[keep], extra_rising]
+        order = np.argsort(rising, kind='stable')
+        falling = np.sort((rising + np.r_[self.width[keep], extra_width]))
+        pulses, summary = syncpulses.decode_pulses(rising[order], falling, self.expected)
+        return pulses[np.argsort(order)], summary
+
+    def test_all_pulses(self):
+        self.assertEqual(len(self.expected), 12)  # 2 runs of 6 sequences.
+        self.assertEqual(len(set(self.expected['group'])), 2)
+        pulses, summary = self._decode(np.ones(len(self.rising), dtype=bool))
+        self.assertTrue(np.all(pulses == self.truth))
+        self.assertEqual(summary['missing'], 0)
+        self.assertAlmostEqual(summary['interval_us'], self.picture_time)
+
+    def test_missing_and_extra(self):
+        rng = np.random.default_rng(0)
+        keep = rng.random(len(self.rising)) > .1
+        keep[30:33] = False  # the first frames of the 4th sequence, after the pause.
+        keep[58:62] = False  # the end of a sequence and the start of the next.
+        keep[70:80] = False  # a whole sequence.
+        keep[[39, 89]] = True  # missing first pulses are inferred from the last pulse of their sequence.
+        glitches = self.rising[[5, 40]] + 4.5e-3  # between two pulses.
+        extra_rising = np.r_[glitches, self.rising[30] - 3 * self.picture_time * 1e-6]  # during the pause.
+        extra_width = np.r_[1e-6, 1e-6, self.width[40]]  # two too short, one of another sequence.
+        pulses, summary = self._decode(keep, extra_rising, extra_width)
+        decoded = pulses[:keep.sum()]
+        self.assertTrue(np.all(decoded == self.truth[keep]))
+        self.assertTrue(np.all(pulses['leaf'][keep.sum():] == -1))
+        self.assertEqual(summary['unclassified'], 2)
+        self.assertEqual(summary['unmatched'], 1)
+        self.assertEqual(summary['missing'], np.sum(~keep))
+
+    def test_recording(self):
+        pulses, _ = syncpulses.decode_recording(self.path, self.rising, self.rising + self.width)
+        self.assertTrue(np.all(pulses == self.truth))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4)
@@ -0,0 +1,36 @@
+"""
+Tests for pattern rendering utilities.
+"""
+
+import unittest
+import numpy as np
+from dmdlib.randpatterns import utils
+
+
+class TestRenderSequence(unittest.TestCase):
+    h, w = 768, 1024
+
+    def _check_packed(self, scale):
+        n = 5
+        mask = np.zeros((self.h, self.w), dtype=bool)
+        mask[100:600, 37:900] = True
+        seq_array_bool = np.random.rand(n, self.h // scale, self.w // scale) < .3
+        unpacked = np.zeros((n, self.h, self.w), dtype=np.uint8)
+        packed = np.zeros((n, self.h, self.w // 8), dtype=np.uint8)
+        utils.render_sequence(seq_array_bool, scale, unpacked, mask)
+        utils.render_sequence(seq_array_bool, scale, packed, mask)
+        self.assertTrue(np.all(np.packbits(unpacked, axis=-1) == packed))
+        self.assertTrue(np.all(unpacked[:, ~mask] == 0))
+
+    def test_packed_scale_4(self):
+        self._check_packed(4)
+
+    def test_packed_scale_1(self):
+        self._check_packed(1)
+
+    def test_packed_scale_3(self):
+        self._check_packed(3)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4)
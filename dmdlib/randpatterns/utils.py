@@ -1,5 +1,6 @@
 import os
 import concurrent.futures
+import threading
 from dmdlib.core.ALP import *
 import tables as tb
 import numpy as np
@@ -24,9 +25,203 @@ def setup_parser():
     parser.add_argument('--scale', type=int, default=4, help='scale factor for pixels. NxN physical pixels are treated as a single logical pixel')
     parser.add_argument('--frames_per_run', type=int, default=60000, help='number of frames to present for each run')
     parser.add_argument('--no_phys', action='store_true', help="bypass connection to openephys for testing")
+    parser.add_argument('--packed', action='store_true',
+                        help='upload frames as packed binary data (8 mirrors per byte) to reduce upload size')
+    parser.add_argument('--read_ahead', type=int, default=0,
+                        help='generate up to this many sequences ahead of upload in a worker thread (default 0: '
+                             'generate in the presentation loop)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='session seed for pattern generation (default: random). It is saved with the patterns.')
+    parser.add_argument('--seeds_only', action='store_true',
+                        help='save the frame indices of each sequence instead of the patterns. Patterns can be '
+                             'regenerated from the saved generator parameters (see dmdlib.randpatterns.regenerate)')
+    parser.add_argument('--stream_save', action='store_true',
+                        help='keep the save file open and append the frames of each run to a single array '
+                             '(HfiveStreamSaver) instead of writing a node per sequence')
+    parser.add_argument('--pack_storage', choices=['bits', 'unmasked', 'coordinates'], default=None,
+                        help='store frames bit-packed (8 logical pixels per byte), optionally keeping only the '
+                             'unmasked logical pixels, or as the coordinates of the on pixels')
+    parser.add_argument('--save_queue_mb', type=int, default=1024,
+                        help='memory for sequences waiting to be saved. When it is full, the presentation waits for '
+                             'the writes to complete')
+    parser.add_argument('--autotune', action='store_true',
+                        help='choose the number and length of the sequences from generation and upload times measured '
+                             'at startup, and add sequences during the run if the device queue drains')
+    parser.add_argument('--emulate', action='store_true',
+                        help="use a software-emulated DMD instead of the ALP device (for testing and benchmarking)")
     return parser
 
 
+def make_dmd(args) -> AlpDmd:
+    """
+    Returns an AlpDmd object for the parsed command line arguments, using the emulated device if requested.
+    """
+    if args.emulate:
+        from dmdlib.core.emulator import AlpEmulator
+        return AlpDmd(backend=AlpEmulator())
+    return AlpDmd()
+
+
+def make_saver(args, path, attributes=None, logical_mask=None):
+    """
+    Returns the h5 saver for the parsed command line arguments.
+
+    :param logical_mask: boolean array of the unmasked logical pixels, used by --pack_storage unmasked.
+    """
+    from dmdlib.randpatterns import saving
+    if args.stream_save:
+        saver_class = saving.HfiveStreamSaver
+    else:
+        saver_class = saving.HfiveSaver
+    return saver_class(path, args.overwrite, attributes=attributes, save_frames=not args.seeds_only,
+                       packing=args.pack_storage, logical_mask=logical_mask,
+                       max_queue_bytes=args.save_queue_mb * 2 ** 20)
+
+
+class FrameStreams:
+    """
+    Counter-based random number streams that are addressable by frame index, so that any frame of a session can be
+    regenerated from the session seed alone. Each (frame, substream) pair is an independent Philox stream keyed by
+    the seed: the frame index and substream are set in the counter, so no stream has to be advanced to reach a frame.
+    """
+
+    def __init__(self, seed=None):
+        """
+        :param seed: session seed (int). If None, a new random seed is drawn from OS entropy.
+        """
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = int(seed)
+        self._key = np.random.SeedSequence(self.seed).generate_state(2, np.uint64)
+
+    def frame(self, index, substream=0) -> np.random.Generator:
+        """
+        :param index: frame index within the session.
+        :param substream: use different substreams for independent draws concerning the same frame (or block).
+        :return: np.random.Generator for the frame.
+        """
+        return np.random.Generator(np.random.Philox(key=self._key, counter=[0, index, substream, 0]))
+
+    def kernel_key(self, substream=0) -> np.uint64:
+        """
+        :param substream: use different substreams for independent draws concerning the same frame (or block).
+        :return: 64 bit key of the frame streams used by numba kernels (see frame_stream_state).
+        """
+        return self._key[0] ^ np.uint64(splitmix64(self._key[1] + np.uint64(substream)))
+
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+@nb.njit(nogil=True)
+def splitmix64(z):
+    """ splitmix64 output function: maps a 64 bit counter to a well mixed 64 bit random value. """
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+@nb.njit(nogil=True)
+def frame_stream_state(key, index):
+    """
+    Start state of the random stream of a frame for use in numba kernels. The n-th 64 bit draw of the stream
+    (n = 0, 1, ...) is stream_draw(state, n), so draws can be taken in any order and by any thread.
+
+    :param key: 64 bit key from FrameStreams.kernel_key.
+    :param index: frame index.
+    """
+    return splitmix64(key + np.uint64(index) * _GOLDEN)
+
+
+@nb.njit(nogil=True)
+def stream_draw(state, n):
+    """ n-th 64 bit draw of the stream starting at state. """
+    return splitmix64(state + np.uint64(n + 1) * _GOLDEN)
+
+
+def probability_threshold(probability) -> np.uint64:
+    """
+    Threshold for the 53 high bits of stream draws: a pixel is on if (draw >> 11) < threshold, which happens with
+    the given probability.
+    """
+    return np.uint64(round(min(max(probability, 0.), 1.) * 2 ** 53))
+
+
+@nb.jit(parallel=True, nopython=True, nogil=True)
+def sparse_frames(key, start, threshold, unmasked_idx, seq_array_bool):
+    """
+    Draws sparse frames: each unmasked logical pixel j of frame i is on if the j-th draw of the frame's stream is
+    below threshold.
+
+    :param key: 64 bit key from FrameStreams.kernel_key.
+    :param start: frame index of the first frame.
+    :param threshold: from probability_threshold.
+    :param unmasked_idx: flat indices of the unmasked logical pixels.
+    :param seq_array_bool: boolean array (n, h / scale, w / scale) to write to.
+    """
+    n, h, w = seq_array_bool.shape
+    for i in nb.prange(n):
+        state = frame_stream_state(key, start + i)
+        seq_array_bool[i, :, :] = False
+        for j in range(unmasked_idx.shape[0]):
+            if (stream_draw(state, j) >> np.uint64(11)) < threshold:
+                idx = unmasked_idx[j]
+                seq_array_bool[i, idx // w, idx % w] = True
+
+
+@nb.jit(parallel=True, nopython=True, nogil=True)
+def sparse_frames_render(key, start, threshold, unmasked_idx, scale, mask, full, seq_array_bool, seq_array, packed):
+    """
+    Same as sparse_frames, but also writes the zoomed and masked frames for upload in the same pass (as
+    render_sequence would from seq_array_bool). Only the logical pixels that are on are touched after the frames are
+    cleared, so no temporary arrays are needed.
+
+    :param scale: logical pixel size in mirrors.
+    :param mask: boolean mask (h, w) of the DMD.
+    :param full: boolean array (h / scale, w / scale) of the logical pixels whose mirrors are all unmasked (see
+    geometry.MaskGeometry).
+    :param seq_array: uint8 array (n, h, w) or packed binary (n, h, w / 8) to write to. Packed rows must not include
+    the padding byte of SXGA+ rows.
+    :param packed: True if seq_array is packed binary.
+    """
+    n, h, w = seq_array_bool.shape
+    for i in nb.prange(n):
+        state = frame_stream_state(key, start + i)
+        seq_array_bool[i, :, :] = False
+        seq_array[i, :, :] = 0
+        for j in range(unmasked_idx.shape[0]):
+            if (stream_draw(state, j) >> np.uint64(11)) < threshold:
+                idx = unmasked_idx[j]
+                y = idx // w
+                x = idx % w
+                seq_array_bool[i, y, x] = True
+                _write_block(seq_array, i, y, x, scale, mask, full[y, x], packed, True)
+
+
+@nb.njit(nogil=True)
+def _write_block(seq_array, i, y, x, scale, mask, full_block, packed, value):
+    """
+    Sets (value True) or clears the unmasked mirrors of logical pixel (y, x) of frame i. The mask is not checked if
+    all mirrors of the block are unmasked (full_block).
+    """
+    if full_block and not packed:
+        seq_array[i, y * scale:(y + 1) * scale, x * scale:(x + 1) * scale] = 255 if value else 0
+        return
+    for yy in range(y * scale, (y + 1) * scale):
+        for xx in range(x * scale, (x + 1) * scale):
+            if full_block or mask[yy, xx]:
+                if packed:
+                    bit = np.uint8(128 >> (xx & 7))
+                    if value:
+                        seq_array[i, yy, xx >> 3] |= bit
+                    else:
+                        seq_array[i, yy, xx >> 3] &= ~bit
+                elif value:
+                    seq_array[i, yy, xx] = 255
+                else:
+                    seq_array[i, yy, xx] = 0
+
+
 def reshape(random_unshaped_array, mask_array, seq_array_bool):
     """ Reshapes a random bool array into the correct shape. Modifies seq_array_bool in place.
 
@@ -46,7 +241,7 @@ def reshape(random_unshaped_array, mask_array, seq_array_bool):
     random_unshaped_array.shape = -1
 
 
-@nb.jit(parallel=True, nopython=True)
+@nb.jit(parallel=True, nopython=True, nogil=True)
 def zoomer(arr_in, scale, arr_out):
     """
     Fast nd array image rescaling for 3 dimensional image arrays expressed as numpy arrays.
@@ -70,6 +265,153 @@ def zoomer(arr_in, scale, arr_out):
                     arr_out[i, j_st:j_nd, k_st:k_nd] = 0
 
 
+@nb.jit(parallel=True, nopython=True, nogil=True)
+def zoomer_packed(arr_in, scale, arr_out):
+    """
+    Same as zoomer, but writes packed binary rows (8 mirrors per byte, bit 7 is the leftmost mirror) as used by the
+    ALP_DATA_BINARY_TOPDOWN data format. ARR_OUT MUST be the correct size (n, h, w / 8)!
+
+    :param arr_in: boolean array
+    :param scale: scale value. 1 pixel in arr in will be scale by scale pixels in output array.
+    :param arr_out: uint8 array to write to.
+    """
+    a, b, c = arr_in.shape
+    n_bytes = arr_out.shape[2]
+    for i in nb.prange(a):
+        for j in range(b):
+            j_st = j * scale
+            for byte in range(n_bytes):
+                v = 0
+                for bit in range(8):
+                    k = (byte * 8 + bit) // scale
+                    if k < c and arr_in[i, j, k]:
+                        v |= 128 >> bit
+                for jj in range(j_st, j_st + scale):
+                    arr_out[i, jj, byte] = v
+
+
+@nb.njit(nogil=True)
+def _geometric_walk(state, log_q, n_pix, out, offset, write):
+    """
+    Walks through n_pix Bernoulli trials with on-probability p = 1 - exp(log_q), jumping straight from one on trial
+    to the next with geometrically distributed gaps. Each gap uses one draw of the stream, so the work is
+    proportional to the number of on trials. The number of on trials is binomial(n_pix, p).
+
+    :return: number of on trials. Their positions are written to out[offset:] if write is True.
+    """
+    if log_q == 0.:  # p == 0
+        return 0
+    pos = -1
+    k = 0
+    draw = 0
+    while True:
+        u = ((stream_draw(state, draw) >> np.uint64(11)) + np.uint64(1)) * (1. / 2 ** 53)  # uniform in (0, 1]
+        draw += 1
+        gap = np.floor(np.log(u) / log_q)
+        if pos + 1 + gap >= n_pix:
+            return k
+        pos += 1 + int(gap)
+        if write:
+            out[offset + k] = pos
+        k += 1
+
+
+@nb.jit(parallel=True, nopython=True, nogil=True)
+def _count_sparse_coordinates(key, start, log_q, n_pix, counts):
+    dummy = np.empty(0, dtype=np.int64)
+    for i in nb.prange(counts.shape[0]):
+        counts[i] = _geometric_walk(frame_stream_state(key, start + i), log_q, n_pix, dummy, 0, False)
+
+
+@nb.jit(parallel=True, nopython=True, nogil=True)
+def _fill_sparse_coordinates(key, start, log_q, n_pix, unmasked_idx, indptr, indices):
+    for i in nb.prange(indptr.shape[0] - 1):
+        _geometric_walk(frame_stream_state(key, start + i), log_q, n_pix, indices, indptr[i], True)
+        for k in range(indptr[i], indptr[i + 1]):
+            indices[k] = unmasked_idx[indices[k]]
+
+
+def sparse_coordinates(key, start, n_frames, probability, unmasked_idx):
+    """
+    Draws the on pixels of sparse frames as a coordinate list, with a cost proportional to the number of on pixels.
+    Each unmasked logical pixel is on with the given probability, independently.
+
+    :param key: 64 bit key from FrameStreams.kernel_key.
+    :param start: frame index of the first frame.
+    :param n_frames: number of frames.
+    :param probability: probability of each pixel being on.
+    :param unmasked_idx: flat indices of the unmasked logical pixels.
+    :return: (indptr, indices): the on pixels of frame i are the flat logical pixel indices
+    indices[indptr[i]:indptr[i + 1]] (CSR layout).
+    """
+    log_q = -np.inf if probability >= 1. else np.log1p(-max(probability, 0.))
+    counts = np.empty(n_frames, dtype=np.int64)
+    _count_sparse_coordinates(key, start, log_q, len(unmasked_idx), counts)
+    indptr = np.zeros(n_frames + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    indices = np.empty(indptr[-1], dtype=np.int64)
+    _fill_sparse_coordinates(key, start, log_q, len(unmasked_idx), unmasked_idx, indptr, indices)
+    return indptr, indices
+
+
+@nb.jit(parallel=True, nopython=True, nogil=True)
+def render_coordinates(indptr, indices, scale, mask, full, seq_array_bool, seq_array, packed, value):
+    """
+    Sets (value True) or clears (value False) the pixels of a coordinate list in the logical and the upload arrays.
+    Only the listed pixels are touched, so rendering into a cleared buffer costs as much as the number of on pixels.
+
+    :param indptr: frame offsets into indices (see sparse_coordinates).
+    :param indices: flat logical pixel indices.
+    :param scale: logical pixel size in mirrors.
+    :param mask: boolean mask (h, w) of the DMD.
+    :param full: boolean array (h / scale, w / scale) of the logical pixels whose mirrors are all unmasked (see
+    geometry.MaskGeometry), for which the mask is not checked.
+    :param seq_array_bool: boolean array (n, h / scale, w / scale).
+    :param seq_array: uint8 array (n, h, w) or packed binary (n, h, w / 8) without SXGA+ padding bytes.
+    :param packed: True if seq_array is packed binary.
+    :param value: True to set the pixels, False to clear them.
+    """
+    w = seq_array_bool.shape[2]
+    for i in nb.prange(indptr.shape[0] - 1):
+        for k in range(indptr[i], indptr[i + 1]):
+            y = indices[k] // w
+            x = indices[k] % w
+            seq_array_bool[i, y, x] = value
+            _write_block(seq_array, i, y, x, scale, mask, full[y, x], packed, value)
+
+
+def packed_rows(seq_array, width):
+    """
+    :param seq_array: packed binary upload array (n, h, packed row bytes).
+    :param width: width of the frames in mirrors.
+    :return: view of seq_array without the padding byte of SXGA+ rows.
+    """
+    row_bytes = (width + 7) // 8
+    return seq_array[:, :, seq_array.shape[2] - row_bytes:]
+
+
+def render_sequence(seq_array_bool, scale, seq_array, mask=None):
+    """
+    Zooms the logical pixels into the array for upload and applies the mask. The upload array can be either one byte
+    per mirror (n, h, w) or packed binary (n, h, packed row bytes), see AlpFrameSequence.
+
+    :param seq_array_bool: boolean array (n, h / scale, w / scale)
+    :param scale: logical pixel size in mirrors.
+    :param seq_array: uint8 array to write to.
+    :param mask: boolean mask (h, w). Everything that is 0 is forced to 0.
+    """
+    n, h, w = seq_array_bool.shape
+    if seq_array.shape[2] >= w * scale:
+        zoomer(seq_array_bool, scale, seq_array)
+        if mask is not None:
+            seq_array *= mask  # mask is 1 in areas we want to stimulate and 0 otherwise.
+    else:
+        packed = packed_rows(seq_array, w * scale)  # skips the padding byte of SXGA+ rows.
+        zoomer_packed(seq_array_bool, scale, packed)
+        if mask is not None:
+            packed &= np.packbits(mask, axis=-1)[:, :packed.shape[2]]
+
+
 @nb.jit(parallel=True)
 def find_unmasked_px(mask, scale):
     """
@@ -81,7 +423,7 @@ def find_unmasked_px(mask, scale):
     h, w = mask.shape
     h_scaled = h // scale
     w_scaled = w // scale
-    valid_array = np.zeros((h_scaled, w_scaled), dtype=bool)
+    valid_array = np.zeros((h_scaled, w_scaled), dtype=np.bool_)
     for y in nb.prange(h_scaled):
         st_y = y * scale
         nd_y = st_y + scale
@@ -92,3 +434,18 @@ def find_unmasked_px(mask, scale):
                 valid_array[y, x] = True
     return valid_array
 
+
+_parallel_started = False
+
+
+def start_parallel_threads():
+    """
+    Runs a small parallel kernel if this is the main thread and none has run yet. numba's TBB threading layer hangs
+    the interpreter at exit if it was started by another thread, which happens when the first parallel kernel runs in
+    an executor or reader thread (ie regenerate_frames or FileSource).
+    """
+    global _parallel_started
+    if not _parallel_started and threading.current_thread() is threading.main_thread():
+        find_unmasked_px(np.ones((1, 1), dtype=np.bool_), 1)
+        _parallel_started = True
+
@@ -15,7 +15,10 @@ setup(
         'console_scripts': ['sparsenoise=dmdlib.randpatterns.sparsenoise_obj:main',
                             'scanner=dmdlib.randpatterns.scanner:main',
                             'whitenoise=dmdlib.randpatterns.whitenoise:main',
-                            'multisparse=dmdlib.randpatterns.multisparse_obj:main']
+                            'multisparse=dmdlib.randpatterns.multisparse_obj:main',
+                            'patternbank=dmdlib.randpatterns.bank:main',
+                            'replay=dmdlib.randpatterns.replay:main',
+                            'prerender=dmdlib.randpatterns.replay:prerender_main']
 
     }, install_requires=['numba', 'numpy', 'tqdm']
 )
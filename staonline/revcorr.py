@@ -0,0 +1,170 @@
+"""
+Spike triggered averages of recorded sessions for many units at once (offline reverse correlation).
+
+The spikes are binned into a sparse spike count matrix S (units x frames). With the frames of the recording as rows
+of X (frames x unmasked logical pixels), the sums of all units at lag k are S[:, k:] @ X, so each chunk of frames
+is read once and correlated with all units by sparse matrix products: sparse x dense for .h5 recordings, and
+sparse x sparse for the csr matrices of SparseSaver sets. Chunks of the recording are correlated in parallel
+processes, and the units are split into blocks if their sums would not fit in the memory limit.
+
+See sta.StreamingSTA for averaging during a presentation.
+"""
+
+from concurrent import futures
+from collections import deque
+import multiprocessing
+import os
+import numpy as np
+from scipy import sparse
+from dmdlib.randpatterns import replay, utils
+
+
+def spike_count_matrix(units, frames, n_units, n_frames) -> sparse.csc_matrix:
+    """
+    :param units: unit number of each spike.
+    :param frames: index of the frame displayed at each spike (see sta.frames_at). Spikes outside of the frames are
+    ignored.
+    :return: float32 matrix (n_units, n_frames) of the number of spikes of each unit during each frame.
+    """
+    units = np.asarray(units, dtype=np.int64).ravel()
+    frames = np.asarray(frames, dtype=np.int64).ravel()
+    keep = (frames >= 0) & (frames < n_frames)
+    counts = np.ones(int(keep.sum()), dtype=np.float32)
+    return sparse.csc_matrix((counts, (units[keep], frames[keep])), shape=(n_units, n_frames))  # sums duplicates.
+
+
+def reverse_correlation(path, units, frames, n_units, n_lags=10, groups=None, centered=False, n_workers=None,
+                        max_memory_mb=2048):
+    """
+    Spike triggered averages of a recording, as StreamingSTA would average them during its presentation.
+
+    :param path: .h5 file, or the path prefix (or .json store file) of a SparseSaver set.
+    :param units: unit number of each spike.
+    :param frames: index of the frame displayed at each spike, counting the frames of the groups in presentation
+    order. Spikes before frame n_lags - 1 or after the last frame are not averaged (StreamingSTA leaves the latter
+    pending).
+    :param n_units: number of units.
+    :param n_lags: number of frames averaged before each spike (including the frame at the spike).
+    :param groups: pattern groups to average (default: all of them).
+    :param centered: subtract the mean frame, so that pixels unrelated to a unit average to 0.
+    :param n_workers: number of processes (default: number of processors). With 1, the chunks are correlated in
+    this process.
+    :param max_memory_mb: approximate limit of the memory used by the workers' sums and frames (not counting the
+    returned averages).
+    :return: float array (n_units, n_lags, h / scale, w / scale) of the averages (NaN at masked pixels), and the
+    number of spikes averaged for each unit.
+    """
+    path, index, mask, params, read = replay.index_recording(path, groups)
+    if mask is None or 'scale' not in params:
+        raise ValueError('The recording must have a mask and the generator scale.')
+    unmasked = utils.find_unmasked_px(mask, params['scale'])
+    n_pix = int(unmasked.sum())
+    n_frames = sum(n for _, _, n in index)
+    frames = np.asarray(frames, dtype=np.int64).ravel()
+    # the extra columns only line up the lags of the last frames, they hold no spikes.
+    frames = np.where((frames >= n_lags - 1) & (frames < n_frames), frames, -1)
+    counts = spike_count_matrix(units, frames, n_units, n_frames + n_lags - 1)
+    n_spikes = np.asarray(counts.sum(axis=1)).ravel().astype(np.int64)
+
+    n_workers = n_workers or os.cpu_count()
+    budget = max_memory_mb * 2 ** 20 // n_workers
+    # half of each worker's budget for its sums, and half for the frames of a chunk (as float32).
+    unit_block = int(min(n_units, max(budget // 2 // (n_lags * n_pix * 8), 1)))
+    chunk_frames = int(max(budget // 2 // (n_pix * 4), 1))
+    jobs = []
+    for sequences, first in _split(index, n_workers):
+        n = sum(n for _, _, n in sequences)
+        for u in range(0, n_units, unit_block):
+            spikes = counts[u:u + unit_block, first:first + n + n_lags - 1]
+            jobs.append((u, (read, path, sequences, params, mask, unmasked, spikes, n_lags, chunk_frames)))
+
+    sums = np.zeros((n_units, n_lags, n_pix))
+    frame_sum = np.zeros(n_pix)
+
+    def add(u, result):
+        job_sums, job_frame_sum = result
+        sums[u:u + len(job_sums)] += job_sums
+        if u == 0:  # each range of frames is read once per block of units.
+            frame_sum[:] += job_frame_sum
+
+    if n_workers == 1:
+        for u, args in jobs:
+            add(u, _correlate(*args))
+    else:
+        # forked workers would inherit the state of the numba threads, which hangs the process on exit.
+        with futures.ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            running = deque()  # at most one job per worker, so that the finished sums do not pile up.
+            for u, args in jobs:
+                if len(running) == n_workers:
+                    u_done, job = running.popleft()
+                    add(u_done, job.result())
+                running.append((u, executor.submit(_correlate, *args)))
+            while running:
+                u, job = running.popleft()
+                add(u, job.result())
+
+    sums /= np.maximum(n_spikes, 1)[:, None, None]
+    if centered:
+        sums -= frame_sum / max(n_frames, 1)
+    sta = np.full((n_units, n_lags) + unmasked.shape, np.nan)
+    sta[:, :, unmasked] = sums
+    return sta, n_spikes
+
+
+def _split(index, n_ranges):
+    """ splits the sequences into contiguous ranges with about equal numbers of frames: [(sequences, first frame)]. """
+    offsets = np.cumsum([0] + [n for _, _, n in index])
+    bounds = np.searchsorted(offsets, np.linspace(0, offsets[-1], n_ranges + 1)[1:-1])
+    ranges = []
+    for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(index)]):
+        if stop > start:
+            ranges.append((index[start:stop], int(offsets[start])))
+    return ranges
+
+
+def _correlate(read, path, index, params, mask, unmasked, spikes, n_lags, chunk_frames):
+    """
+    Sums the frames of the indexed sequences before the spikes (worker process).
+
+    :param read: reader function of the recording (see replay.index_recording).
+    :param spikes: spike count matrix (units, frames + n_lags - 1) whose first column is the first frame.
+    :return: sums (units, n_lags, unmasked pixels) and the number of frames each pixel was on.
+    """
+    pixels = np.flatnonzero(unmasked.ravel())
+    sums = np.zeros((spikes.shape[0], n_lags, len(pixels)))
+    frame_sum = np.zeros(len(pixels))
+    start = 0
+    for chunk in _chunks(read(path, index, params, mask, params['scale'], sparse_frames=True), pixels,
+                         chunk_frames):
+        n = chunk.shape[0]
+        frame_sum += np.asarray(chunk.sum(axis=0)).ravel()
+        for lag in range(n_lags):
+            product = spikes[:, start + lag:start + lag + n] @ chunk
+            sums[:, lag] += product.toarray() if sparse.issparse(product) else product
+        start += n
+    return sums, frame_sum
+
+
+def _chunks(sequences, pixels, chunk_frames):
+    """
+    Joins sequences of logical frames into chunks of at least chunk_frames frames (or the rest) with one column per
+    unmasked pixel: float32 csr matrices for sparse sequences, float32 arrays for dense ones.
+    """
+    waiting, n = [], 0
+    for frames in sequences:
+        if sparse.issparse(frames):
+            waiting.append(frames.tocsc()[:, pixels].astype(np.float32))
+        else:
+            waiting.append(frames.reshape(len(frames), -1)[:, pixels].astype(np.float32))
+        n += waiting[-1].shape[0]
+        if n >= chunk_frames:
+            yield _join(waiting)
+            waiting, n = [], 0
+    if waiting:
+        yield _join(waiting)
+
+
+def _join(chunks):
+    if sparse.issparse(chunks[0]):
+        return sparse.vstack(chunks, format='csr')
+    return np.concatenate(chunks)
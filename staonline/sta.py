@@ -0,0 +1,250 @@
+"""
+Incremental spike triggered averages of the presented patterns.
+
+Frames are added in presentation order, as the boolean logical patterns that the presenter makes ((n, h / scale,
+w / scale) arrays), as compact frames with one column per unmasked logical pixel, or as coordinate lists of the on
+pixels (dmdlib.randpatterns.saving.FrameCoordinates). Spikes are added as the index of the frame that was displayed
+at the spike time (see frames_at), and may arrive before or after that frame.
+
+The recent frames are kept in a ring buffer as lists of their on pixels, and each spike adds the frames of its lags
+to the sums of its unit. The cost is proportional to the number of spikes times the on pixels per frame, so it does
+not grow with the frame rate, and the sparse patterns are cheap to average.
+"""
+
+import threading
+import numpy as np
+import numba as nb
+
+
+class StreamingSTA:
+    """
+    Spike triggered averages of n_units units over n_lags frames: lag 0 is the frame displayed at the spike time, lag
+    k is the k-th frame before it.
+    """
+    def __init__(self, frame_shape, n_units, n_lags=10, unmasked=None, capacity=None):
+        """
+        :param frame_shape: (h, w) of the logical frames.
+        :param n_units: number of units. Spikes are given as unit numbers from 0 to n_units - 1.
+        :param n_lags: number of frames averaged before each spike (including the frame at the spike).
+        :param unmasked: optional boolean array (h, w) of the unmasked logical pixels (ie generator.unmasked). Only
+        these are averaged, and compact frames have one column per unmasked pixel (in row major order).
+        :param capacity: number of recent frames kept. Spikes can be added up to capacity - n_lags frames after
+        their frame was added (default 4 * n_lags).
+        """
+        self.frame_shape = tuple(frame_shape)
+        self.n_units = n_units
+        self.n_lags = n_lags
+        self.capacity = max(capacity or 4 * n_lags, n_lags)
+        n_logical = self.frame_shape[0] * self.frame_shape[1]
+        if unmasked is None:
+            self.unmasked = None
+            self._pix_index = np.arange(n_logical, dtype=np.int32)
+        else:
+            self.unmasked = np.asarray(unmasked, dtype=bool)
+            if self.unmasked.shape != self.frame_shape:
+                raise ValueError('The unmasked array must have the frame shape {}.'.format(self.frame_shape))
+            self._pix_index = np.full(n_logical, -1, dtype=np.int32)  # logical pixel: compact pixel or -1.
+            self._pix_index[self.unmasked.ravel()] = np.arange(self.unmasked.sum(), dtype=np.int32)
+        self.n_pix = int((self._pix_index >= 0).sum())
+        self._ring_pix = np.zeros((self.capacity, self.n_pix), dtype=np.int32)  # on pixels of each kept frame.
+        self._ring_nnz = np.zeros(self.capacity, dtype=np.int32)
+        self.sums = np.zeros((n_units, n_lags, self.n_pix), dtype=np.int32)
+        self.n_spikes = np.zeros(n_units, dtype=np.int64)
+        self.frame_sum = np.zeros(self.n_pix, dtype=np.int64)  # number of frames each pixel was on.
+        self.n_frames = 0  # frames added, ie the index of the next frame.
+        self.dropped = 0  # spikes too early or too late to be averaged over all lags.
+        self._pending_units = np.zeros(0, dtype=np.int64)
+        self._pending_frames = np.zeros(0, dtype=np.int64)
+        self._lock = threading.Lock()
+
+    def add_frames(self, frames):
+        """
+        Adds the next frames, and averages the waiting spikes that fall on them.
+
+        :param frames: boolean array (n, h, w) of logical frames, boolean array (n, n_pix) of compact frames, or
+        FrameCoordinates.
+        """
+        # waiting spikes are averaged before their frames are overwritten by the later frames of the same call.
+        chunk = self.capacity - self.n_lags + 1
+        with self._lock:
+            if hasattr(frames, 'indptr'):
+                indptr = np.asarray(frames.indptr, dtype=np.int64)
+                pix = self._pix_index[frames.indices]
+                for i in range(0, len(frames), chunk):
+                    part = indptr[i:i + chunk + 1]
+                    _push_coordinates(part, pix, self.n_frames, self._ring_pix, self._ring_nnz)
+                    self._pushed(len(part) - 1)
+            else:
+                flat, pix_index = self._flatten(frames)
+                for i in range(0, len(flat), chunk):
+                    part = flat[i:i + chunk]
+                    _push_frames(part, pix_index, self.n_frames, self._ring_pix, self._ring_nnz)
+                    self._pushed(len(part))
+
+    def _pushed(self, n):
+        """ counts the on pixels of n frames written to the ring buffer, and averages the waiting spikes. """
+        _count_on(self.n_frames, n, self._ring_pix, self._ring_nnz, self.frame_sum)
+        self.n_frames += n
+        self._process()
+
+    def add_spikes(self, units, frames):
+        """
+        Adds spikes. Spikes on frames that have not been added yet wait for them.
+
+        :param units: unit number of each spike.
+        :param frames: index of the frame displayed at each spike (see frames_at).
+        """
+        units = np.asarray(units, dtype=np.int64).ravel()
+        frames = np.asarray(frames, dtype=np.int64).ravel()
+        if len(units) != len(frames):
+            raise ValueError('There must be one unit number per spike.')
+        if len(units) and (units.min() < 0 or units.max() >= self.n_units):
+            raise ValueError('Unit numbers must be from 0 to {}.'.format(self.n_units - 1))
+        with self._lock:
+            self._pending_units = np.concatenate((self._pending_units, units))
+            self._pending_frames = np.concatenate((self._pending_frames, frames))
+            self._process()
+
+    def _flatten(self, frames):
+        """
+        :return: boolean array (n, pixels) of the frames without copying them, and the compact pixel (or -1) of each
+        of its columns.
+        """
+        frames = np.ascontiguousarray(frames, dtype=bool)
+        if frames.ndim == 3:
+            if frames.shape[1:] != self.frame_shape:
+                raise ValueError('Frames must have the shape {}.'.format(self.frame_shape))
+            return frames.reshape(len(frames), len(self._pix_index)), self._pix_index
+        if frames.ndim != 2 or frames.shape[1] != self.n_pix:
+            raise ValueError('Compact frames must have {} columns.'.format(self.n_pix))
+        return frames, np.arange(self.n_pix, dtype=np.int32)
+
+    def _process(self):
+        """ averages the waiting spikes whose frames are in the ring buffer, and drops those that are too old. """
+        frames = self._pending_frames
+        if not len(frames):
+            return
+        first = frames - (self.n_lags - 1)  # frame of the last lag.
+        ready = frames < self.n_frames
+        lost = ready & (first < max(self.n_frames - self.capacity, 0))
+        use = ready & ~lost
+        self.dropped += int(lost.sum())
+        if np.any(use):
+            units, frames = self._pending_units[use], frames[use]
+            order = np.argsort(units, kind='stable')
+            units, frames = units[order], frames[order]
+            starts = np.flatnonzero(np.diff(units, prepend=-1, append=self.n_units))
+            _accumulate(units, frames, starts, self._ring_pix, self._ring_nnz, self.n_lags, self.sums)
+            self.n_spikes += np.bincount(units, minlength=self.n_units)
+        self._pending_units = self._pending_units[~ready]
+        self._pending_frames = self._pending_frames[~ready]
+
+    @property
+    def n_pending(self) -> int:
+        """ spikes waiting for their frames. """
+        return len(self._pending_frames)
+
+    def mean_frame(self) -> np.ndarray:
+        """ :return: fraction of the added frames in which each pixel was on (n_pix). """
+        return self.frame_sum / max(self.n_frames, 1)
+
+    def sta(self, unit, centered=False) -> np.ndarray:
+        """
+        :param unit: unit number.
+        :param centered: subtract the mean frame, so that pixels unrelated to the unit average to 0.
+        :return: float array (n_lags, n_pix) of the fraction of the unit's spikes at which each pixel was on.
+        """
+        with self._lock:
+            sta = self.sums[unit] / max(self.n_spikes[unit], 1)
+            if centered:
+                sta -= self.mean_frame()
+        return sta
+
+    def images(self, unit, centered=False) -> np.ndarray:
+        """
+        :return: float array (n_lags, h, w) of the unit's average (see sta). Masked pixels are NaN.
+        """
+        sta = self.sta(unit, centered)
+        images = np.full((self.n_lags, self.frame_shape[0] * self.frame_shape[1]), np.nan)
+        images[:, self._pix_index >= 0] = sta
+        return images.reshape((self.n_lags,) + self.frame_shape)
+
+    def reset(self):
+        """ clears the averages and the frames, eg. to start a new run whose frames are numbered from 0. """
+        with self._lock:
+            self.sums[:] = 0
+            self.n_spikes[:] = 0
+            self.frame_sum[:] = 0
+            self._ring_nnz[:] = 0
+            self.n_frames = 0
+            self.dropped = 0
+            self._pending_units = self._pending_units[:0]
+            self._pending_frames = self._pending_frames[:0]
+
+
+def frames_at(times, onsets) -> np.ndarray:
+    """
+    Index of the frame that was displayed at each time.
+
+    :param times: spike times, in the clock of the onsets.
+    :param onsets: sorted onset times of the frames (ie from dmdlib.randpatterns.regenerate.read_frame_timestamps).
+    :return: int64 frame indices, -1 for times before the first onset.
+    """
+    return np.searchsorted(onsets, times, side='right').astype(np.int64) - 1
+
+
+@nb.njit(parallel=True, nogil=True)
+def _push_frames(frames, pix_index, first_frame, ring_pix, ring_nnz):
+    """
+    writes the on pixels of boolean frames (n, pixels) to their ring buffer slots. pix_index is the compact pixel of
+    each column, or -1 for masked pixels, which are skipped.
+    """
+    capacity = ring_nnz.shape[0]
+    for i in nb.prange(frames.shape[0]):  # at most capacity frames, so that each has its own slot.
+        slot = (first_frame + i) % capacity
+        nnz = 0
+        for j in range(frames.shape[1]):
+            if frames[i, j] and pix_index[j] >= 0:
+                ring_pix[slot, nnz] = pix_index[j]
+                nnz += 1
+        ring_nnz[slot] = nnz
+
+
+@nb.njit(parallel=True, nogil=True)
+def _push_coordinates(indptr, pix, first_frame, ring_pix, ring_nnz):
+    """ writes the on pixels of coordinate lists to their ring buffer slots. Masked pixels (-1) are skipped. """
+    capacity = ring_nnz.shape[0]
+    for i in nb.prange(indptr.shape[0] - 1):
+        slot = (first_frame + i) % capacity
+        nnz = 0
+        for k in range(indptr[i], indptr[i + 1]):
+            if pix[k] >= 0:
+                ring_pix[slot, nnz] = pix[k]
+                nnz += 1
+        ring_nnz[slot] = nnz
+
+
+@nb.njit(nogil=True)
+def _count_on(first_frame, n, ring_pix, ring_nnz, frame_sum):
+    """ adds the on pixels of frames first_frame to first_frame + n - 1 in the ring buffer to frame_sum. """
+    capacity = ring_nnz.shape[0]
+    for i in range(first_frame, first_frame + n):
+        slot = i % capacity
+        for k in range(ring_nnz[slot]):
+            frame_sum[ring_pix[slot, k]] += 1
+
+
+@nb.njit(parallel=True, nogil=True)
+def _accumulate(units, frames, starts, ring_pix, ring_nnz, n_lags, sums):
+    """
+    Adds the frames before each spike to the sums of its unit. The spikes are sorted by unit, and the spikes of a unit
+    are starts[g]:starts[g + 1] for some g, so that the units can be summed in parallel.
+    """
+    capacity = ring_nnz.shape[0]
+    for g in nb.prange(starts.shape[0] - 1):
+        for s in range(starts[g], starts[g + 1]):
+            unit_sums = sums[units[s]]
+            for lag in range(n_lags):
+                slot = (frames[s] - lag) % capacity
+                for k in range(ring_nnz[slot]):
+                    unit_sums[lag, ring_pix[slot, k]] += 1
@@ -0,0 +1,69 @@
+"""
+Tests the offline reverse correlation of saved recordings against the streaming averages of the same frames.
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from dmdlib.randpatterns.replay import prerender
+from dmdlib.randpatterns.saving import HfiveStreamSaver, SparseSaver
+from dmdlib.randpatterns.sparsenoise_obj import SparseNoise
+from dmdlib.randpatterns import regenerate
+from staonline.sta import StreamingSTA
+from staonline.revcorr import reverse_correlation
+
+
+class TestReverseCorrelation(unittest.TestCase):
+    n_frames = 95
+    n_units = 6
+    n_lags = 3
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        mask = np.ones((48, 64), dtype=bool)
+        mask[:8, :] = False
+        self.mask = mask
+        self.generator = SparseNoise(.1, mask, 4, seed=3)
+        rng = np.random.default_rng(2)
+        # and a spike after the last frame, which is not averaged.
+        self.units = np.r_[rng.integers(0, self.n_units, 500), 0]
+        self.frames = np.r_[rng.integers(0, self.n_frames, 500), self.n_frames + 1]
+        streaming = StreamingSTA(self.generator.unmasked.shape, self.n_units, self.n_lags, self.generator.unmasked,
+                                 capacity=self.n_frames + self.n_lags)
+        streaming.add_frames(regenerate.regenerate_frames(self.generator, 0, self.n_frames))
+        streaming.add_spikes(self.units, self.frames)
+        self.expected = np.stack([streaming.images(u, centered=True) for u in range(self.n_units)])
+        self.n_spikes = streaming.n_spikes
+        self.assertEqual(streaming.n_pending, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _check(self, path, **kwargs):
+        sta, n_spikes = reverse_correlation(path, self.units, self.frames, self.n_units, self.n_lags, centered=True,
+                                            **kwargs)
+        self.assertEqual(list(n_spikes), list(self.n_spikes))
+        self.assertTrue(np.allclose(sta, self.expected, equal_nan=True))
+
+    def test_h5(self):
+        path = os.path.join(self.workdir, 'rendered.h5')
+        with HfiveStreamSaver(path) as saver:
+            saver.store_mask_array(self.mask)
+            saver.store_generator_params(self.generator.params())
+            prerender(self.generator, saver, self.n_frames, frames_per_run=50, pix_per_seq=15, n_workers=1)
+        self._check(path, n_workers=1)
+        # blocks of 2 units and chunks of 3 frames in 2 processes.
+        self._check(path, n_workers=2, max_memory_mb=4 * 2 * self.n_lags * 192 * 8 / 2 ** 20)
+
+    def test_sparse_saver(self):
+        with SparseSaver(self.workdir, 'sparse', attributes={}) as saver:
+            saver.store_mask_array(self.mask)
+            saver.store_generator_params(self.generator.params())
+            prerender(self.generator, saver, self.n_frames, pix_per_seq=20, n_workers=1)
+        self._check(os.path.join(self.workdir, 'sparse.json'), n_workers=1)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4)
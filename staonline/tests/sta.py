@@ -0,0 +1,88 @@
+"""
+Tests the streaming spike triggered averages against averages of all the frames.
+"""
+
+import unittest
+import numpy as np
+from scipy import sparse
+from staonline.sta import StreamingSTA, frames_at
+
+
+class Coordinates:
+    """ coordinate list of boolean frames, like dmdlib.randpatterns.saving.FrameCoordinates. """
+    def __init__(self, frames):
+        csr = sparse.csr_matrix(frames.reshape(len(frames), frames.shape[1] * frames.shape[2]))
+        self.indptr, self.indices = csr.indptr, csr.indices
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+
+class TestStreamingSTA(unittest.TestCase):
+    n_frames = 600
+    n_units = 5
+    n_lags = 4
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.frames = rng.random((self.n_frames, 6, 8)) < .2
+        self.unmasked = np.ones((6, 8), dtype=bool)
+        self.unmasked[:, :2] = False
+        self.units = rng.integers(0, self.n_units, 2000)
+        self.spike_frames = rng.integers(0, self.n_frames, 2000)
+
+    def _expected(self, unit):
+        frames = self.spike_frames[(self.units == unit) & (self.spike_frames >= self.n_lags - 1)]
+        return np.stack([self.frames[frames - lag][:, self.unmasked].mean(axis=0) for lag in range(self.n_lags)])
+
+    def _stream(self, sta, chunk, to_frames):
+        """ adds the frames in chunks, and the spikes of each chunk after the next one. """
+        added = np.zeros(len(self.units), dtype=bool)
+        for start in range(0, self.n_frames + chunk, chunk):
+            sta.add_frames(to_frames(self.frames[start:start + chunk]))
+            late = ~added & (self.spike_frames < start)
+            sta.add_spikes(self.units[late], self.spike_frames[late])
+            added |= late
+
+    def _check(self, sta):
+        self.assertEqual(sta.n_pending, 0)
+        self.assertEqual(sta.dropped, np.sum(self.spike_frames < self.n_lags - 1))
+        for unit in range(self.n_units):
+            self.assertTrue(np.allclose(sta.sta(unit), self._expected(unit)))
+        images = sta.images(0, centered=True)
+        self.assertEqual(images.shape, (self.n_lags, 6, 8))
+        self.assertTrue(np.all(np.isnan(images[:, :, :2])))
+        mean = self.frames[:, self.unmasked].mean(axis=0)
+        self.assertTrue(np.allclose(images[:, self.unmasked], self._expected(0) - mean))
+
+    def test_frames(self):
+        sta = StreamingSTA((6, 8), self.n_units, self.n_lags, self.unmasked, capacity=50 + self.n_lags)
+        self._stream(sta, 25, lambda f: f)
+        self._check(sta)
+
+    def test_compact(self):
+        sta = StreamingSTA((6, 8), self.n_units, self.n_lags, self.unmasked, capacity=50 + self.n_lags)
+        self._stream(sta, 25, lambda f: f[:, self.unmasked])
+        self._check(sta)
+
+    def test_coordinates(self):
+        sta = StreamingSTA((6, 8), self.n_units, self.n_lags, self.unmasked, capacity=50 + self.n_lags)
+        self._stream(sta, 25, Coordinates)
+        self._check(sta)
+
+    def test_waiting_spikes(self):
+        """ spikes added before a chunk of frames larger than the ring buffer are averaged, late ones dropped. """
+        sta = StreamingSTA((6, 8), self.n_units, self.n_lags, self.unmasked)
+        sta.add_spikes(self.units, self.spike_frames)
+        sta.add_frames(self.frames)
+        self._check(sta)
+        sta.add_spikes([0], [10])
+        self.assertEqual(sta.dropped, np.sum(self.spike_frames < self.n_lags - 1) + 1)
+
+    def test_frames_at(self):
+        onsets = np.array([100, 110, 120])
+        self.assertEqual(list(frames_at([95, 100, 115, 200], onsets)), [-1, 0, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=4)